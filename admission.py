@@ -0,0 +1,192 @@
+# admission.py
+# Admission control for the LLM stage: bounded concurrency, bounded FIFO wait queue, token-rate budget
+
+import os
+import math
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Any, Optional
+
+# ------------ Config -------------
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", "8"))  # LLM calls in flight, all providers
+LLM_MAX_QUEUE = int(os.environ.get("LLM_MAX_QUEUE", "32"))  # requests allowed to wait for a slot
+LLM_TOKENS_PER_MINUTE = int(os.environ.get("LLM_TOKENS_PER_MINUTE", "0"))  # 0 = no token-rate limit
+# Per-provider caps, e.g. "mistral=4,openai=4". A provider at its cap is skipped if another has room.
+LLM_PROVIDER_CONCURRENCY = os.environ.get("LLM_PROVIDER_CONCURRENCY", "")
+# The limits above are for the whole server; serve.py exports its worker count and each worker
+# process enforces its share (the state lives in process memory)
+WEB_WORKERS = max(1, int(os.environ.get("WEB_WORKERS", "1")))
+# ---------------------------------
+
+
+class QueueFull(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__(f"For mange samtidige analyser. Prøv igjen om {retry_after} s.")
+        self.retry_after = retry_after
+
+
+def parse_provider_limits(spec: str) -> Dict[str, int]:
+    limits = {}
+    for part in spec.split(","):
+        if "=" in part:
+            name, n = part.split("=", 1)
+            limits[name.strip()] = int(n)
+    return limits
+
+
+def worker_share(total: int, workers: int = WEB_WORKERS) -> int:
+    """This worker's part of a server-wide limit: total // workers, at least 1 (0 = off stays 0)."""
+    return max(1, total // workers) if total > 0 else total
+
+
+def estimate_tokens(messages: List[Dict[str, str]], max_tokens: int) -> int:
+    """Rough token cost of one call (prompt at ~4 chars/token plus the completion budget)."""
+    prompt_chars = sum(len(m.get("content", "")) for m in messages)
+    return prompt_chars // 4 + max_tokens
+
+
+def _percentile(values, q: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(q * len(values)))], 3)
+
+
+class Ticket:
+    def __init__(self, tokens: int):
+        self.tokens = tokens
+        self.enqueued = time.monotonic()
+        self.admitted_at: Optional[float] = None
+
+
+class AdmissionController:
+    """FIFO admission to a fixed number of LLM slots, optionally also bounded by tokens per minute.
+
+    `enqueue` either admits immediately, queues the request, or raises QueueFull when the wait
+    queue is already at `max_queue` (callers answer 429 with Retry-After). Waiting is done in
+    short `wait` calls so the caller can report its queue position and watch its deadline.
+    The module-level ADMISSION holds this worker's share of the configured limits.
+    """
+
+    def __init__(self, max_concurrent: int = worker_share(LLM_MAX_CONCURRENCY),
+                 max_queue: int = worker_share(LLM_MAX_QUEUE),
+                 tokens_per_minute: int = worker_share(LLM_TOKENS_PER_MINUTE)):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.tokens_per_minute = tokens_per_minute
+        self._bucket = float(tokens_per_minute)
+        self._refilled = time.monotonic()
+        self._active = 0
+        self._waiting: deque = deque()
+        self._cond = threading.Condition()
+        self.admitted = 0
+        self.rejected = 0
+        self._queue_times: deque = deque(maxlen=1000)
+        self._service_times: deque = deque(maxlen=1000)
+
+    # -- token bucket (call with the lock held) --
+    def _refill(self) -> None:
+        if not self.tokens_per_minute:
+            return
+        now = time.monotonic()
+        self._bucket = min(self.tokens_per_minute, self._bucket + (now - self._refilled) * self.tokens_per_minute / 60)
+        self._refilled = now
+
+    def _can_admit(self, ticket: Ticket) -> bool:
+        if self._active >= self.max_concurrent:
+            return False
+        if self.tokens_per_minute:
+            self._refill()
+            # A single call larger than the whole budget waits for a full bucket rather than forever
+            return self._bucket >= min(ticket.tokens, self.tokens_per_minute)
+        return True
+
+    def _admit(self, ticket: Ticket) -> None:
+        self._active += 1
+        self.admitted += 1
+        if self.tokens_per_minute:
+            self._bucket -= ticket.tokens
+        ticket.admitted_at = time.monotonic()
+        self._queue_times.append(ticket.admitted_at - ticket.enqueued)
+
+    def retry_after(self) -> int:
+        """Seconds until a slot is likely free: queue length times mean service time per slot."""
+        mean = sum(self._service_times) / len(self._service_times) if self._service_times else 5.0
+        return max(1, math.ceil(mean * (len(self._waiting) + 1) / max(1, self.max_concurrent)))
+
+    def reject(self) -> int:
+        """Count a request turned away up front; returns its Retry-After."""
+        with self._cond:
+            self.rejected += 1
+            return self.retry_after()
+
+    def saturated(self) -> bool:
+        with self._cond:
+            return len(self._waiting) >= self.max_queue
+
+    def enqueue(self, tokens: int = 0) -> Ticket:
+        ticket = Ticket(tokens)
+        with self._cond:
+            if not self._waiting and self._can_admit(ticket):
+                self._admit(ticket)
+                return ticket
+            if len(self._waiting) >= self.max_queue:
+                self.rejected += 1
+                raise QueueFull(self.retry_after())
+            self._waiting.append(ticket)
+        return ticket
+
+    def wait(self, ticket: Ticket, timeout: float) -> bool:
+        """Block up to `timeout` seconds; True once the ticket holds a slot."""
+        end = time.monotonic() + timeout
+        with self._cond:
+            while ticket.admitted_at is None:
+                if self._waiting and self._waiting[0] is ticket and self._can_admit(ticket):
+                    self._waiting.popleft()
+                    self._admit(ticket)
+                    self._cond.notify_all()
+                    break
+                left = end - time.monotonic()
+                if left <= 0:
+                    return False
+                self._cond.wait(left)
+        return True
+
+    def position(self, ticket: Ticket) -> int:
+        """1-based place in the wait queue, 0 once admitted."""
+        with self._cond:
+            try:
+                return self._waiting.index(ticket) + 1
+            except ValueError:
+                return 0
+
+    def release(self, ticket: Ticket) -> None:
+        with self._cond:
+            if ticket.admitted_at is not None:
+                self._active -= 1
+                self._service_times.append(time.monotonic() - ticket.admitted_at)
+            elif ticket in self._waiting:
+                self._waiting.remove(ticket)
+            self._cond.notify_all()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            self._refill()
+            queue_times = list(self._queue_times)
+            return {
+                "web_workers": WEB_WORKERS,  # the limits below are per worker
+                "max_concurrent": self.max_concurrent,
+                "max_queue": self.max_queue,
+                "active": self._active,
+                "waiting": len(self._waiting),
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "queue_time_p50": _percentile(queue_times, 0.5),
+                "queue_time_p95": _percentile(queue_times, 0.95),
+                "tokens_per_minute": self.tokens_per_minute or None,
+                "token_budget_left": round(self._bucket) if self.tokens_per_minute else None,
+            }
+
+
+ADMISSION = AdmissionController()
@@ -5,13 +5,33 @@
 import os
 import json
 import time
-from flask import Flask, render_template, request, jsonify, Response, stream_template
+import uuid
+from flask import Flask, render_template, request, jsonify, Response, stream_template, url_for, send_from_directory
 from flask_cors import CORS
 from dotenv import load_dotenv
-from rag_infer import infer, call_mistral_stream
-from icpc_utils import ICPCEntry
-import faiss
-from sentence_transformers import SentenceTransformer
+from rag_infer import call_mistral_stream
+from suggest_index import SuggestIndex, load_synonyms
+from llm_router import ROUTER
+from deadline import Deadline, DeadlineExceeded, degraded_result
+from singleflight import SingleFlight, coalesce_key
+from admission import ADMISSION, QueueFull, estimate_tokens
+from jobs import JobStore, JobRunner, RetryLater, JOBS_DB_PATH, JOB_MAX_NOTES
+from compact_output import build_compact_messages, hydrate, SYSTEM_PROMPT_COMPACT
+from prompt_budget import TokenCounter, GroundingCache, PromptBuilder
+from long_note import LONG_NOTE_MODE, windowed_search
+from cancellation import Cancelled
+from live import LiveSessions, LIVE_TOPN
+from tracing import TRACER, NULL_TRACE, PROFILE_DIR, PROFILE_TOKEN
+from index_store import IndexStore, INDEX_WATCH_INTERVAL
+from bundle import BUNDLE_PATH, read_manifest, verify_bundle, load_model
+from semantic_cache import SemanticCache
+from neighbors import NEIGHBOR_EXPAND
+from model_registry import ModelRegistry, PRIMARY
+from procmem import memory as process_memory
+from evidence import NoteEvidence
+from prompt_layout import PROMPT_LAYOUT, LAYOUTS, CachedLayout, Codebook
+from structured_output import (OUTPUT_STATS, OUTPUT_CONTINUATION, CONTINUATION_MAX_TOKENS, OutputError, parse_output,
+                               response_schema, continuation_messages, join_continuation)
 import numpy as np
 import re
 
@@ -28,29 +48,78 @@ META_PATH = os.environ.get("META_PATH", "icpc2_meta.json")
 TOPN_RETRIEVE = int(os.environ.get("TOPN_RETRIEVE", "40"))
 TEMPERATURE = float(os.environ.get("TEMPERATURE", "0.2"))
 MAX_TOKENS = int(os.environ.get("MAX_TOKENS", "800"))
+ICPC_CSV_PATH = os.environ.get("ICPC_CSV_PATH", "mnt/data/ICPC-2.csv")  # synonyms for /suggest
+SUGGEST_LIMIT = int(os.environ.get("SUGGEST_LIMIT", "10"))
+COALESCE_REQUESTS = os.environ.get("COALESCE_REQUESTS", "1") == "1"  # share identical in-flight analyses
+QUEUE_POLL_INTERVAL = float(os.environ.get("QUEUE_POLL_INTERVAL", "0.5"))  # how often queued requests report position
+JOB_NOTE_DEADLINE = float(os.environ.get("JOB_NOTE_DEADLINE", "120"))  # per-note deadline for background jobs
+SSE_HEARTBEAT = float(os.environ.get("SSE_HEARTBEAT", "2"))  # idle seconds between keep-alives; detects gone clients
+OUTPUT_MODE = os.environ.get("OUTPUT_MODE", "full")  # "compact": LLM returns codes/confidence/evidence only
+COMPACT_MAX_TOKENS = int(os.environ.get("COMPACT_MAX_TOKENS", "300"))  # completion budget in compact mode
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")  # `X-Admin-Token: <token>` for /admin endpoints; empty = disabled
+DEFER_BACKGROUND = os.environ.get("DEFER_BACKGROUND", "0") == "1"  # set by serve.py: threads start per worker after fork
+
+def embed_queries(texts, model):
+    return model.encode([f"query: {t}" for t in texts], convert_to_numpy=True, normalize_embeddings=True)
 
 # Load models and data once at startup
 print("🔄 Loading models and data...")
-faiss_index = faiss.read_index(INDEX_PATH)
-with open(META_PATH, "r", encoding="utf-8") as f:
-    meta = [ICPCEntry(**r) for r in json.load(f)]
-emb = SentenceTransformer(EMB_MODEL)
-print("✅ Models loaded successfully!")
+if BUNDLE_PATH:
+    # Self-contained bundle from build_index.py: model, index and metadata from local files only
+    bundle_manifest = read_manifest(os.path.realpath(BUNDLE_PATH))
+    verify_bundle(os.path.realpath(BUNDLE_PATH), bundle_manifest)
+    EMB_MODEL = bundle_manifest["model"]
+    emb = load_model(os.path.realpath(BUNDLE_PATH), bundle_manifest)
+    print(f"📦 Bundle {bundle_manifest['version']} ({EMB_MODEL}, {bundle_manifest['model_dtype']})")
+else:
+    from sentence_transformers import SentenceTransformer
+    emb = SentenceTransformer(EMB_MODEL)
+token_counter = TokenCounter(hf_tokenizer=getattr(emb, "tokenizer", None))
+ROUTER.count_tokens = token_counter.count  # token accounting when a provider sends no usage
+synonyms = load_synonyms(ICPC_CSV_PATH)
 
-def embed_queries(texts, model):
-    return model.encode([f"query: {t}" for t in texts], convert_to_numpy=True, normalize_embeddings=True)
+def prepare_index_version(version):
+    """Per-index structures, built before a (re)loaded index goes live."""
+    version.grounding_cache = GroundingCache(version.meta, token_counter)  # candidate lines + token counts
+    version.prompt_builder = PromptBuilder(version.grounding_cache, token_counter)
+    version.suggest_index = SuggestIndex(version.meta, synonyms)
 
-def retrieve(note_text, model, faiss_index, meta, topn):
-    qvec = embed_queries([note_text], model)[0].astype(np.float32)
-    D, I = faiss_index.search(qvec.reshape(1, -1), topn)
-    return [meta[i] for i in I[0]]
+# FAISS index + metadata (code_index: titles/chapters for compact-output hydration); hot-reloadable
+INDEX = IndexStore(INDEX_PATH, META_PATH, EMB_MODEL, emb.get_sentence_embedding_dimension(),
+                   prepare=prepare_index_version, probe=embed_queries(["hoste og feber"], emb)[0],
+                   bundle_path=BUNDLE_PATH)
+INDEX.load_initial()
+# Extra (model, index) sets for A/B routing and shadow evaluation; the one above is PRIMARY
+REGISTRY = ModelRegistry(prepare=prepare_index_version)
+REGISTRY.add_primary(emb, INDEX)
+single_flight = SingleFlight(enabled=COALESCE_REQUESTS)
+live_sessions = LiveSessions()
+semantic_cache = SemanticCache()  # reuses results of near-identical earlier notes
+live_flights = SingleFlight(enabled=False)  # threaded, cancellable live analyses (never shared)
+print("✅ Models loaded successfully!")
 
-def format_grounding(entries):
-    lines = []
-    for e in entries:
-        comp = e.component_guess if e.component_guess is not None else e.component_hint
-        lines.append(f"{e.code} | {e.title} | component:{comp} | chapter:{e.chapter}")
-    return "\n".join(lines)
+def retrieve(note_text, model, faiss_index, meta, topn, timings=None, note_vectors=None, neighbors=None):
+    """Top `topn` entries. With NEIGHBOR_EXPAND and a neighbor graph, only the top NEIGHBOR_EXPAND
+    are searched and the rest are filled with their graph neighbors."""
+    expand = neighbors is not None and 0 < NEIGHBOR_EXPAND < topn
+    k = NEIGHBOR_EXPAND if expand else topn
+    if LONG_NOTE_MODE:
+        # Long notes: overlapping windows, one batched encode + one search, pooled per code
+        hits = windowed_search([note_text], model, faiss_index, k, timings=timings, note_vectors=note_vectors)
+        rows = [i for i, _ in hits[0]]
+    else:
+        t0 = time.perf_counter()
+        qvec = embed_queries([note_text], model)[0].astype(np.float32)
+        t1 = time.perf_counter()
+        D, I = faiss_index.search(qvec.reshape(1, -1), k)
+        if timings is not None:
+            timings["embed"], timings["search"] = (t0, t1), (t1, time.perf_counter())
+        if note_vectors is not None:
+            note_vectors.append(qvec)
+        rows = [int(i) for i in I[0] if i >= 0]
+    if expand:
+        rows = neighbors.expand(rows, topn)
+    return [meta[i] for i in rows]
 
 SYSTEM_PROMPT = """Du er en medisinsk kodeassistent i allmennpraksis.
 Oppgave: Foreslå ICPC-2-koder for et konsultasjonsnotat.
@@ -61,7 +130,7 @@ Regler:
 3) Maks 3 forslag.
 4) Symptom vs. diagnose: Hvis diagnosen ikke er tydelig etablert, prioriter symptomkode (komponent 1) fremfor sykdomsdiagnose (komponent 7).
 5) Prosesskoder (komponent 2–6) kun ved eksplisitt prosess (screening, henvisning, sykmelding, prøver, behandling, administrativt).
-6) For hver kode: kort begrunnelse og 1–3 tekstbevis (spans) ordrett fra notatet (angi gjerne seksjon).
+6) For hver kode: kort begrunnelse og 1–3 tekstbevis (spans) ordrett fra notatet.
 7) Sett confidence 0.0–1.0 konservativt. Bruk needs_review: true ved lav sikkerhet eller mulig feilkode.
 8) Ingen kjede-resonnering. Ikke avslør interne steg.
 
@@ -80,9 +149,8 @@ Output-skjema (JSON):
       "component": 1,
       "confidence": 0.0,
       "evidence_spans": [
-        {"text": "ordrett sitat fra notatet", "section": "Anamnese|Status|Vurdering|Plan|Ukjent"}
+        {"text": "ordrett sitat fra notatet"}
       ],
-      "alternatives": ["ALT1", "ALT2"],
       "needs_review": false
     }
   ],
@@ -107,16 +175,345 @@ Returner KUN JSON iht. skjemaet. Ikke skriv noe annet.
         {"role": "user", "content": user_content},
     ]
 
-def parse_json_or_raise(text):
-    m = re.search(r"\{.*\}", text, flags=re.S)
-    if not m:
-        raise ValueError("Model did not return JSON.")
-    return json.loads(m.group(0))
+# Prompt-cache friendly layouts (prompt_layout.py); 'rag' is build_messages above
+CACHED_LAYOUTS = {(layout, compact): CachedLayout(SYSTEM_PROMPT_COMPACT if compact else SYSTEM_PROMPT,
+                                                   sort_candidates=layout == 'cached-sorted')
+                  for layout in ('cached', 'cached-sorted') for compact in (False, True)}
+
+def prompt_template(version, layout, compact):
+    """Message builder for a layout. Codebooks are built per index version on first use."""
+    if layout == 'codebook':
+        books = getattr(version, 'codebooks', None)
+        if books is None:
+            books = version.codebooks = {}
+        if compact not in books:
+            books[compact] = Codebook(version.meta, SYSTEM_PROMPT_COMPACT if compact else SYSTEM_PROMPT)
+        return books[compact]
+    if (layout, compact) in CACHED_LAYOUTS:
+        return CACHED_LAYOUTS[(layout, compact)]
+    return build_compact_messages if compact else build_messages
 
 @app.route('/')
 def index():
     return render_template('index.html')
 
+@app.route('/suggest', methods=['GET'])
+def suggest():
+    query = request.args.get('q', '').strip()
+    limit = max(1, min(request.args.get('limit', SUGGEST_LIMIT, type=int), 50))
+    version = INDEX.current()
+    t0 = time.perf_counter()
+    results = version.suggest_index.search(query, limit) if query else []
+    took_ms = (time.perf_counter() - t0) * 1000
+    return jsonify({'query': query, 'results': results, 'took_ms': round(took_ms, 3),
+                    'index_version': version.version})
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    return jsonify({'llm': ROUTER.stats(), 'admission': ADMISSION.stats(), 'coalescing': single_flight.stats(),
+                    'live': dict(live_sessions.stats(), streams=live_flights.stats()), 'tracing': TRACER.stats(),
+                    'index': INDEX.stats(), 'semantic_cache': semantic_cache.stats(), 'models': REGISTRY.stats(),
+                    'output': OUTPUT_STATS.stats(), 'process': process_memory()})
+
+def enforce_candidates(obj, entries):
+    """Flag suggestions whose code is not among the retrieved candidates."""
+    allowed = {e.code for e in entries}
+    for item in obj.get("top_k", []):
+        if item.get("code") not in allowed:
+            item["needs_review"] = True
+            item["notes"] = (obj.get("notes") or "") + " | Kode ikke i kandidatliste fra RAG."
+    return obj
+
+def output_mode_from_request(data):
+    mode = (data.get('output_mode') or OUTPUT_MODE).lower()
+    return mode if mode in ('full', 'compact') else OUTPUT_MODE
+
+def model_set_from_request(data):
+    """Model set for this request (X-Model-Set / model_set, else weighted); None if unknown."""
+    return REGISTRY.route(request.headers.get('X-Model-Set') or data.get('model_set'))
+
+def analysis_events(note_text, deadline, output_mode=OUTPUT_MODE, cancel=None, trace=NULL_TRACE,
+                    model_set=PRIMARY, prompt_layout=PROMPT_LAYOUT):
+    """Run retrieve -> build_messages -> LLM stream -> parse within `deadline`.
+
+    Yields ('queued', {'position': n}) while waiting for an LLM slot, ('stream', chunk) for every
+    LLM chunk and finally ('final', result). If the deadline
+    comes close or the LLM fails, the stream is stopped and the final result is degraded to
+    the suggestions parsed so far or to the retrieval candidates (see deadline.degraded_result).
+    Raises DeadlineExceeded only if the deadline passes before retrieval is done.
+
+    With output_mode 'compact' the LLM only returns codes, confidences and evidence; titles,
+    components and chapters are filled in from code_index before the result is returned.
+    Cancelling `cancel` (cancellation.CancelToken) stops the analysis, closes the provider
+    stream and raises Cancelled. Every stage is recorded as a span on `trace` (tracing.py).
+
+    The whole analysis runs on the embedding model and index version of `model_set`
+    (model_registry.py) that are active when it starts; a hot reload in the meantime only affects
+    later requests. The final result carries `model_set` and `index_version`. `alternatives` come
+    from the index version's neighbor graph (neighbors.py), so the LLM is not asked for them.
+    Evidence spans are located in the note locally (evidence.py): offsets and section are filled
+    in, and a suggestion quoting text that is not in the note is marked needs_review.
+    `prompt_layout` (prompt_layout.py) orders the prompt for provider prefix caching; with
+    'codebook' every code is offered and the retrieved candidates only feed the fallbacks.
+    A semantic-cache hit (semantic_cache.py) returns an earlier result right after retrieval,
+    marked `source: "semantic-cache"`.
+    """
+    mset, version = REGISTRY.acquire(model_set)
+    trace.set(model_set=mset.name, index_version=version.version)
+    try:
+        for kind, payload in _analysis_events(note_text, deadline, mset, version, output_mode, cancel, trace,
+                                              prompt_layout if prompt_layout in LAYOUTS else PROMPT_LAYOUT):
+            if kind == 'final':
+                payload['model_set'] = mset.name
+                payload['index_version'] = version.version
+                if version.neighbors is not None:
+                    version.neighbors.fill_alternatives(payload)  # from the code graph, not the LLM
+                with trace.span("evidence") as span:
+                    NoteEvidence(note_text).verify(payload)
+                    span.set(**payload['evidence_check'])
+            yield kind, payload
+    finally:
+        REGISTRY.release(mset, version)
+
+def shadow_retrieve(note_text, model, version):
+    """Retrieval only, for shadow evaluation of another model set (ranked codes)."""
+    return [e.code for e in retrieve(note_text, model, version.index, version.meta, TOPN_RETRIEVE,
+                                     neighbors=version.neighbors)]
+
+def _analysis_events(note_text, deadline, mset, version, output_mode, cancel, trace, prompt_layout):
+    if cancel is not None:
+        cancel.check()
+    deadline.check("kandidatsøk")
+    timings, note_vectors = {}, []
+    t0 = time.perf_counter()
+    with trace.span("retrieve", topn=TOPN_RETRIEVE) as span:
+        entries = retrieve(note_text, mset.model, version.index, version.meta, TOPN_RETRIEVE, timings, note_vectors,
+                           version.neighbors)
+    trace.add_timings(timings, parent=span)
+    codes = [e.code for e in entries]
+    REGISTRY.submit_shadow(mset.name, note_text, codes, (time.perf_counter() - t0) * 1000, shadow_retrieve)
+    # A near-identical earlier note with (nearly) the same candidates: reuse its result, skip the LLM
+    cache_scope = (output_mode, prompt_layout, mset.name, version.version)
+    with trace.span("semantic_cache") as span:
+        cached = semantic_cache.lookup(note_vectors[0], codes, cache_scope)
+        span.set(hit=cached is not None)
+    if cached is not None:
+        trace.set(source='semantic-cache')
+        yield 'final', cached
+        return
+    deadline.check("promptbygging")
+    compact = output_mode == 'compact'
+    max_tokens = COMPACT_MAX_TOKENS if compact else MAX_TOKENS
+    # Fit note + candidates into PROMPT_TOKEN_BUDGET; the lowest-ranked candidates go first
+    timings = {}
+    with trace.span("build_prompt", layout=prompt_layout) as span:
+        template = prompt_template(version, prompt_layout, compact)
+        if prompt_layout == 'codebook':
+            # The whole code list is in the static prefix; no per-request candidates
+            messages, _, prompt_report = version.prompt_builder.build(note_text, [], template, timings)
+            prompt_entries = version.meta
+        else:
+            messages, prompt_entries, prompt_report = version.prompt_builder.build(note_text, entries, template, timings)
+        prompt_report["layout"] = prompt_layout
+        span.set(prompt_tokens=prompt_report["prompt_tokens"], candidates=prompt_report["candidates_used"],
+                 static_prefix_tokens=prompt_report["static_prefix_tokens"])
+    trace.add_timings(timings, parent=span)
+
+    if not deadline.allows_llm():
+        trace.set(degraded=True, degraded_reason="deadline")
+        yield 'final', dict(degraded_result("", entries, "deadline"), prompt=prompt_report)
+        return
+
+    # Wait for an LLM slot (raises QueueFull if the wait queue is full)
+    ticket = ADMISSION.enqueue(estimate_tokens(messages, max_tokens))
+    try:
+        with trace.span("admission_queue") as span:
+            last_position = max_position = None
+            while ticket.admitted_at is None:
+                if cancel is not None:
+                    cancel.check()
+                position = ADMISSION.position(ticket)
+                if position and position != last_position:
+                    yield 'queued', {'position': position}
+                    last_position = position
+                    max_position = max(position, max_position or 0)
+                    span.set(max_position=max_position)
+                if not deadline.allows_llm():
+                    trace.set(degraded=True, degraded_reason="deadline")
+                    yield 'final', dict(degraded_result("", entries, "deadline"), prompt=prompt_report)
+                    return
+                ADMISSION.wait(ticket, QUEUE_POLL_INTERVAL)
+
+        full_response = ""
+        llm_report = {}
+        try:
+            with trace.span("call_mistral_stream", max_tokens=max_tokens) as span:
+                t0 = time.perf_counter()
+                chunks = 0
+                try:
+                    for chunk in call_mistral_stream(messages, temperature=TEMPERATURE, max_tokens=max_tokens,
+                                                     deadline=deadline, cancel=cancel, report=llm_report,
+                                                     schema=response_schema(compact)):
+                        if not chunks:
+                            span.set(ttft_ms=round((time.perf_counter() - t0) * 1000, 3))
+                        chunks += 1
+                        full_response += chunk
+                        yield 'stream', chunk
+                finally:
+                    span.set(chunks=chunks, chars=len(full_response), **{
+                        k: llm_report.get(k) for k in ("provider", "model", "prompt_tokens", "cached_prompt_tokens",
+                                                       "completion_tokens", "tokens_per_s", "finish_reason")})
+            # Fences, prose, trailing commas and truncation are repaired; top_k is validated
+            with trace.span("parse_output") as span:
+                try:
+                    obj, output_report = parse_output(full_response, compact)
+                except OutputError as e:
+                    obj, output_report = None, e.report
+                span.set(ok=obj is not None, repairs=output_report["repairs"],
+                         problems=len(output_report["problems"]))
+            if (obj is None and OUTPUT_CONTINUATION and llm_report.get("finish_reason") == "length"
+                    and deadline.allows_llm()):
+                obj, repaired, full_response = yield from continue_output(messages, full_response, compact,
+                                                                          deadline, cancel, trace)
+                output_report = dict(repaired or output_report, continuation=True)
+            OUTPUT_STATS.record(output_report, ok=obj is not None)
+            if obj is None:
+                raise ValueError("Model did not return usable JSON.")
+            if compact:
+                obj = hydrate(obj, version.code_index)
+            obj = enforce_candidates(obj, prompt_entries)
+            obj["output"] = output_report
+        except Cancelled:
+            raise
+        except TimeoutError:
+            obj = degraded_result(full_response, entries, "deadline")
+        except Exception as e:
+            print(f"⚠️ LLM-steget feilet, faller tilbake til søkeresultater: {e}")
+            obj = degraded_result(full_response, entries, "llm_error")
+    finally:
+        ADMISSION.release(ticket)
+    if compact and obj.get("degraded"):
+        obj = hydrate(obj, version.code_index)  # partial compact suggestions get titles too
+    obj["prompt"] = prompt_report
+    if llm_report:
+        obj["llm"] = llm_report
+    if obj.get("degraded"):
+        trace.set(degraded=True, degraded_reason=obj.get("degraded_reason"))
+    else:
+        semantic_cache.store(note_vectors[0], codes, obj, cache_scope)
+    yield 'final', obj
+
+def continue_output(messages, partial, compact, deadline, cancel, trace):
+    """Last resort for output cut at max_tokens before its first complete suggestion: one more call
+    asking the model to finish the JSON, streamed on as 'stream' events. Returns (object, parse
+    report, text); object and report are None if the result is still unusable."""
+    continuation, call = "", {}
+    with trace.span("continuation", max_tokens=CONTINUATION_MAX_TOKENS) as span:
+        try:
+            for chunk in call_mistral_stream(continuation_messages(messages, partial), temperature=TEMPERATURE,
+                                             max_tokens=CONTINUATION_MAX_TOKENS, deadline=deadline, cancel=cancel,
+                                             report=call):
+                continuation += chunk
+                yield 'stream', chunk
+        finally:
+            span.set(chars=len(continuation), finish_reason=call.get("finish_reason"))
+    for text in join_continuation(partial, continuation):
+        try:
+            obj, report = parse_output(text, compact)
+            return obj, report, text
+        except OutputError:
+            continue
+    return None, None, partial + continuation
+
+def analysis_key(note_text, output_mode=OUTPUT_MODE, model_set=PRIMARY):
+    mset = REGISTRY.sets[model_set]
+    version = mset.store.current().version if mset.loaded else None
+    return coalesce_key(note_text, mset.model_id, version, TOPN_RETRIEVE, TEMPERATURE, MAX_TOKENS, output_mode)
+
+def queue_full_response(retry_after):
+    resp = jsonify({'error': QueueFull(retry_after).args[0], 'retry_after': retry_after})
+    resp.status_code = 429
+    resp.headers['Retry-After'] = str(retry_after)
+    return resp
+
+def admission_precheck(note_text, output_mode=OUTPUT_MODE, model_set=PRIMARY):
+    """Fast 429 when the LLM wait queue is full, unless the request can join a running analysis."""
+    if ADMISSION.saturated() and not single_flight.has(analysis_key(note_text, output_mode, model_set)):
+        return queue_full_response(ADMISSION.reject())
+    return None
+
+def start_trace(name):
+    """Trace for the current request (X-Request-Id is honoured); profiled on demand, see tracing.py."""
+    request_id = request.headers.get('X-Request-Id', '')
+    if not re.fullmatch(r'[A-Za-z0-9_-]{1,64}', request_id):
+        request_id = uuid.uuid4().hex  # also used in profile file names
+    return request_id, TRACER.start(name, request_id, profile=TRACER.wants_profile(request.headers))
+
+def shared_analysis(note_text, deadline, output_mode=OUTPUT_MODE, request_id=None, trace=NULL_TRACE,
+                    model_set=PRIMARY):
+    """analysis_events, coalesced: identical concurrent requests share one pipeline run.
+    Late joiners get a replay of the chunks produced so far. The first request's deadline applies,
+    and the stage spans go to its trace; a joiner's trace records which request it joined.
+    Returns the Flight; subscribe to it and call single_flight.leave when done reading."""
+    key = analysis_key(note_text, output_mode, model_set)
+    flight = single_flight.join(key, lambda cancel: analysis_events(note_text, deadline, output_mode, cancel=cancel,
+                                                                    trace=trace, model_set=model_set),
+                                tag=request_id)
+    if flight.tag != request_id:
+        trace.set(coalesced_into=flight.tag)
+    return flight
+
+def stream_flight(flights, flight, on_cancelled=None, trace=NULL_TRACE):
+    """SSE lines for one flight, and a close callback for Response.call_on_close. Keep-alives
+    are written while the pipeline is silent, so a closed tab surfaces as GeneratorExit within
+    about SSE_HEARTBEAT seconds; the subscriber then leaves as disconnected, which cancels the
+    flight (and its provider stream) if nobody else is reading it. The close callback covers a
+    response that is closed before the generator ever ran (its finally never does then); the
+    subscriber leaves only once, whichever of the two comes first."""
+    left = []
+
+    def leave(disconnected, outcome):
+        if not left:
+            left.append(True)
+            flights.leave(flight, disconnected=disconnected)
+            trace.finish(outcome='disconnected' if disconnected else outcome)
+
+    def generate():
+        disconnected = True
+        outcome = 'ok'
+        try:
+            try:
+                for kind, payload in flight.subscribe(heartbeat=SSE_HEARTBEAT):
+                    yield sse_event(kind, payload)
+            except Cancelled as e:
+                disconnected, outcome = False, 'cancelled'
+                if on_cancelled is not None:
+                    yield on_cancelled(e)
+            except QueueFull as e:
+                disconnected, outcome = False, 'queue_full'
+                yield f"data: {json.dumps({'error': str(e), 'retry_after': e.retry_after, 'type': 'error'})}\n\n"
+            except Exception as e:
+                disconnected, outcome = False, 'error'
+                yield f"data: {json.dumps({'error': str(e), 'type': 'error'})}\n\n"
+            else:
+                disconnected = False
+        finally:
+            leave(disconnected, outcome)
+
+    return generate(), lambda: leave(True, 'disconnected')
+
+def sse_event(kind, payload):
+    """One analysis event as an SSE line for the streaming endpoints."""
+    if kind == 'heartbeat':
+        return ": keepalive\n\n"
+    if kind == 'stream':
+        body = {'chunk': payload, 'type': 'stream'}
+    elif kind == 'queued':
+        body = {'position': payload['position'], 'type': 'queued'}
+    else:
+        body = {'result': payload, 'type': 'final'}
+    return f"data: {json.dumps(body)}\n\n"
+
 @app.route('/analyze', methods=['POST'])
 def analyze():
     data = request.get_json()
@@ -125,33 +522,39 @@ def analyze():
     if not note_text:
         return jsonify({'error': 'Ingen tekst funnet'}), 400
     
+    output_mode = output_mode_from_request(data)
+    model_set = model_set_from_request(data)
+    if model_set is None:
+        return jsonify({'error': 'Ukjent modellsett'}), 400
+    rejected = admission_precheck(note_text, output_mode, model_set)
+    if rejected is not None:
+        return rejected
+
+    deadline = Deadline.from_request(data, request.headers)
+    request_id, trace = start_trace('analyze')
+    flight = shared_analysis(note_text, deadline, output_mode, request_id, trace, model_set)
+    outcome = 'error'
     try:
-        # Retrieve candidates
-        entries = retrieve(note_text, emb, faiss_index, meta, TOPN_RETRIEVE)
-        
-        # Build messages
-        grounding = format_grounding(entries)
-        messages = build_messages(note_text, grounding)
-        
-        # Call LLM with streaming
-        full_response = ""
-        for chunk in call_mistral_stream(messages, temperature=TEMPERATURE, max_tokens=MAX_TOKENS):
-            full_response += chunk
-        
-        # Parse JSON
-        obj = parse_json_or_raise(full_response)
-        
-        # Enforce that codes are within retrieved candidates
-        allowed = {e.code for e in entries}
-        for item in obj.get("top_k", []):
-            if item.get("code") not in allowed:
-                item["needs_review"] = True
-                item["notes"] = (obj.get("notes") or "") + " | Kode ikke i kandidatliste fra RAG."
-        
-        return jsonify(obj)
+        obj = None
+        for kind, payload in flight.subscribe():
+            if kind == 'final':
+                obj = payload
+        outcome = 'ok'
+        resp = jsonify(obj)
+        resp.headers['X-Request-Id'] = request_id
+        return resp
         
+    except QueueFull as e:
+        outcome = 'queue_full'
+        return queue_full_response(e.retry_after)
+    except DeadlineExceeded as e:
+        outcome = 'deadline'
+        return jsonify({'error': str(e)}), 504
     except Exception as e:
         return jsonify({'error': str(e)}), 500
+    finally:
+        single_flight.leave(flight)
+        trace.finish(outcome=outcome)
 
 @app.route('/stream-analyze', methods=['POST'])
 def stream_analyze():
@@ -161,37 +564,182 @@ def stream_analyze():
     if not note_text:
         return jsonify({'error': 'Ingen tekst funnet'}), 400
     
+    output_mode = output_mode_from_request(data)
+    model_set = model_set_from_request(data)
+    if model_set is None:
+        return jsonify({'error': 'Ukjent modellsett'}), 400
+    rejected = admission_precheck(note_text, output_mode, model_set)
+    if rejected is not None:
+        return rejected
+
+    deadline = Deadline.from_request(data, request.headers)
+    request_id, trace = start_trace('stream-analyze')
+    flight = shared_analysis(note_text, deadline, output_mode, request_id, trace, model_set)
+    stream, close = stream_flight(single_flight, flight, trace=trace)
+    resp = Response(stream, mimetype='text/plain', headers={'X-Request-Id': request_id})
+    resp.call_on_close(close)
+    return resp
+
+@app.route('/live/retrieve', methods=['POST'])
+def live_retrieve():
+    """Live mode, every (debounced) change: retrieval only, no LLM. Also cancels a running
+    analysis of an older revision of the same session."""
+    data = request.get_json() or {}
+    session_id = str(data.get('session_id') or '')
+    if not session_id:
+        return jsonify({'error': 'session_id mangler'}), 400
+    revision = int(data.get('revision', 0))
+    note_text = data.get('note_text', '').strip()
+
+    session = live_sessions.get(session_id)
+    if not live_sessions.advance(session, revision):
+        return jsonify({'revision': revision, 'stale': True}), 409
+    version = INDEX.acquire()
+    try:
+        t0 = time.perf_counter()
+        hits, info = live_sessions.retrieve(session, note_text, emb, version.index, LIVE_TOPN) if note_text else ([], {})
+        meta = version.meta
+        candidates = [{'code': meta[i].code, 'title': meta[i].title, 'component': meta[i].component_guess,
+                       'chapter': meta[i].chapter, 'score': round(score, 4)} for i, score in hits]
+        took_ms = (time.perf_counter() - t0) * 1000
+    finally:
+        INDEX.release(version)
+    return jsonify({'revision': revision, 'candidates': candidates, 'took_ms': round(took_ms, 3),
+                    'index_version': version.version, **info})
+
+@app.route('/live/analyze', methods=['POST'])
+def live_analyze():
+    """Live mode, once the text has settled: the normal streaming analysis, but tied to the
+    session revision. A newer revision cancels it and closes the provider stream; the client
+    then gets a 'cancelled' event. Not coalesced, so cancelling only ever affects this session."""
+    data = request.get_json() or {}
+    session_id = str(data.get('session_id') or '')
+    note_text = data.get('note_text', '').strip()
+    if not session_id or not note_text:
+        return jsonify({'error': 'session_id og note_text er påkrevd'}), 400
+    revision = int(data.get('revision', 0))
+    output_mode = output_mode_from_request(data)
+    if ADMISSION.saturated():
+        return queue_full_response(ADMISSION.reject())
+
+    session = live_sessions.get(session_id)
+    token = live_sessions.start_analysis(session, revision)
+    if token is None:
+        return jsonify({'revision': revision, 'stale': True}), 409
+    deadline = Deadline.from_request(data, request.headers)
+    request_id, trace = start_trace('live-analyze')
+    trace.set(session_id=session_id, revision=revision)
+    flight = live_flights.join(session_id, lambda cancel: analysis_events(note_text, deadline, output_mode, cancel=cancel,
+                                                                          trace=trace),
+                               cancel=token, tag=request_id)
+
+    stream, close = stream_flight(live_flights, flight, trace=trace, on_cancelled=lambda e: (
+        f"data: {json.dumps({'type': 'cancelled', 'reason': str(e), 'revision': revision})}\n\n"))
+
     def generate():
         try:
-            # Retrieve candidates
-            entries = retrieve(note_text, emb, faiss_index, meta, TOPN_RETRIEVE)
-            
-            # Build messages
-            grounding = format_grounding(entries)
-            messages = build_messages(note_text, grounding)
-            
-            # Stream LLM response
-            full_response = ""
-            for chunk in call_mistral_stream(messages, temperature=TEMPERATURE, max_tokens=MAX_TOKENS):
-                full_response += chunk
-                yield f"data: {json.dumps({'chunk': chunk, 'type': 'stream'})}\n\n"
-            
-            # Parse and return final result
-            obj = parse_json_or_raise(full_response)
-            
-            # Enforce that codes are within retrieved candidates
-            allowed = {e.code for e in entries}
-            for item in obj.get("top_k", []):
-                if item.get("code") not in allowed:
-                    item["needs_review"] = True
-                    item["notes"] = (obj.get("notes") or "") + " | Kode ikke i kandidatliste fra RAG."
-            
-            yield f"data: {json.dumps({'result': obj, 'type': 'final'})}\n\n"
-            
-        except Exception as e:
-            yield f"data: {json.dumps({'error': str(e), 'type': 'error'})}\n\n"
-    
-    return Response(generate(), mimetype='text/plain')
+            yield from stream
+        finally:
+            live_sessions.finish_analysis(session, token)
+
+    def on_close():
+        close()
+        live_sessions.finish_analysis(session, token)
+
+    resp = Response(generate(), mimetype='text/plain', headers={'X-Request-Id': request_id})
+    resp.call_on_close(on_close)
+    return resp
+
+def process_job_note(note_text):
+    """Background-job version of the pipeline: same stages, a longer deadline, and requeue on 429."""
+    trace = TRACER.start('job')
+    outcome = 'error'
+    try:
+        for kind, payload in analysis_events(note_text, Deadline(JOB_NOTE_DEADLINE), trace=trace):
+            if kind == 'final':
+                outcome = 'ok'
+                return payload
+    except QueueFull:
+        outcome = 'queue_full'
+        raise RetryLater()
+    finally:
+        trace.finish(outcome=outcome)
+
+job_store = JobStore(JOBS_DB_PATH)
+job_runner = JobRunner(job_store, process_job_note)
+
+def start_background():
+    """Background threads (index watcher, job workers). Threads do not survive fork, so under
+    serve.py every worker starts its own after forking instead of the master at import."""
+    INDEX.watch(INDEX_WATCH_INTERVAL)
+    job_runner.start()
+
+if not DEFER_BACKGROUND:
+    start_background()
+
+@app.route('/profiles/<request_id>', methods=['GET'])
+def get_profile(request_id):
+    """Folded stacks of a profiled request (flamegraph.pl / speedscope). Needs PROFILE_TOKEN."""
+    if not PROFILE_TOKEN or request.headers.get('X-Profile') != PROFILE_TOKEN:
+        return jsonify({'error': 'Ikke tilgang'}), 403
+    if not re.fullmatch(r'[A-Za-z0-9_-]+', request_id):
+        return jsonify({'error': 'Ugyldig id'}), 400
+    if not os.path.exists(os.path.join(PROFILE_DIR, f'{request_id}.folded')):
+        return jsonify({'error': 'Profil ikke funnet'}), 404
+    return send_from_directory(os.path.abspath(PROFILE_DIR), f'{request_id}.folded', mimetype='text/plain')
+
+@app.route('/admin/reload-index', methods=['POST'])
+def reload_index():
+    """Load the index/metadata files again in the background and swap them in once validated.
+    In-flight requests finish on the old version. `?wait=1` blocks and returns the outcome."""
+    if not ADMIN_TOKEN or request.headers.get('X-Admin-Token') != ADMIN_TOKEN:
+        return jsonify({'error': 'Ikke tilgang'}), 403
+    if request.args.get('wait') == '1':
+        result = INDEX.reload()
+        return jsonify(result), 409 if result['status'] in ('busy', 'failed') else 200
+    if not INDEX.reload_async():
+        return jsonify({'status': 'busy'}), 409
+    return jsonify({'status': 'reloading', 'version': INDEX.current().version,
+                    'status_url': url_for('stats')}), 202
+
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    data = request.get_json() or {}
+    raw_notes = data.get('notes') or []
+    if not isinstance(raw_notes, list) or not raw_notes:
+        return jsonify({'error': 'Ingen notater funnet'}), 400
+    if len(raw_notes) > JOB_MAX_NOTES:
+        return jsonify({'error': f'For mange notater (maks {JOB_MAX_NOTES} per jobb)'}), 413
+
+    notes = []
+    for i, n in enumerate(raw_notes):
+        if isinstance(n, str):
+            n = {'note_text': n}
+        note_text = (n.get('note_text') or '').strip() if isinstance(n, dict) else ''
+        if not note_text:
+            return jsonify({'error': f'Notat {i} mangler tekst'}), 400
+        note_id = n.get('id')
+        if note_id is not None and (isinstance(note_id, bool) or not isinstance(note_id, (str, int))):
+            return jsonify({'error': f'Notat {i}: id må være tekst eller heltall'}), 400
+        notes.append({'id': note_id, 'note_text': note_text})
+
+    job_id = job_store.create_job(notes)
+    job_runner.notify()
+    return jsonify({
+        'job_id': job_id,
+        'status': 'queued',
+        'total': len(notes),
+        'status_url': url_for('get_job', job_id=job_id),
+    }), 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    include_results = request.args.get('results', '1') != '0'
+    job = job_store.get(job_id, include_results=include_results)
+    if job is None:
+        return jsonify({'error': 'Jobb ikke funnet'}), 404
+    return jsonify(job)
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    # Development server; production runs serve.py (preloaded model shared by forked workers)
+    app.run(debug=os.environ.get("FLASK_DEBUG", "0") == "1", host='0.0.0.0', port=int(os.environ.get("PORT", "5000")))
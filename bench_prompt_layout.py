@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# bench_prompt_layout.py
+# Prompt layouts side by side (rag / cached / codebook): time-to-first-token, prompt tokens billed
+# and accuracy on a labelled set, through the app's own analysis pipeline and LLM instrumentation
+
+import os
+import sys
+import json
+import argparse
+from typing import Any, Dict, List, Optional
+
+
+def _pct(values: List[float], q: float) -> Optional[float]:
+    values = sorted(v for v in values if v is not None)
+    return round(values[min(len(values) - 1, int(q * len(values)))], 4) if values else None
+
+
+def _mean(values) -> float:
+    values = list(values)
+    return round(sum(values) / len(values), 4) if values else 0.0
+
+
+def summarize(rows: List[Dict[str, Any]], cached_price: float) -> Dict[str, Any]:
+    return {
+        "notes": len(rows),
+        "ttft_s": {"p50": _pct([r["ttft_s"] for r in rows], 0.5), "p95": _pct([r["ttft_s"] for r in rows], 0.95)},
+        "prompt_tokens": _mean(r["prompt_tokens"] for r in rows),
+        "cached_prompt_tokens": _mean(r["cached_prompt_tokens"] for r in rows),
+        # Uncached tokens at full price, cached ones at `cached_price` (OpenAI: 0.5, some providers less)
+        "billed_prompt_tokens": _mean(r["prompt_tokens"] - r["cached_prompt_tokens"] * (1 - cached_price) for r in rows),
+        "static_prefix_tokens": rows[0]["static_prefix_tokens"] if rows else None,
+        "top1": _mean(r["top1"] for r in rows),
+        "top3": _mean(r["top3"] for r in rows),
+        "reachable": _mean(r["reachable"] for r in rows),
+        "degraded": sum(r["degraded"] for r in rows),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sammenlign prompt-layouter (TTFT, fakturerte prompt-tokens, treffsikkerhet).")
+    parser.add_argument("gold", help="JSONL med note_text + codes, eller CSV med kolonnene note_text, codes")
+    parser.add_argument("--layouts", default="rag,cached,cached-sorted,codebook",
+                        help="Kommaseparert: rag, cached, cached-sorted, codebook")
+    parser.add_argument("--output-mode", default="full", choices=["full", "compact"])
+    parser.add_argument("--provider", default="mock", choices=["mock", "env"],
+                        help="mock: lokal mock_llm.py med simulert prefiks-cache; env: leverandørene i .env")
+    parser.add_argument("--rounds", type=int, default=2, help="Runder over settet per layout; runde 1 varmer cachen")
+    parser.add_argument("--cached-price", type=float, default=0.5, help="Pris for cachede prompt-tokens (andel av full pris)")
+    parser.add_argument("--limit", type=int, help="Bare de første N notatene")
+    parser.add_argument("--report", help="Skriv full rapport som JSON hit")
+    args = parser.parse_args()
+
+    if args.provider == "mock":
+        from mock_llm import MockLLM
+        mock = MockLLM()
+        mock.serve(background=True)
+        os.environ.update({"MISTRAL_API_KEY": "", "OPENAI_API_KEY": "mock", "OPENAI_MODEL": "mock",
+                           "OPENAI_BASE": f"http://127.0.0.1:{mock.port}/v1", "LLM_HEDGE_DELAY": "0"})
+    # Every note must reach the LLM, and no background threads are needed
+    os.environ.update({"SEMANTIC_CACHE": "0", "DEFER_BACKGROUND": "1"})
+
+    import app
+    from deadline import Deadline
+    from eval_retrieval import load_gold
+
+    data = load_gold(args.gold)[:args.limit]
+    layouts = [l for l in args.layouts.split(",") if l]
+    print(f"📏 {len(data)} merkede notater, layouter: {', '.join(layouts)} ({args.provider})", file=sys.stderr)
+
+    version = app.INDEX.current()
+    ranked = {note: [e.code for e in app.retrieve(note, app.emb, version.index, version.meta, app.TOPN_RETRIEVE,
+                                                  neighbors=version.neighbors)] for note, _ in data}
+    all_codes = set(version.code_index)
+
+    results = {}
+    for layout in layouts:
+        rows = []
+        for rnd in range(args.rounds):
+            for note, gold in data:
+                final = {}
+                for kind, payload in app.analysis_events(note, Deadline(120), args.output_mode, prompt_layout=layout):
+                    if kind == 'final':
+                        final = payload
+                llm, prompt = final.get("llm") or {}, final.get("prompt") or {}
+                codes = [i.get("code") for i in final.get("top_k", [])]
+                offered = all_codes if layout == "codebook" else set(ranked[note][:prompt.get("candidates_used", 0)])
+                rows.append({
+                    "round": rnd,
+                    "ttft_s": llm.get("ttft_s"),
+                    "prompt_tokens": llm.get("prompt_tokens") or prompt.get("prompt_tokens") or 0,
+                    "cached_prompt_tokens": llm.get("cached_prompt_tokens") or 0,
+                    "static_prefix_tokens": prompt.get("static_prefix_tokens"),
+                    "top1": bool(codes) and codes[0] in gold,
+                    "top3": any(c in gold for c in codes[:3]),
+                    "reachable": any(c in offered for c in gold),
+                    "degraded": bool(final.get("degraded")),
+                })
+        warm = [r for r in rows if r["round"] > 0] or rows
+        results[layout] = {"cold": summarize([r for r in rows if r["round"] == 0], args.cached_price),
+                           "warm": summarize(warm, args.cached_price)}
+
+    print(f"\n{'layout':13} {'runde':5} {'ttft p50':>9} {'ttft p95':>9} {'prompt':>7} {'cachet':>7} {'fakt.':>7} "
+          f"{'prefiks':>7} {'top1':>6} {'top3':>6} {'nåbar':>6}")
+    print("-" * 96)
+    for layout, by_round in results.items():
+        for name, s in by_round.items():
+            print(f"{layout:13} {name:5} {s['ttft_s']['p50'] or '-':>9} {s['ttft_s']['p95'] or '-':>9} "
+                  f"{s['prompt_tokens']:>7.0f} {s['cached_prompt_tokens']:>7.0f} {s['billed_prompt_tokens']:>7.0f} "
+                  f"{s['static_prefix_tokens'] or 0:>7} {s['top1']:>6.3f} {s['top3']:>6.3f} {s['reachable']:>6.3f}")
+    if args.provider == "mock":
+        print("\nℹ️  Mock-leverandøren svarer leksikalt: top1/top3 viser bare at riktig kode nådde prompten. "
+              "Kjør med --provider env for reell treffsikkerhet.")
+
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump({"provider": args.provider, "output_mode": args.output_mode, "rounds": args.rounds,
+                       "cached_price": args.cached_price, "results": results, "llm": app.ROUTER.stats()},
+                      f, ensure_ascii=False, indent=2)
+        print(f"📝 Rapport skrevet til {args.report}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,15 @@
 # build_index.py
 # Build a FAISS index from the ICPC-2 CSV
 
-import os, json
+import os, json, time
 from dotenv import load_dotenv
 import numpy as np
 import faiss
 from sentence_transformers import SentenceTransformer
-from icpc_utils import load_icpc_csv, to_entries, build_doc_text, save_meta
+from icpc_utils import build_doc_text, save_meta
+from icpc_csv import load_icpc_csv, to_entries
+from bundle import BUNDLE_DIR, BUNDLE_MODEL_DTYPE, write_bundle, sha256_file
+from neighbors import NEIGHBORS_K, build_graph, save_graph
 
 # Load environment variables
 load_dotenv()
@@ -16,6 +19,8 @@ CSV_PATH = os.environ.get("ICPC_CSV_PATH", "mnt/data/ICPC-2.csv")
 EMB_MODEL = os.environ.get("EMB_MODEL", "intfloat/multilingual-e5-base")  # good multilingual baseline
 INDEX_OUT = os.environ.get("INDEX_OUT", "icpc2.faiss")
 META_OUT = os.environ.get("META_OUT", "icpc2_meta.json")
+NEIGHBORS_OUT = os.environ.get("NEIGHBORS_OUT", "icpc2_neighbors.npz")  # code-to-code graph for alternatives
+MANIFEST_OUT = os.environ.get("MANIFEST_OUT", "icpc2_manifest.json")  # model/dim/rows, checked by the app on (re)load
 BATCH = int(os.environ.get("BATCH", "256"))
 # --------------------------------
 
@@ -40,11 +45,34 @@ def main():
     index = faiss.IndexFlatIP(d)
     index.add(vecs.astype(np.float32))
 
+    # Write to temp files and rename, so a running app (INDEX_WATCH_INTERVAL) never reads half a file
     print(f"Writing index -> {INDEX_OUT}")
-    faiss.write_index(index, INDEX_OUT)
+    faiss.write_index(index, INDEX_OUT + ".tmp")
+    os.replace(INDEX_OUT + ".tmp", INDEX_OUT)
 
     print(f"Writing metadata -> {META_OUT}")
-    save_meta(entries, META_OUT)
+    save_meta(entries, META_OUT + ".tmp")
+    os.replace(META_OUT + ".tmp", META_OUT)
+
+    print(f"Writing neighbor graph (k={NEIGHBORS_K}) -> {NEIGHBORS_OUT}")
+    neighbors = build_graph(vecs, entries, NEIGHBORS_K)
+    save_graph(NEIGHBORS_OUT + ".tmp", *neighbors, [e.code for e in entries])
+    os.replace(NEIGHBORS_OUT + ".tmp", NEIGHBORS_OUT)
+
+    print(f"Writing manifest -> {MANIFEST_OUT}")
+    with open(MANIFEST_OUT + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"model": EMB_MODEL, "dim": d, "rows": int(index.ntotal),
+                   "built_at": time.strftime("%Y-%m-%dT%H:%M:%S%z")}, f, indent=2)
+    os.replace(MANIFEST_OUT + ".tmp", MANIFEST_OUT)
+
+    if BUNDLE_DIR:
+        # Model weights + index + metadata + manifest: runtimes with BUNDLE_PATH start offline
+        print(f"Writing bundle -> {BUNDLE_DIR}/")
+        settings = {"csv_path": CSV_PATH, "csv_sha256": sha256_file(CSV_PATH), "batch": BATCH,
+                    "doc_prefix": "passage: ", "query_prefix": "query: ", "neighbors_k": NEIGHBORS_K}
+        path = write_bundle(BUNDLE_DIR, model, index, entries, EMB_MODEL, settings, BUNDLE_MODEL_DTYPE,
+                            neighbors=neighbors)
+        print(f"Bundle -> {path} ({BUNDLE_DIR}/current)")
 
     print("Done.")
 
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# bulk_code.py
+# Bulk ICPC-2 coding of many notes (CSV / JSONL / directory of .txt) with checkpoint/resume
+
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Dict, Any, Iterator, List, Tuple
+
+import numpy as np
+import faiss
+from sentence_transformers import SentenceTransformer
+
+from rag_infer import (
+    EMB_MODEL, INDEX_PATH, META_PATH, TOPN_RETRIEVE, TEMPERATURE, MAX_TOKENS,
+    load_meta, embed_queries, format_grounding, build_messages, call_mistral_stream, parse_json_or_raise,
+)
+from compact_output import build_compact_messages, hydrate
+from evidence import NoteEvidence
+from structured_output import response_schema
+
+COMPACT_MAX_TOKENS = int(os.environ.get("COMPACT_MAX_TOKENS", "300"))
+
+Note = Tuple[str, str]  # (note id, note text)
+
+
+# ------------ Input -------------
+def read_notes(path: str, id_col: str, text_col: str) -> Iterator[Note]:
+    """Stream notes from a CSV/TSV file, a JSONL file or a directory of .txt files."""
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            if name.endswith(".txt"):
+                with open(os.path.join(path, name), "r", encoding="utf-8") as f:
+                    yield os.path.splitext(name)[0], f.read().strip()
+    elif path.endswith(".jsonl"):
+        with open(path, "r", encoding="utf-8") as f:
+            for n, line in enumerate(f, 1):
+                if line.strip():
+                    row = json.loads(line)
+                    yield str(row.get(id_col, n)), str(row.get(text_col, "")).strip()
+    else:
+        with open(path, "r", encoding="utf-8-sig", newline="") as f:
+            sample = f.read(2048)
+            f.seek(0)
+            try:
+                dialect = csv.Sniffer().sniff(sample, delimiters=",;\t")
+            except Exception:
+                dialect = csv.excel
+            for n, row in enumerate(csv.DictReader(f, dialect=dialect), 1):
+                yield str(row.get(id_col) or n), (row.get(text_col) or "").strip()
+
+
+def count_notes(path: str) -> int:
+    if os.path.isdir(path):
+        return sum(1 for name in os.listdir(path) if name.endswith(".txt"))
+    with open(path, "rb") as f:
+        lines = sum(1 for line in f if line.strip())
+    # CSV has a header row; multi-line quoted notes make this an estimate, which is fine for an ETA
+    return lines if path.endswith(".jsonl") else max(0, lines - 1)
+
+
+def batched(it: Iterator[Note], size: int) -> Iterator[List[Note]]:
+    batch = []
+    for item in it:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# ------------ Checkpoint -------------
+def load_done(out_path: str, retry_errors: bool) -> set:
+    """Ids already in the append-only output. A torn last line from a crash is dropped."""
+    done = set()
+    if not os.path.exists(out_path):
+        return done
+    good_bytes = 0
+    with open(out_path, "rb") as f:
+        for raw in f:
+            try:
+                row = json.loads(raw)
+            except json.JSONDecodeError:
+                break
+            good_bytes += len(raw)
+            if "result" in row or not retry_errors:
+                done.add(row["id"])
+    if good_bytes < os.path.getsize(out_path):
+        with open(out_path, "r+b") as f:
+            f.truncate(good_bytes)
+    return done
+
+
+class Output:
+    """Append-only JSONL writer; every line is flushed and fsynced so it doubles as the checkpoint."""
+
+    def __init__(self, path: str):
+        self.f = open(path, "a", encoding="utf-8")
+
+    def write(self, row: Dict[str, Any]) -> None:
+        self.f.write(json.dumps(row, ensure_ascii=False) + "\n")
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def close(self) -> None:
+        self.f.close()
+
+
+# ------------ Progress -------------
+class Progress:
+    def __init__(self, total: int, skipped: int):
+        self.total = total
+        self.skipped = skipped
+        self.done = 0
+        self.errors = 0
+        self.start = time.time()
+
+    def update(self, ok: bool) -> None:
+        self.done += 1
+        if not ok:
+            self.errors += 1
+        self.render()
+
+    def render(self, end: str = "") -> None:
+        elapsed = time.time() - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        left = max(0, self.total - self.skipped - self.done)
+        eta = left / rate if rate > 0 else 0
+        eta_str = time.strftime("%H:%M:%S", time.gmtime(eta)) if rate > 0 else "--:--:--"
+        sys.stderr.write(
+            f"\r📊 {self.skipped + self.done}/{self.total} notater | {rate:.2f} notater/s | "
+            f"feil: {self.errors} | ETA {eta_str}   {end}"
+        )
+        sys.stderr.flush()
+
+
+# ------------ Pipeline -------------
+def code_note(note_id: str, note_text: str, entries, retries: int, code_index=None) -> Dict[str, Any]:
+    """LLM + parse for one note whose candidates are already retrieved; retries with backoff.
+    With `code_index` the compact output schema is used and titles/components are filled in locally."""
+    if code_index is not None:
+        messages = build_compact_messages(note_text, format_grounding(entries))
+        max_tokens = COMPACT_MAX_TOKENS
+    else:
+        messages = build_messages(note_text, format_grounding(entries))
+        max_tokens = MAX_TOKENS
+    t0 = time.time()
+    last_error = None
+    for attempt in range(retries + 1):
+        try:
+            compact = code_index is not None
+            out_text = "".join(call_mistral_stream(messages, temperature=TEMPERATURE, max_tokens=max_tokens,
+                                                   schema=response_schema(compact)))
+            obj = parse_json_or_raise(out_text, compact)
+            if code_index is not None:
+                obj = hydrate(obj, code_index)
+            allowed = {e.code for e in entries}
+            for item in obj.get("top_k", []):
+                if item.get("code") not in allowed:
+                    item["needs_review"] = True
+                    item["notes"] = (obj.get("notes") or "") + " | Kode ikke i kandidatliste fra RAG."
+            NoteEvidence(note_text).verify(obj)
+            return {"id": note_id, "result": obj, "elapsed": round(time.time() - t0, 3)}
+        except Exception as e:
+            last_error = e
+            if attempt == retries:
+                break  # no point waiting before reporting the failure
+            # Back off harder on rate limiting (HTTP 429)
+            status = getattr(getattr(e, "response", None), "status_code", None)
+            time.sleep((2 ** attempt) * (5 if status == 429 else 1))
+    return {"id": note_id, "error": str(last_error), "elapsed": round(time.time() - t0, 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk ICPC-2-koding av mange notater med checkpoint/resume.")
+    parser.add_argument("input", help="CSV/TSV-fil, JSONL-fil eller mappe med .txt-filer")
+    parser.add_argument("-o", "--output", required=True, help="JSONL-fil for resultater (append-only, brukes også som checkpoint)")
+    parser.add_argument("--id-col", default="id", help="Kolonne/felt med notat-id (default: id)")
+    parser.add_argument("--text-col", default="note_text", help="Kolonne/felt med notattekst (default: note_text)")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("BULK_WORKERS", "4")), help="Samtidige LLM-kall")
+    parser.add_argument("--batch-size", type=int, default=int(os.environ.get("BULK_BATCH", "64")), help="Notater per embedding/søk-batch")
+    parser.add_argument("--retries", type=int, default=3, help="Nye forsøk per notat ved feil")
+    parser.add_argument("--retry-errors", action="store_true", help="Kjør notater som feilet i en tidligere kjøring på nytt")
+    parser.add_argument("--compact", action="store_true",
+                        help="Kompakt output-skjema: modellen returnerer kun koder/confidence/bevis (færre tokens)")
+    args = parser.parse_args()
+
+    done = load_done(args.output, args.retry_errors)
+    total = count_notes(args.input)
+    print(f"🏥 Bulk ICPC-2-koding: {args.input} -> {args.output}", file=sys.stderr)
+    print(f"♻️  {len(done)} notater allerede ferdige, hoppes over", file=sys.stderr)
+
+    print("🔄 Loading models and data...", file=sys.stderr)
+    index = faiss.read_index(INDEX_PATH)
+    meta = load_meta(META_PATH)
+    emb = SentenceTransformer(EMB_MODEL)
+    code_index = {e.code: e for e in meta} if args.compact else None
+
+    out = Output(args.output)
+    progress = Progress(total, skipped=len(done))
+    pending = set()
+    max_pending = args.workers * 2  # keep the pool busy without reading the whole input ahead
+
+    todo = ((i, t) for i, t in read_notes(args.input, args.id_col, args.text_col) if i not in done)
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        try:
+            for batch in batched(todo, args.batch_size):
+                empty = [(i, t) for i, t in batch if not t]
+                for note_id, _ in empty:
+                    out.write({"id": note_id, "error": "Tomt notat"})
+                    progress.update(False)
+                batch = [(i, t) for i, t in batch if t]
+                if not batch:
+                    continue
+
+                # One embedding call and one FAISS search for the whole batch
+                qvecs = embed_queries([t for _, t in batch], emb).astype(np.float32)
+                _, I = index.search(qvecs, TOPN_RETRIEVE)
+
+                for (note_id, text), row in zip(batch, I):
+                    while len(pending) >= max_pending:
+                        finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        for fut in finished:
+                            pending.discard(fut)
+                            res = fut.result()
+                            out.write(res)
+                            progress.update("result" in res)
+                    entries = [meta[j] for j in row if j >= 0]
+                    pending.add(pool.submit(code_note, note_id, text, entries, args.retries, code_index))
+
+            for fut in pending:
+                res = fut.result()
+                out.write(res)
+                progress.update("result" in res)
+        except KeyboardInterrupt:
+            print("\n⏸️  Avbrutt – ferdige notater er lagret, kjør samme kommando igjen for å fortsette.", file=sys.stderr)
+            pool.shutdown(wait=False, cancel_futures=True)
+        finally:
+            out.close()
+
+    progress.render(end="\n")
+    print(f"✅ Ferdig: {progress.done - progress.errors} kodet, {progress.errors} feil.", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+# bundle.py
+# Versioned, self-contained engine bundle: embedding model weights, FAISS index, compact metadata
+# and a manifest with hashes, so a container starts fully offline from local files
+
+import os
+import json
+import time
+import shutil
+import hashlib
+from typing import Any, Dict, List, Optional
+
+from icpc_utils import ICPCEntry
+
+# ------------ Config -------------
+BUNDLE_DIR = os.environ.get("BUNDLE_DIR", "bundles")  # build_index.py output root; empty = no bundle
+BUNDLE_MODEL_DTYPE = os.environ.get("BUNDLE_MODEL_DTYPE", "float32")  # float32 | float16 (half-size weights)
+BUNDLE_PATH = os.environ.get("BUNDLE_PATH", "")  # runtime: bundle (or `current` link) to load; empty = loose files
+BUNDLE_VERIFY = os.environ.get("BUNDLE_VERIFY", "size")  # size | sha256 | off
+# ---------------------------------
+
+FORMAT = 1
+INDEX_FILE = "index.faiss"
+META_FILE = "meta.json"
+NEIGHBORS_FILE = "neighbors.npz"
+MANIFEST_FILE = "manifest.json"
+MODEL_DIR = "model"
+CURRENT_LINK = "current"
+META_FIELDS = ("code", "title", "component_hint", "component_guess", "chapter")
+
+
+class BundleError(Exception):
+    """The bundle is incomplete, corrupted or not built for this runtime."""
+
+
+def sha256_file(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def save_entries(entries: List[ICPCEntry], path: str) -> None:
+    """Column-oriented metadata without indentation: about a third of the list-of-dicts size."""
+    cols = {k: [getattr(e, k) for e in entries] for k in META_FIELDS}
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(cols, f, ensure_ascii=False, separators=(",", ":"))
+
+
+def load_entries(path: str) -> List[ICPCEntry]:
+    """Metadata in either layout: bundle columns or the list of records from save_meta."""
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        return [ICPCEntry(*row) for row in zip(*(data[k] for k in META_FIELDS))]
+    return [ICPCEntry(**r) for r in data]
+
+
+def _file_table(root: str) -> Dict[str, Dict[str, Any]]:
+    files = {}
+    for dirpath, _, names in os.walk(root):
+        for name in sorted(names):
+            path = os.path.join(dirpath, name)
+            rel = os.path.relpath(path, root).replace(os.sep, "/")
+            if rel != MANIFEST_FILE:
+                files[rel] = {"size": os.path.getsize(path), "sha256": sha256_file(path)}
+    return dict(sorted(files.items()))
+
+
+def write_bundle(out_root: str, model, index, entries: List[ICPCEntry], model_id: str,
+                 settings: Dict[str, Any], model_dtype: str = BUNDLE_MODEL_DTYPE, neighbors=None) -> str:
+    """Write a bundle under `out_root/<version>/` and point `out_root/current` at it.
+    The version is derived from the file hashes, so rebuilding identical inputs is a no-op."""
+    import faiss
+
+    tmp = os.path.join(out_root, f".build-{os.getpid()}")
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    if model_dtype == "float16":
+        model.half()
+    model.save(os.path.join(tmp, MODEL_DIR))
+    faiss.write_index(index, os.path.join(tmp, INDEX_FILE))
+    save_entries(entries, os.path.join(tmp, META_FILE))
+    if neighbors is not None:
+        from neighbors import save_graph
+        save_graph(os.path.join(tmp, NEIGHBORS_FILE), *neighbors, [e.code for e in entries])
+
+    files = _file_table(tmp)
+    digest = hashlib.sha256("".join(f"{k}:{v['sha256']}\n" for k, v in files.items()).encode()).hexdigest()
+    version = f"icpc2-{digest[:12]}"
+    manifest = {
+        "format": FORMAT,
+        "version": version,
+        "built_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "model": model_id,
+        "model_dtype": model_dtype,
+        "dim": int(index.d),
+        "rows": int(index.ntotal),
+        "metric": "inner_product",
+        "normalized": True,
+        "settings": settings,
+        "files": files,
+    }
+    with open(os.path.join(tmp, MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+    final = os.path.join(out_root, version)
+    if os.path.exists(final):
+        shutil.rmtree(tmp)
+    else:
+        os.replace(tmp, final)
+    link_tmp = os.path.join(out_root, f".{CURRENT_LINK}-{os.getpid()}")
+    if os.path.lexists(link_tmp):
+        os.remove(link_tmp)
+    os.symlink(version, link_tmp)
+    os.replace(link_tmp, os.path.join(out_root, CURRENT_LINK))  # atomic switch for watching apps
+    return final
+
+
+def read_manifest(bundle_path: str) -> Dict[str, Any]:
+    path = os.path.join(bundle_path, MANIFEST_FILE)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        raise BundleError(f"Kan ikke lese {path}: {e}")
+    if manifest.get("format") != FORMAT:
+        raise BundleError(f"Ukjent bundle-format {manifest.get('format')} (forventet {FORMAT})")
+    return manifest
+
+
+def verify_bundle(bundle_path: str, manifest: Dict[str, Any], mode: str = BUNDLE_VERIFY) -> None:
+    """`size` only stats the files (cheap, catches truncated copies); `sha256` reads them all."""
+    if mode == "off":
+        return
+    for rel, info in manifest.get("files", {}).items():
+        path = os.path.join(bundle_path, rel)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            raise BundleError(f"Mangler {rel} i bundle {manifest.get('version')}")
+        if size != info["size"]:
+            raise BundleError(f"{rel} har {size} byte, manifestet sier {info['size']}")
+        if mode == "sha256" and sha256_file(path) != info["sha256"]:
+            raise BundleError(f"{rel} har feil sha256")
+
+
+def bundle_files(bundle_path: str) -> Dict[str, str]:
+    return {"index": os.path.join(bundle_path, INDEX_FILE), "meta": os.path.join(bundle_path, META_FILE),
+            "manifest": os.path.join(bundle_path, MANIFEST_FILE), "model": os.path.join(bundle_path, MODEL_DIR),
+            "neighbors": os.path.join(bundle_path, NEIGHBORS_FILE)}
+
+
+def load_model(bundle_path: str, manifest: Optional[Dict[str, Any]] = None):
+    """The bundled SentenceTransformer, loaded from local files only (no hub access)."""
+    from sentence_transformers import SentenceTransformer
+
+    manifest = manifest or read_manifest(bundle_path)
+    model = SentenceTransformer(bundle_files(bundle_path)["model"])
+    if manifest.get("model_dtype") == "float16" and getattr(model, "device", None) is not None \
+            and model.device.type == "cpu":
+        model.float()  # fp16 is a storage format here; CPU inference runs in fp32
+    return model
@@ -0,0 +1,52 @@
+# cancellation.py
+# Cancel tokens: let another thread stop a running analysis and close its provider stream
+
+import threading
+from typing import Callable, List, Optional
+
+
+class Cancelled(Exception):
+    """The analysis was cancelled (superseded by a newer revision, or the client went away)."""
+
+
+class CancelToken:
+    """Set once by whoever owns the request; consumers either poll `cancelled`/`check()` or
+    register a callback that wakes them (the LLM router uses it to interrupt a blocked read)."""
+
+    def __init__(self):
+        self.reason: Optional[str] = None
+        self._callbacks: List[Callable[[], None]] = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.reason is not None
+
+    def cancel(self, reason: str = "cancelled") -> bool:
+        """Cancel and run the callbacks; False if it was already cancelled."""
+        with self._lock:
+            if self.reason is not None:
+                return False
+            self.reason = reason
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn()
+        return True
+
+    def on_cancel(self, fn: Callable[[], None]) -> Callable[[], None]:
+        """Run `fn` on cancel (immediately if already cancelled). Returns an unregister function."""
+        with self._lock:
+            if self.reason is None:
+                self._callbacks.append(fn)
+                return lambda: self._remove(fn)
+        fn()
+        return lambda: None
+
+    def _remove(self, fn: Callable[[], None]) -> None:
+        with self._lock:
+            if fn in self._callbacks:
+                self._callbacks.remove(fn)
+
+    def check(self) -> None:
+        if self.reason is not None:
+            raise Cancelled(self.reason)
@@ -0,0 +1,72 @@
+# compact_output.py
+# Compact LLM output schema: the model returns codes/confidences/evidence only, the server hydrates the rest
+
+from typing import List, Dict, Any
+
+from icpc_utils import ICPCEntry, component_from_code
+
+# Same rules as SYSTEM_PROMPT, but the model does not repeat titles, components or alternatives:
+# they are already in icpc2_meta.json / the neighbor graph and are filled in locally (see hydrate
+# and neighbors.NeighborGraph.fill_alternatives). Sections come from evidence.NoteEvidence.
+SYSTEM_PROMPT_COMPACT = """Du er en medisinsk kodeassistent i allmennpraksis.
+Oppgave: Foreslå ICPC-2-koder for et konsultasjonsnotat.
+
+Regler:
+1) Returner KUN gyldig JSON som matcher skjemaet nedenfor. Ingen fritekst.
+2) Velg koder KUN fra listen i <icpc2_kandidater>.
+3) Maks 3 forslag.
+4) Symptom vs. diagnose: Hvis diagnosen ikke er tydelig etablert, prioriter symptomkode (komponent 1) fremfor sykdomsdiagnose (komponent 7).
+5) Prosesskoder (komponent 2–6) kun ved eksplisitt prosess (screening, henvisning, sykmelding, prøver, behandling, administrativt).
+6) For hver kode: 1–3 korte tekstbevis ordrett fra notatet.
+7) Sett confidence 0.0–1.0 konservativt. Bruk needs_review: true ved lav sikkerhet eller mulig feilkode.
+8) Ingen kjede-resonnering. Ikke avslør interne steg.
+9) Ikke gjenta tittel, komponent eller alternativer – kun feltene i skjemaet.
+
+Output-skjema (JSON):
+{"top_k": [{"code": "ICPC2_CODE", "confidence": 0.0, "evidence": ["ordrett sitat"], "needs_review": false}], "notes": ""}
+"""
+
+
+def build_compact_messages(note_text: str, grounding: str) -> List[Dict[str, str]]:
+    user_content = f"""Du får et konsultasjonsnotat mellom <note>-tagger og en liste av tillatte ICPC-2-koder i <icpc2_kandidater>.
+Returner KUN JSON iht. skjemaet. Ikke skriv noe annet.
+
+<icpc2_kandidater>
+{grounding}
+</icpc2_kandidater>
+
+<note>
+{note_text}
+</note>
+"""
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT_COMPACT},
+        {"role": "user", "content": user_content},
+    ]
+
+
+def hydrate_item(item: Dict[str, Any], code_index: Dict[str, ICPCEntry]) -> Dict[str, Any]:
+    """Expand one compact suggestion to the full response format. Fields already present are kept,
+    so this is safe on items that are already full (e.g. degraded retrieval fallbacks)."""
+    code = item.get("code")
+    entry = code_index.get(code)
+    out = {"code": code}
+    out["title"] = item.get("title") or (entry.title if entry else "")
+    out["component"] = item.get("component") or component_from_code(code or "")[1]
+    out["chapter"] = item.get("chapter") or (entry.chapter if entry else (code or "?")[:1])
+    out["confidence"] = item.get("confidence", 0.0)
+    if "evidence_spans" in item:
+        out["evidence_spans"] = item["evidence_spans"]
+    else:
+        out["evidence_spans"] = [{"text": t} for t in item.get("evidence", []) if isinstance(t, str)]
+    out["alternatives"] = item.get("alternatives", [])
+    out["needs_review"] = bool(item.get("needs_review", False)) or entry is None
+    for key in ("notes",):
+        if key in item:
+            out[key] = item[key]
+    return out
+
+
+def hydrate(obj: Dict[str, Any], code_index: Dict[str, ICPCEntry]) -> Dict[str, Any]:
+    obj["top_k"] = [hydrate_item(i, code_index) for i in obj.get("top_k", []) if isinstance(i, dict)]
+    return obj
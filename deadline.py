@@ -0,0 +1,126 @@
+# deadline.py
+# End-to-end request deadlines and graceful degradation to retrieval results
+
+import os
+import json
+import re
+import time
+from typing import List, Dict, Any, Optional
+
+from icpc_utils import ICPCEntry
+
+# ------------ Config -------------
+REQUEST_DEADLINE = float(os.environ.get("REQUEST_DEADLINE", "45"))  # server-wide default, seconds
+REQUEST_DEADLINE_MAX = float(os.environ.get("REQUEST_DEADLINE_MAX", "120"))  # cap for per-request deadlines
+# Time kept back at the end for parsing and responding; the LLM stream is stopped this early
+DEADLINE_RESERVE = float(os.environ.get("DEADLINE_RESERVE", "1.0"))
+# Don't start the LLM at all with less time than this left; answer from retrieval instead
+DEADLINE_MIN_LLM = float(os.environ.get("DEADLINE_MIN_LLM", "3.0"))
+DEGRADED_TOP_K = 3
+DEGRADED_CANDIDATES = 10
+# ---------------------------------
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class Deadline:
+    """Absolute point in time (time.monotonic) by which a request must be answered."""
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.at = time.monotonic() + seconds
+
+    @classmethod
+    def from_request(cls, data: Optional[Dict[str, Any]], headers=None) -> "Deadline":
+        """Per-request deadline from JSON `deadline_ms` or the `X-Deadline-Ms` header, capped server-side."""
+        raw = (data or {}).get("deadline_ms")
+        if raw is None and headers is not None:
+            raw = headers.get("X-Deadline-Ms")
+        try:
+            seconds = float(raw) / 1000 if raw is not None else REQUEST_DEADLINE
+        except (TypeError, ValueError):
+            seconds = REQUEST_DEADLINE
+        return cls(max(0.0, min(seconds, REQUEST_DEADLINE_MAX)))
+
+    def remaining(self) -> float:
+        return max(0.0, self.at - time.monotonic())
+
+    def expired(self) -> bool:
+        return time.monotonic() >= self.at
+
+    def check(self, stage: str) -> None:
+        if self.expired():
+            raise DeadlineExceeded(f"Tidsfristen ({self.seconds:.1f}s) ble nådd før {stage}.")
+
+    def llm_cutoff(self) -> float:
+        """Monotonic time at which the LLM stream must stop to leave DEADLINE_RESERVE for the rest."""
+        return self.at - DEADLINE_RESERVE
+
+    def allows_llm(self) -> bool:
+        return self.remaining() - DEADLINE_RESERVE >= DEADLINE_MIN_LLM
+
+
+def parse_partial_top_k(text: str) -> List[Dict[str, Any]]:
+    """Return the complete `top_k` items from possibly truncated model output.
+
+    The stream is cut mid-JSON when the deadline hits, but suggestions the model has already
+    closed are valid objects; decode them one by one and stop at the first incomplete one.
+    """
+    m = re.search(r'"top_k"\s*:\s*\[', text)
+    if not m:
+        return []
+    decoder = json.JSONDecoder()
+    items = []
+    pos = m.end()
+    while True:
+        while pos < len(text) and text[pos] in " \t\r\n,":
+            pos += 1
+        if pos >= len(text) or text[pos] != "{":
+            break
+        try:
+            item, pos = decoder.raw_decode(text, pos)
+        except json.JSONDecodeError:
+            break
+        if isinstance(item, dict) and item.get("code"):
+            items.append(item)
+    return items
+
+
+def degraded_result(partial_text: str, entries: List[ICPCEntry], reason: str) -> Dict[str, Any]:
+    """Best answer we can give without a complete LLM response.
+
+    Uses the suggestions already parsed from the partial stream if there are any, otherwise the
+    top retrieval candidates. Everything is flagged `needs_review`, and the response carries
+    `degraded: true` so callers can tell it apart from a normal answer.
+    """
+    allowed = {e.code for e in entries}
+    items = [i for i in parse_partial_top_k(partial_text or "") if i.get("code") in allowed]
+    if items:
+        source = "partial-llm"
+        note = "Svaret fra språkmodellen ble avbrutt; viser forslagene som var ferdige. Må kontrolleres."
+    else:
+        source = "retrieval"
+        note = "Språkmodellen svarte ikke i tide; forslagene er kun basert på søk og må kontrolleres."
+        items = []
+        for e in entries[:DEGRADED_TOP_K]:
+            items.append({
+                "code": e.code,
+                "title": e.title,
+                "component": e.component_guess,
+                "confidence": 0.0,
+                "evidence_spans": [],
+                "alternatives": [],
+                "needs_review": True,
+            })
+    for item in items:
+        item["needs_review"] = True
+    return {
+        "top_k": items,
+        "candidates": [{"code": e.code, "title": e.title} for e in entries[:DEGRADED_CANDIDATES]],
+        "notes": note,
+        "degraded": True,
+        "degraded_reason": reason,
+        "source": source,
+    }
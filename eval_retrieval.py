@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# eval_retrieval.py
+# Retrieval recall evaluation: recall@k, MRR and prompt-token cost across k, models, index types and modes
+
+import re
+import csv
+import sys
+import json
+import time
+import argparse
+from typing import Dict, List, Any, Tuple, Callable
+
+import numpy as np
+import faiss
+from sentence_transformers import SentenceTransformer
+
+from icpc_utils import ICPCEntry, build_doc_text
+from rag_infer import EMB_MODEL, INDEX_PATH, META_PATH, load_meta, embed_queries
+from prompt_budget import GroundingCache, TokenCounter
+from long_note import windowed_search
+
+DEFAULT_KS = "5,10,15,20,25,30,40,60"
+
+
+# ------------ Gold set -------------
+def load_gold(path: str) -> List[Tuple[str, List[str]]]:
+    """(note_text, gold codes) from JSONL ({"note_text", "codes": [...]}) or CSV (note_text, codes "R05;R74")."""
+    rows = []
+    if path.endswith(".jsonl"):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    r = json.loads(line)
+                    rows.append((r["note_text"], r["codes"]))
+    else:
+        with open(path, "r", encoding="utf-8-sig", newline="") as f:
+            for r in csv.DictReader(f):
+                rows.append((r["note_text"], re.split(r"[;,\s]+", r["codes"])))
+    return [(t.strip(), [c.strip().upper() for c in codes if c.strip()]) for t, codes in rows if t.strip()]
+
+
+# ------------ Index types -------------
+def build_index(kind: str, vecs: np.ndarray, nprobe: int):
+    d = vecs.shape[1]
+    if kind == "flat":
+        index = faiss.IndexFlatIP(d)
+    elif kind == "hnsw":
+        index = faiss.IndexHNSWFlat(d, 32, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efSearch = 128
+    elif kind == "ivf":
+        nlist = max(1, int(np.sqrt(len(vecs))))
+        index = faiss.IndexIVFFlat(faiss.IndexFlatIP(d), nlist, faiss.METRIC_INNER_PRODUCT)
+        index.train(vecs)
+        index.nprobe = nprobe
+    else:
+        raise ValueError(f"Ukjent indekstype: {kind}")
+    index.add(vecs)
+    return index
+
+
+def encode_passages(model: SentenceTransformer, meta: List[ICPCEntry]) -> np.ndarray:
+    passages = [f"passage: {build_doc_text(e)}" for e in meta]
+    return model.encode(passages, batch_size=256, convert_to_numpy=True, normalize_embeddings=True).astype(np.float32)
+
+
+# ------------ Retrieval modes -------------
+def dense_search(model, index, notes: List[str], kmax: int) -> np.ndarray:
+    """Current production path: one E5 query vector per note, one FAISS search."""
+    qvecs = embed_queries(notes, model).astype(np.float32)
+    _, I = index.search(qvecs, kmax)
+    return I
+
+
+def window_search(pool: str) -> Callable:
+    """Long-note mode (long_note.py): overlapping windows, one search, scores pooled per code."""
+    def search(model, index, notes: List[str], kmax: int) -> np.ndarray:
+        out = np.full((len(notes), kmax), -1, dtype=np.int64)
+        for row, hits in enumerate(windowed_search(notes, model, index, kmax, pool=pool)):
+            out[row, :len(hits)] = [i for i, _ in hits]
+        return out
+    return search
+
+
+RETRIEVAL_MODES: Dict[str, Callable] = {
+    "dense": dense_search,
+    "window-max": window_search("max"),
+    "window-mean": window_search("mean"),
+}
+
+
+# ------------ Metrics -------------
+def evaluate(ranked: np.ndarray, gold: List[List[str]], meta: List[ICPCEntry], ks: List[int],
+             grounding: GroundingCache) -> Dict[str, Any]:
+    codes = [[meta[i].code for i in row if i >= 0] for row in ranked]
+    out = {"recall": {}, "hit": {}, "grounding_tokens": {}}
+    for k in ks:
+        recalls, hits = [], []
+        for got, want in zip(codes, gold):
+            found = len(set(got[:k]) & set(want))
+            recalls.append(found / len(want) if want else 1.0)
+            hits.append(1.0 if found else 0.0)
+        out["recall"][k] = round(float(np.mean(recalls)), 4)
+        out["hit"][k] = round(float(np.mean(hits)), 4)
+        # Prompt cost of the candidate block at this k (mean over notes), counted like PromptBuilder
+        out["grounding_tokens"][k] = int(np.mean([
+            sum(grounding.tokens[meta[i].code] for i in row[:k] if i >= 0) for row in ranked
+        ]))
+    rr = []
+    for got, want in zip(codes, gold):
+        rank = next((r for r, c in enumerate(got, 1) if c in want), None)
+        rr.append(1.0 / rank if rank else 0.0)
+    out["mrr"] = round(float(np.mean(rr)), 4)
+    return out
+
+
+def smallest_k(recall_by_k: Dict[int, float], target: float):
+    for k in sorted(recall_by_k):
+        if recall_by_k[k] >= target:
+            return k
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluer kandidatsøket (recall@k, MRR, prompt-tokens) på et merket sett.")
+    parser.add_argument("gold", help="JSONL med note_text + codes, eller CSV med kolonnene note_text, codes")
+    parser.add_argument("--ks", default=DEFAULT_KS, help=f"Kommaseparerte k-verdier (default: {DEFAULT_KS})")
+    parser.add_argument("--models", default=EMB_MODEL, help="Kommaseparerte embedding-modeller")
+    parser.add_argument("--index-types", default="file",
+                        help="Kommaseparert: file (bygget indeks for EMB_MODEL), flat, hnsw, ivf")
+    parser.add_argument("--modes", default="dense", help=f"Kommaseparert: {', '.join(RETRIEVAL_MODES)}")
+    parser.add_argument("--nprobe", type=int, default=8, help="nprobe for ivf")
+    parser.add_argument("--target-recall", type=float, default=0.95, help="Mål-recall for anbefalt k")
+    parser.add_argument("--report", help="Skriv full rapport som JSON hit")
+    args = parser.parse_args()
+
+    ks = sorted(int(k) for k in args.ks.split(","))
+    data = load_gold(args.gold)
+    notes = [t for t, _ in data]
+    gold = [c for _, c in data]
+    meta = load_meta(META_PATH)
+    print(f"📏 {len(data)} merkede notater, {len(meta)} ICPC-2-koder", file=sys.stderr)
+    # Token costs as app.py budgets them: its TokenCounter over the serving model's (EMB_MODEL)
+    # tokenizer, whichever models are evaluated here
+    print(f"🔄 Laster {EMB_MODEL}...", file=sys.stderr)
+    app_model = SentenceTransformer(EMB_MODEL)
+    counter = TokenCounter(hf_tokenizer=getattr(app_model, "tokenizer", None))
+    grounding = GroundingCache(meta, counter)
+    print(f"🔢 Tokenteller: {counter.name}", file=sys.stderr)
+
+    results = []
+    for model_name in args.models.split(","):
+        if model_name == EMB_MODEL:
+            model = app_model
+        else:
+            print(f"🔄 Laster {model_name}...", file=sys.stderr)
+            model = SentenceTransformer(model_name)
+        passage_vecs = None
+        for kind in args.index_types.split(","):
+            if kind == "file":
+                if model_name != EMB_MODEL:
+                    print(f"⚠️  {INDEX_PATH} er bygget med {EMB_MODEL}; hopper over 'file' for {model_name}", file=sys.stderr)
+                    continue
+                index = faiss.read_index(INDEX_PATH)
+            else:
+                if passage_vecs is None:
+                    passage_vecs = encode_passages(model, meta)
+                index = build_index(kind, passage_vecs, args.nprobe)
+            for mode in args.modes.split(","):
+                t0 = time.perf_counter()
+                ranked = RETRIEVAL_MODES[mode](model, index, notes, max(ks))
+                ms_per_note = (time.perf_counter() - t0) * 1000 / max(1, len(notes))
+                metrics = evaluate(ranked, gold, meta, ks, grounding)
+                results.append({"model": model_name, "index": kind, "mode": mode,
+                                "ms_per_note": round(ms_per_note, 2), **metrics,
+                                "recommended_k": smallest_k(metrics["recall"], args.target_recall)})
+
+    # Table: one row per configuration and k
+    print(f"\n{'modell':40} {'indeks':6} {'modus':12} {'k':>4} {'recall':>7} {'hit':>6} {'tokens':>7}")
+    print("-" * 88)
+    for r in results:
+        for k in ks:
+            print(f"{r['model'][:40]:40} {r['index']:6} {r['mode']:12} {k:>4} "
+                  f"{r['recall'][k]:>7.3f} {r['hit'][k]:>6.3f} {r['grounding_tokens'][k]:>7}")
+        rec = r["recommended_k"]
+        print(f"  ↳ MRR {r['mrr']:.3f} | {r['ms_per_note']} ms/notat | minste k med recall ≥ {args.target_recall}: "
+              f"{rec if rec is not None else 'ikke nådd'}"
+              + (f" (≈{r['grounding_tokens'][rec]} prompt-tokens for kandidatene)" if rec is not None else ""))
+        print()
+
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump({"target_recall": args.target_recall, "ks": ks, "results": results}, f, ensure_ascii=False, indent=2)
+        print(f"📝 Rapport skrevet til {args.report}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
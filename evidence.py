@@ -0,0 +1,163 @@
+# evidence.py
+# Local evidence check: every quoted span is located in the note (exact, then fuzzy), gets its
+# character offsets and the section it sits in, and quotes that are not in the note are flagged
+
+import os
+import re
+from bisect import bisect_right
+from collections import defaultdict
+from difflib import SequenceMatcher
+from typing import Any, Dict, List, Optional, Tuple
+
+# ------------ Config -------------
+EVIDENCE_MIN_SCORE = float(os.environ.get("EVIDENCE_MIN_SCORE", "0.85"))  # fuzzy match ratio for a quote to count
+# Word windows scored by the fuzzy fallback per quote part: the ones sharing most trigrams with it
+EVIDENCE_MAX_WINDOWS = int(os.environ.get("EVIDENCE_MAX_WINDOWS", "24"))
+# ---------------------------------
+
+UNKNOWN = "Ukjent"
+# Section header at the start of a line -> the label in the output schema. Combined headers
+# ("Vurdering/Plan:") take the first one.
+SECTION_LABELS = {"anamnese": "Anamnese", "aa": "Anamnese", "status": "Status", "funn": "Status", "us": "Status",
+                  "undersøkelse": "Status", "vurdering": "Vurdering", "konklusjon": "Vurdering",
+                  "plan": "Plan", "tiltak": "Plan", "behandling": "Plan"}
+SECTION_HEADER_RE = re.compile(r"^[ \t]*(%s)(?:[ \t]*/[ \t]*\w+)*[ \t]*:" % "|".join(SECTION_LABELS), re.I | re.M)
+ELLIPSIS_RE = re.compile(r"\s*(?:\.\.\.+|…|\[\s*(?:\.\.\.|…)\s*\])\s*")
+WORD_RE = re.compile(r"\w+")
+DROPPED = set("\"'«»“”„‘’`")
+
+
+class NoteEvidence:
+    """One note, parsed once: section boundaries and a normalized copy (case-folded, collapsed
+    whitespace, no quote marks) with a map back to the original offsets (one per normalized
+    character). locate() tries an exact substring search on the normalized text first and falls
+    back to the best-scoring word window of about the quote's length. Fuzzy candidates come from a
+    character-trigram index of the note's words: only windows sharing trigrams with the quote are
+    scored, at most EVIDENCE_MAX_WINDOWS of them, so a quote that is not in the note costs a
+    lookup rather than a scan."""
+
+    def __init__(self, note_text: str):
+        self.text = note_text
+        self.section_starts: List[int] = [0]
+        self.section_labels: List[str] = [UNKNOWN]
+        for m in SECTION_HEADER_RE.finditer(note_text):
+            self.section_starts.append(m.start())
+            self.section_labels.append(SECTION_LABELS[m.group(1).lower()])
+        self.norm, self.offsets = self._normalize(note_text)
+        self.words = [(m.start(), m.end(), m.group()) for m in WORD_RE.finditer(self.norm)]
+        self.trigrams: Dict[str, List[int]] = defaultdict(list)  # trigram -> word positions
+        for w, (_, _, word) in enumerate(self.words):
+            for t in self._trigrams(word):
+                self.trigrams[t].append(w)
+
+    @staticmethod
+    def _trigrams(word: str) -> set:
+        padded = f" {word} "
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    @staticmethod
+    def _normalize(text: str) -> Tuple[str, List[int]]:
+        chars, offsets = [], []
+        for i, c in enumerate(text):
+            if c in DROPPED:
+                continue
+            if c.isspace():
+                if not chars or chars[-1] == " ":
+                    continue
+                c = " "
+            for lc in c.lower():  # may be longer than one character ('İ' -> 'i̇')
+                chars.append(lc)
+                offsets.append(i)
+        return "".join(chars), offsets
+
+    def section_at(self, pos: int) -> str:
+        return self.section_labels[bisect_right(self.section_starts, pos) - 1]
+
+    def _span(self, nstart: int, nend: int) -> Tuple[int, int]:
+        """Normalized [nstart, nend) -> original offsets."""
+        return self.offsets[nstart], self.offsets[nend - 1] + 1
+
+    def _find(self, quote: str, after: int = 0) -> Optional[Tuple[int, int, float]]:
+        """(normalized start, end, score) of one quote part at or after `after`."""
+        q = self._normalize(quote)[0].strip()
+        if not q:
+            return None
+        i = self.norm.find(q, after)
+        if i >= 0:
+            return i, i + len(q), 1.0
+        q_words = WORD_RE.findall(q)
+        if not q_words:
+            return None
+        n = len(q_words)
+        # Trigram hits per note word, summed over each n-word window: windows with none cannot
+        # score EVIDENCE_MIN_SCORE, and only the best-anchored ones are compared in full
+        hits = [0] * len(self.words)
+        for t in set().union(*(self._trigrams(word) for word in q_words)):
+            for w in self.trigrams.get(t, ()):
+                hits[w] += 1
+        first = next((w for w, (start, _, _) in enumerate(self.words) if start >= after), len(self.words))
+        prefix = [0]
+        for h in hits:
+            prefix.append(prefix[-1] + h)
+        anchored = [(prefix[min(w + n, len(hits))] - prefix[w], w) for w in range(first, len(self.words))]
+        anchored = sorted((a for a in anchored if a[0] > 0), reverse=True)[:EVIDENCE_MAX_WINDOWS]
+        best = None
+        for _, w in anchored:
+            start = self.words[w][0]
+            for length in (n - 1, n, n + 1):
+                if length < 1 or w + length > len(self.words):
+                    continue
+                end = self.words[w + length - 1][1]
+                sm = SequenceMatcher(None, q, self.norm[start:end], autojunk=False)
+                if sm.real_quick_ratio() < EVIDENCE_MIN_SCORE or sm.quick_ratio() < EVIDENCE_MIN_SCORE:
+                    continue
+                score = sm.ratio()
+                if best is None or score > best[2] or (score == best[2] and start < best[0]):
+                    best = (start, end, score)
+        return best
+
+    def locate(self, quote: str, min_score: float = EVIDENCE_MIN_SCORE) -> Optional[Dict[str, Any]]:
+        """Offsets of `quote` in the note, or None if it is not there. Quotes shortened with an
+        ellipsis match when every part is found, in order; the span covers all parts."""
+        parts = [p for p in ELLIPSIS_RE.split(quote or "") if p.strip()]
+        if not parts:
+            return None
+        first, after, score = None, 0, 1.0
+        for part in parts:
+            hit = self._find(part, after)
+            if hit is None or hit[2] < min_score:
+                return None
+            first = hit[0] if first is None else first
+            after, score = hit[1], min(score, hit[2])
+        start, end = self._span(first, after)
+        return {"start": start, "end": end, "score": round(score, 3), "match": "exact" if score == 1.0 else "fuzzy"}
+
+    def check_span(self, span: Any, min_score: float = EVIDENCE_MIN_SCORE) -> Dict[str, Any]:
+        """The span with verified text, offsets and section. Quotes not found keep their text and
+        get `verified: false`."""
+        quote = span.get("text", "") if isinstance(span, dict) else str(span)
+        hit = self.locate(quote, min_score)
+        if hit is None:
+            return {"text": quote, "section": UNKNOWN, "verified": False, "match": "none"}
+        text = self.text[hit["start"]:hit["end"]]
+        out = {"text": text, "section": self.section_at(hit["start"]), "verified": True, **hit}
+        if hit["match"] == "fuzzy":
+            out["quote"] = quote  # what the model wrote; `text` is what the note says
+        return out
+
+    def verify(self, obj: Dict[str, Any], min_score: float = EVIDENCE_MIN_SCORE) -> Dict[str, Any]:
+        """Check every suggestion's evidence_spans in place. A suggestion citing text that is not
+        in the note is marked needs_review."""
+        counts = {"spans": 0, "exact": 0, "fuzzy": 0, "unverified": 0}
+        for item in obj.get("top_k", []):
+            if not isinstance(item, dict):
+                continue
+            spans = [self.check_span(s, min_score) for s in item.get("evidence_spans") or []]
+            item["evidence_spans"] = spans
+            for s in spans:
+                counts["spans"] += 1
+                counts[s["match"] if s["verified"] else "unverified"] += 1
+            if any(not s["verified"] for s in spans):
+                item["needs_review"] = True
+        obj["evidence_check"] = counts
+        return obj
@@ -0,0 +1,62 @@
+# icpc_csv.py
+# Build-time only: load the ICPC-2 CSV with pandas and turn it into ICPCEntry rows (build_index.py).
+# Kept out of icpc_utils so the server never imports pandas.
+
+from __future__ import annotations
+import csv
+from typing import List
+
+import pandas as pd
+
+from icpc_utils import ICPCEntry, component_from_code
+
+
+def _detect_delimiter(path: str) -> str:
+    with open(path, "r", encoding="utf-8", errors="ignore") as f:
+        sample = f.read(2048)
+        try:
+            dialect = csv.Sniffer().sniff(sample)
+            return dialect.delimiter
+        except Exception:
+            return ","
+
+
+def load_icpc_csv(path: str) -> pd.DataFrame:
+    """Load and normalize the ICPC-2 CSV (handles ';' delimiter and trailing spaces)."""
+    delim = _detect_delimiter(path)
+    df = pd.read_csv(path, delimiter=delim, encoding="utf-8", on_bad_lines="skip")
+    # Strip whitespace in column names
+    df.columns = df.columns.str.strip()
+    # Canonical expected columns: "Kode", "Kodetekst"
+    # Some files might have "Kodetekst " with trailing space; we stripped above.
+    assert "Kode" in df.columns, f"Expected a 'Kode' column. Found: {list(df.columns)}"
+    # Find the text column heuristically
+    text_col = None
+    for cand in ["Kodetekst", "Tekst", "Tittel", "Title"]:
+        if cand in df.columns:
+            text_col = cand
+            break
+    if text_col is None:
+        # Fallback: second column
+        text_col = df.columns[1]
+    df = df[["Kode", text_col]].rename(columns={text_col: "Kodetekst"})
+    # Drop rows without code/text
+    df = df.dropna(subset=["Kode", "Kodetekst"])
+    # Normalize whitespace
+    df["Kode"] = df["Kode"].astype(str).str.strip()
+    df["Kodetekst"] = df["Kodetekst"].astype(str).str.strip()
+    # Deduplicate by code keeping the longest title
+    df = (df.sort_values(by="Kodetekst", key=lambda s: s.str.len(), ascending=False)
+            .drop_duplicates(subset=["Kode"], keep="first"))
+    return df.reset_index(drop=True)
+
+
+def to_entries(df: pd.DataFrame) -> List[ICPCEntry]:
+    rows: List[ICPCEntry] = []
+    for _, r in df.iterrows():
+        code = str(r["Kode"]).strip()
+        title = str(r["Kodetekst"]).strip()
+        hint, comp = component_from_code(code)
+        chapter = code[0] if code else "?"
+        rows.append(ICPCEntry(code=code, title=title, component_hint=hint, component_guess=comp, chapter=chapter))
+    return rows
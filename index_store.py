@@ -0,0 +1,283 @@
+# index_store.py
+# Versioned FAISS index + metadata with zero-downtime hot reload: a new version is loaded and
+# validated in the background, swapped in for new requests, and released once in-flight ones drain
+
+import os
+import json
+import time
+import hashlib
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+import faiss
+
+from icpc_utils import ICPCEntry
+from bundle import BUNDLE_VERIFY, bundle_files, read_manifest, verify_bundle, load_entries
+from neighbors import NEIGHBORS_PATH, NeighborGraph
+
+# ------------ Config -------------
+MANIFEST_PATH = os.environ.get("MANIFEST_PATH", "icpc2_manifest.json")  # written by build_index.py; optional
+INDEX_WATCH_INTERVAL = float(os.environ.get("INDEX_WATCH_INTERVAL", "0"))  # seconds between file checks; 0 = off
+# ---------------------------------
+
+
+class IndexValidationError(Exception):
+    """The files on disk do not form a usable index (wrong dimension, row count or model)."""
+
+
+def file_version(*paths: str) -> str:
+    """Content hash of the index files; identical files give the same version."""
+    h = hashlib.sha1()
+    for path in paths:
+        if not path or not os.path.exists(path):
+            continue
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+    return h.hexdigest()[:12]
+
+
+class IndexVersion:
+    """One loaded (index, metadata, neighbor graph) set. Requests hold it from retrieval to the
+    final result, so a swap never changes the candidates under a running analysis. `prepare`
+    callbacks may attach derived structures (grounding cache, suggest index) as attributes."""
+
+    def __init__(self, version: str, index, meta: List[ICPCEntry], manifest: Dict[str, Any],
+                 neighbors: Optional[NeighborGraph] = None):
+        self.version = version
+        self.index = index
+        self.meta = meta
+        self.code_index = {e.code: e for e in meta}
+        self.manifest = manifest
+        self.neighbors = neighbors
+        self.loaded_at = time.time()
+        self.in_flight = 0
+
+    def close(self) -> None:
+        """Free the index memory; only called once nothing holds this version any more."""
+        if self.index is not None:
+            self.index.reset()
+        self.index = self.neighbors = None
+        self.meta, self.code_index = [], {}
+
+
+class IndexStore:
+    """The active IndexVersion plus the retired ones still serving requests.
+
+    acquire()/release() count a version's users; reload() loads the files on a background
+    thread, validates them against the embedding model and swaps atomically. A retired version is
+    closed when its last request releases it. With INDEX_WATCH_INTERVAL set, a change to the files
+    that has been stable for one interval triggers a reload (build_index.py writes atomically).
+    """
+
+    def __init__(self, index_path: str, meta_path: str, model_id: str, dim: int,
+                 manifest_path: str = MANIFEST_PATH, prepare: Optional[Callable[[IndexVersion], None]] = None,
+                 probe: Optional[np.ndarray] = None, bundle_path: str = "", neighbors_path: str = NEIGHBORS_PATH):
+        self.index_path = index_path
+        self.meta_path = meta_path
+        self.manifest_path = manifest_path
+        self.neighbors_path = neighbors_path  # missing file: the graph is computed from the index at load
+        self.bundle_path = bundle_path  # bundle.py directory (or `current` link); replaces the three paths
+        self.model_id = model_id
+        self.dim = dim
+        self.prepare = prepare
+        self.probe = probe  # a query vector searched once as a smoke test of each new version
+        self._current: Optional[IndexVersion] = None
+        self._retired: List[IndexVersion] = []
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._watcher: Optional[threading.Thread] = None
+        self.watch_interval: Optional[float] = None
+        self.reloads = 0
+        self.unchanged = 0
+        self.failed = 0
+        self.released = 0
+        self.last_error: Optional[str] = None
+        self.reloading = False
+
+    # --- loading ---
+
+    def _paths(self) -> List[str]:
+        if self.bundle_path:
+            return [bundle_files(self.bundle_path)["manifest"]]  # follows the `current` link when stat'ed
+        return [self.index_path, self.meta_path, self.manifest_path, self.neighbors_path]
+
+    def _disk_version(self) -> str:
+        if self.bundle_path:
+            return read_manifest(os.path.realpath(self.bundle_path))["version"]
+        return file_version(*self._paths())
+
+    def load(self) -> IndexVersion:
+        """Read and validate the files; raises IndexValidationError (BundleError for bundles).
+        Does not swap."""
+        if self.bundle_path:
+            root = os.path.realpath(self.bundle_path)  # pin the bundle the link points at right now
+            manifest = read_manifest(root)
+            verify_bundle(root, manifest, BUNDLE_VERIFY)
+            version = manifest["version"]
+            files = bundle_files(root)
+            index_path, meta_path, neighbors_path = files["index"], files["meta"], files["neighbors"]
+        else:
+            version = file_version(*self._paths())
+            manifest = {}
+            if self.manifest_path and os.path.exists(self.manifest_path):
+                with open(self.manifest_path, "r", encoding="utf-8") as f:
+                    manifest = json.load(f)
+            index_path, meta_path, neighbors_path = self.index_path, self.meta_path, self.neighbors_path
+        index = faiss.read_index(index_path)
+        meta = load_entries(meta_path)
+        if manifest.get("dim") and manifest["dim"] != index.d:
+            raise IndexValidationError(f"Manifestet sier dimensjon {manifest['dim']}, indeksen har {index.d}")
+        if index.d != self.dim:
+            raise IndexValidationError(f"Indeksen har dimensjon {index.d}, embedding-modellen {self.dim}")
+        if index.ntotal != len(meta):
+            raise IndexValidationError(f"Indeksen har {index.ntotal} rader, metadata {len(meta)}")
+        if len({e.code for e in meta}) != len(meta):
+            raise IndexValidationError("Metadata har dupliserte koder")
+        if manifest.get("model") and manifest["model"] != self.model_id:
+            raise IndexValidationError(f"Indeksen er bygget med {manifest['model']}, ikke {self.model_id}")
+        if self.probe is not None and len(meta):
+            _, I = index.search(self.probe.reshape(1, -1).astype(np.float32), min(5, len(meta)))
+            if not all(0 <= i < len(meta) for i in I[0]):
+                raise IndexValidationError("Prøvesøk ga ugyldige rader")
+        if neighbors_path and os.path.exists(neighbors_path):
+            try:
+                graph = NeighborGraph.load(neighbors_path, meta)
+            except (ValueError, KeyError) as e:
+                raise IndexValidationError(str(e))
+        else:
+            graph = NeighborGraph.from_index(index, meta)
+        v = IndexVersion(version, index, meta, manifest, graph)
+        if self.prepare is not None:
+            self.prepare(v)
+        return v
+
+    def load_initial(self) -> IndexVersion:
+        v = self.load()
+        with self._lock:
+            self._current = v
+        return v
+
+    def reload(self) -> Dict[str, Any]:
+        """Load, validate and swap (blocking). Returns the outcome; never raises on bad files,
+        the current version simply stays active."""
+        if not self._reload_lock.acquire(blocking=False):
+            return {"status": "busy"}
+        self.reloading = True
+        t0 = time.perf_counter()
+        try:
+            try:
+                if self._current is not None and self._disk_version() == self._current.version:
+                    self.unchanged += 1
+                    return {"status": "unchanged", "version": self._current.version}
+                new = self.load()
+            except Exception as e:
+                self.failed += 1
+                self.last_error = f"{type(e).__name__}: {e}"
+                print(f"⚠️ Indeks-reload avvist: {self.last_error}")
+                return {"status": "failed", "error": self.last_error,
+                        "version": self._current.version if self._current else None}
+            with self._lock:
+                old, self._current = self._current, new
+                if old is not None:
+                    self._retired.append(old)
+            self.reloads += 1
+            self.last_error = None
+            if old is not None:
+                self._maybe_close(old)
+            print(f"✅ Indeks {new.version} aktiv ({len(new.meta)} koder)")
+            return {"status": "reloaded", "version": new.version, "previous": old.version if old else None,
+                    "took_s": round(time.perf_counter() - t0, 3)}
+        finally:
+            self.reloading = False
+            self._reload_lock.release()
+
+    def reload_async(self) -> bool:
+        """Start reload() on a background thread; False if one is already running."""
+        if self.reloading:
+            return False
+        threading.Thread(target=self.reload, name="index-reload", daemon=True).start()
+        return True
+
+    # --- use ---
+
+    def current(self) -> IndexVersion:
+        return self._current
+
+    def acquire(self) -> IndexVersion:
+        with self._lock:
+            v = self._current
+            v.in_flight += 1
+            return v
+
+    def release(self, v: IndexVersion) -> None:
+        with self._lock:
+            v.in_flight -= 1
+        self._maybe_close(v)
+
+    @property
+    def in_flight(self) -> int:
+        """Requests holding any version, the retired ones included (not just current().in_flight)."""
+        with self._lock:
+            return sum(v.in_flight for v in ([self._current] if self._current else []) + self._retired)
+
+    def _maybe_close(self, v: IndexVersion) -> None:
+        with self._lock:
+            if v is self._current or v.in_flight > 0 or v not in self._retired:
+                return
+            self._retired.remove(v)
+            self.released += 1
+        v.close()
+
+    # --- file watch ---
+
+    def _stamp(self):
+        out = []
+        for path in self._paths():
+            try:
+                st = os.stat(path)
+                out.append((st.st_mtime_ns, st.st_size))
+            except OSError:
+                out.append(None)
+        return tuple(out)
+
+    def watch(self, interval: float = INDEX_WATCH_INTERVAL) -> None:
+        if interval <= 0 or self._watcher is not None:
+            return
+        self.watch_interval = interval
+
+        def loop():
+            seen = self._stamp()
+            pending = None
+            while True:
+                time.sleep(interval)
+                stamp = self._stamp()
+                if stamp != seen:
+                    seen, pending = stamp, stamp  # changed: wait until it is stable for one interval
+                elif pending is not None:
+                    pending = None
+                    self.reload()
+
+        self._watcher = threading.Thread(target=loop, name="index-watch", daemon=True)
+        self._watcher.start()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            v = self._current
+            return {
+                "version": v.version if v else None,
+                "rows": len(v.meta) if v else 0,
+                "dim": self.dim,
+                "model": (v.manifest.get("model") if v else None) or self.model_id,
+                "loaded_at": v.loaded_at if v else None,
+                "in_flight": v.in_flight if v else 0,
+                "retired": [{"version": r.version, "in_flight": r.in_flight} for r in self._retired],
+                "reloads": self.reloads,
+                "unchanged": self.unchanged,
+                "failed": self.failed,
+                "released": self.released,
+                "reloading": self.reloading,
+                "last_error": self.last_error,
+                "watch_interval": self.watch_interval,
+            }
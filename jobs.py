@@ -0,0 +1,253 @@
+# jobs.py
+# Asynchronous job subsystem: SQLite-backed job store and a background worker pool
+
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+from typing import Callable, Dict, Any, List, Optional
+
+# ------------ Config -------------
+JOBS_DB_PATH = os.environ.get("JOBS_DB_PATH", "jobs.sqlite3")
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "2"))
+JOB_MAX_NOTES = int(os.environ.get("JOB_MAX_NOTES", "10000"))
+JOB_RETRY_DELAY = float(os.environ.get("JOB_RETRY_DELAY", "5"))  # back-off when the LLM queue is full
+JOB_ORPHAN_CHECK = float(os.environ.get("JOB_ORPHAN_CHECK", "60"))  # seconds between requeue sweeps while idle
+# ---------------------------------
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    created REAL NOT NULL,
+    total INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS job_notes (
+    job_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    note_id TEXT,
+    note_text TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',  -- pending | running | done | failed
+    claimed_by TEXT,
+    result TEXT,
+    error TEXT,
+    updated REAL,
+    PRIMARY KEY (job_id, idx)
+);
+CREATE INDEX IF NOT EXISTS job_notes_status ON job_notes (status, job_id, idx);
+"""
+
+
+_boot = {"pid": None, "nonce": None}
+
+
+def process_nonce() -> str:
+    """Random id of this process, new after fork. A restarted container keeps its hostname and
+    often gets the same PIDs, so host:pid alone would mistake a dead owner for a live one."""
+    if _boot["pid"] != os.getpid():
+        _boot["pid"], _boot["nonce"] = os.getpid(), uuid.uuid4().hex[:12]
+    return _boot["nonce"]
+
+
+def _pid_alive(owner: Optional[str]) -> bool:
+    """Whether the process that claimed a note ("host:pid:nonce") may still be working on it."""
+    try:
+        host, pid, *nonce = owner.split(":")
+        if host != os.uname().nodename:
+            return True  # can't tell for another host; leave it alone
+        if int(pid) == os.getpid():
+            return nonce == [process_nonce()]  # our PID, but maybe an earlier life of it
+        os.kill(int(pid), 0)
+        return True
+    except (AttributeError, ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        return True
+
+
+class JobStore:
+    """Jobs and their notes in a local SQLite file, so submitted work survives restarts."""
+
+    def __init__(self, path: str = JOBS_DB_PATH):
+        self.path = path
+        self._local = threading.local()
+        with self._conn() as db:
+            db.executescript(SCHEMA)
+
+    @property
+    def owner(self) -> str:
+        """Claims are per process: a forked worker must not share its master's identity."""
+        return f"{os.uname().nodename}:{os.getpid()}:{process_nonce()}"
+
+    def _conn(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None or getattr(self._local, "pid", None) != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.row_factory = sqlite3.Row
+            self._local.db, self._local.pid = db, os.getpid()
+        return db
+
+    def close(self) -> None:
+        """Close this thread's connection (serve.py does so in the master before forking)."""
+        db = getattr(self._local, "db", None)
+        if db is not None:
+            db.close()
+            self._local.db = None
+
+    def create_job(self, notes: List[Dict[str, str]]) -> str:
+        job_id = uuid.uuid4().hex
+        db = self._conn()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute("INSERT INTO jobs (id, created, total) VALUES (?, ?, ?)", (job_id, time.time(), len(notes)))
+            db.executemany(
+                "INSERT INTO job_notes (job_id, idx, note_id, note_text) VALUES (?, ?, ?, ?)",
+                [(job_id, i, n.get("id"), n["note_text"]) for i, n in enumerate(notes)],
+            )
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        return job_id
+
+    def requeue_orphans(self) -> int:
+        """Put notes claimed by a process that no longer exists back to pending (crash/restart)."""
+        db = self._conn()
+        rows = db.execute("SELECT DISTINCT claimed_by FROM job_notes WHERE status = 'running'").fetchall()
+        dead = [r["claimed_by"] for r in rows if not _pid_alive(r["claimed_by"])]
+        n = 0
+        for owner in dead:
+            n += db.execute("UPDATE job_notes SET status = 'pending', claimed_by = NULL "
+                            "WHERE status = 'running' AND claimed_by = ?", (owner,)).rowcount
+        return n
+
+    def claim_next(self) -> Optional[sqlite3.Row]:
+        """Atomically mark the oldest pending note as running and return it (jobs are FIFO)."""
+        db = self._conn()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute(
+                "SELECT n.job_id, n.idx, n.note_text FROM job_notes n JOIN jobs j ON j.id = n.job_id "
+                "WHERE n.status = 'pending' ORDER BY j.created, n.idx LIMIT 1"
+            ).fetchone()
+            if row is not None:
+                db.execute("UPDATE job_notes SET status = 'running', claimed_by = ?, updated = ? "
+                           "WHERE job_id = ? AND idx = ?", (self.owner, time.time(), row["job_id"], row["idx"]))
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        return row
+
+    def release(self, job_id: str, idx: int) -> None:
+        self._conn().execute("UPDATE job_notes SET status = 'pending', claimed_by = NULL "
+                             "WHERE job_id = ? AND idx = ?", (job_id, idx))
+
+    def complete(self, job_id: str, idx: int, result: Optional[Dict[str, Any]] = None,
+                 error: Optional[str] = None) -> None:
+        self._conn().execute(
+            "UPDATE job_notes SET status = ?, result = ?, error = ?, updated = ? WHERE job_id = ? AND idx = ?",
+            ("failed" if error else "done", json.dumps(result, ensure_ascii=False) if result is not None else None,
+             error, time.time(), job_id, idx),
+        )
+
+    def get(self, job_id: str, include_results: bool = True) -> Optional[Dict[str, Any]]:
+        db = self._conn()
+        job = db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if job is None:
+            return None
+        counts = {r["status"]: r["n"] for r in db.execute(
+            "SELECT status, COUNT(*) AS n FROM job_notes WHERE job_id = ? GROUP BY status", (job_id,))}
+        finished = counts.get("done", 0) + counts.get("failed", 0)
+        if finished == job["total"]:
+            status = "done"
+        elif finished or counts.get("running"):
+            status = "running"
+        else:
+            status = "queued"
+        out = {
+            "job_id": job_id,
+            "status": status,
+            "created": job["created"],
+            "total": job["total"],
+            "done": counts.get("done", 0),
+            "failed": counts.get("failed", 0),
+            "progress": round(finished / job["total"], 4) if job["total"] else 1.0,
+        }
+        if include_results:
+            # Partial results while running; finished notes only, in submission order
+            out["results"] = [
+                {"index": r["idx"], "id": r["note_id"], "status": r["status"],
+                 **({"result": json.loads(r["result"])} if r["result"] else {}),
+                 **({"error": r["error"]} if r["error"] else {})}
+                for r in db.execute("SELECT idx, note_id, status, result, error FROM job_notes "
+                                    "WHERE job_id = ? AND status IN ('done', 'failed') ORDER BY idx", (job_id,))
+            ]
+        return out
+
+
+class RetryLater(Exception):
+    """Raised by the process function to put a note back (e.g. the LLM queue is full)."""
+
+
+class JobRunner:
+    """Background worker threads that drain the job store through `process(note_text) -> result`."""
+
+    def __init__(self, store: JobStore, process: Callable[[str], Dict[str, Any]], workers: int = JOB_WORKERS):
+        self.store = store
+        self.process = process
+        self.workers = workers
+        self._wake = threading.Event()
+        self._started = False
+        self._next_orphan_check = 0.0
+
+    def start(self) -> None:
+        if self._started:
+            return
+        self._started = True
+        self.requeue_orphans()
+        for i in range(self.workers):
+            threading.Thread(target=self._loop, name=f"job-worker-{i}", daemon=True).start()
+
+    def requeue_orphans(self) -> None:
+        """At start, and every JOB_ORPHAN_CHECK seconds while idle: a worker of another process
+        that died (or a container that restarted) leaves its notes 'running' otherwise."""
+        self._next_orphan_check = time.monotonic() + JOB_ORPHAN_CHECK
+        requeued = self.store.requeue_orphans()
+        if requeued:
+            print(f"♻️  {requeued} jobb-notater fra en avsluttet prosess lagt tilbake i køen")
+            self.notify()
+
+    def notify(self) -> None:
+        self._wake.set()
+
+    def _loop(self) -> None:
+        while True:
+            try:
+                self._step()
+            except Exception as e:
+                # A store error (locked or full disk, ...) must not kill the worker thread
+                print(f"⚠️  Jobbarbeider {threading.current_thread().name}: {type(e).__name__}: {e}")
+                time.sleep(JOB_RETRY_DELAY)
+
+    def _step(self) -> None:
+        """Claim and process one note, or wait for work."""
+        row = self.store.claim_next()
+        if row is None:
+            if time.monotonic() >= self._next_orphan_check:
+                self.requeue_orphans()
+            self._wake.wait(timeout=1.0)
+            self._wake.clear()
+            return
+        try:
+            result = self.process(row["note_text"])
+        except RetryLater:
+            self.store.release(row["job_id"], row["idx"])
+            time.sleep(JOB_RETRY_DELAY)
+            return
+        except Exception as e:
+            self.store.complete(row["job_id"], row["idx"], error=str(e))
+            return
+        self.store.complete(row["job_id"], row["idx"], result=result)
@@ -0,0 +1,152 @@
+# live.py
+# Live "code as you type" sessions: cheap retrieval on every revision with per-section embedding
+# reuse, and cancellation of LLM analyses that a newer revision has superseded
+
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Any, Optional, Tuple
+
+import numpy as np
+
+from cancellation import CancelToken
+from long_note import split_windows, pool_hits
+from prompt_budget import split_sections
+
+# ------------ Config -------------
+LIVE_TOPN = int(os.environ.get("LIVE_TOPN", "10"))  # candidates shown while typing
+LIVE_SESSION_TTL = float(os.environ.get("LIVE_SESSION_TTL", "900"))  # idle seconds before a session is dropped
+LIVE_MAX_SESSIONS = int(os.environ.get("LIVE_MAX_SESSIONS", "1000"))
+LIVE_SECTION_CACHE = int(os.environ.get("LIVE_SECTION_CACHE", "64"))  # cached section embeddings per session
+# ---------------------------------
+
+
+class LiveSession:
+    def __init__(self, session_id: str):
+        self.id = session_id
+        self.revision = -1
+        self.analysis: Optional[Tuple[int, CancelToken]] = None  # (revision, token) of the running LLM stream
+        self.sections: "OrderedDict[str, np.ndarray]" = OrderedDict()  # section hash -> window vectors
+        self.last_seen = time.monotonic()
+
+
+class LiveSessions:
+    """Per-editor state for live mode. Revisions are client-side counters that only go up: a
+    request for an older revision than the session has seen is stale, and a newer revision
+    cancels the running analysis (closing its provider stream) so the LLM only runs on settled text."""
+
+    def __init__(self, ttl: float = LIVE_SESSION_TTL, max_sessions: int = LIVE_MAX_SESSIONS,
+                 section_cache: int = LIVE_SECTION_CACHE):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.section_cache = section_cache
+        self._sessions: "OrderedDict[str, LiveSession]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.retrievals = 0
+        self.sections_embedded = 0
+        self.sections_reused = 0
+        self.analyses = 0
+        self.superseded = 0
+
+    def get(self, session_id: str) -> LiveSession:
+        now = time.monotonic()
+        with self._lock:
+            session = self._sessions.pop(session_id, None) or LiveSession(session_id)
+            while self._sessions:
+                oldest = next(iter(self._sessions.values()))
+                if now - oldest.last_seen <= self.ttl and len(self._sessions) < self.max_sessions:
+                    break
+                self._drop(oldest)
+            session.last_seen = now
+            self._sessions[session_id] = session  # most recently used last
+            return session
+
+    def _drop(self, session: LiveSession) -> None:
+        del self._sessions[session.id]
+        if session.analysis is not None:
+            session.analysis[1].cancel("session expired")
+
+    def advance(self, session: LiveSession, revision: int) -> bool:
+        """Record `revision`; False if it is older than one already seen. A newer revision cancels
+        the running analysis of an older one."""
+        with self._lock:
+            if revision < session.revision:
+                return False
+            session.revision = revision
+            running = session.analysis
+            if running is not None and running[0] < revision:
+                session.analysis = None
+                self.superseded += 1
+            else:
+                running = None
+        if running is not None:
+            running[1].cancel("superseded")
+        return True
+
+    def start_analysis(self, session: LiveSession, revision: int) -> Optional[CancelToken]:
+        """Cancel token for an LLM analysis of `revision`, or None if the revision is already stale."""
+        if not self.advance(session, revision):
+            return None
+        token = CancelToken()
+        with self._lock:
+            previous = session.analysis
+            session.analysis = (revision, token)
+            self.analyses += 1
+            if previous is not None:
+                self.superseded += 1
+        if previous is not None:
+            previous[1].cancel("superseded")  # same revision analysed again (e.g. manual re-run)
+        return token
+
+    def finish_analysis(self, session: LiveSession, token: CancelToken) -> None:
+        with self._lock:
+            if session.analysis is not None and session.analysis[1] is token:
+                session.analysis = None
+
+    def retrieve(self, session: LiveSession, note_text: str, model, index, topn: int = LIVE_TOPN
+                 ) -> Tuple[List[Tuple[int, float]], Dict[str, Any]]:
+        """Retrieval-only ranking for the current text. Each section is embedded (as windows if
+        long) and cached by content hash, so a keystroke re-embeds only the section it changed.
+        All section vectors go through one FAISS search and are max-pooled per code."""
+        sections = [chunk.strip() for _, chunk in split_sections(note_text) if chunk.strip()]
+        keys = [hashlib.sha1(s.encode("utf-8")).hexdigest() for s in sections]
+        with self._lock:
+            cached = {k: session.sections[k] for k in keys if k in session.sections}
+        missing = [(k, s) for k, s in zip(keys, sections) if k not in cached]
+        tokenizer = getattr(model, "tokenizer", None)
+        if missing:
+            windows, spans = [], []
+            for _, s in missing:
+                w = split_windows(s, tokenizer)
+                spans.append((len(windows), len(windows) + len(w)))
+                windows.extend(w)
+            vecs = model.encode([f"query: {w}" for w in windows], convert_to_numpy=True,
+                                normalize_embeddings=True).astype(np.float32)
+            for (k, _), (a, b) in zip(missing, spans):
+                cached[k] = vecs[a:b]
+        with self._lock:
+            for k in keys:
+                session.sections[k] = cached[k]
+                session.sections.move_to_end(k)
+            while len(session.sections) > self.section_cache:
+                session.sections.popitem(last=False)
+            self.retrievals += 1
+            self.sections_embedded += len(missing)
+            self.sections_reused += len(keys) - len(missing)
+        if not keys:
+            return [], {"sections": 0, "sections_embedded": 0}
+        D, I = index.search(np.vstack([cached[k] for k in keys]), topn)
+        return pool_hits(D, I, topn, "max"), {"sections": len(keys), "sections_embedded": len(missing)}
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            embedded, reused = self.sections_embedded, self.sections_reused
+            return {
+                "sessions": len(self._sessions),
+                "retrievals": self.retrievals,
+                "section_reuse_rate": round(reused / (embedded + reused), 4) if embedded + reused else 0.0,
+                "analyses": self.analyses,
+                "superseded": self.superseded,
+            }
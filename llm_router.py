@@ -0,0 +1,585 @@
+# llm_router.py
+# Provider router for streaming chat completions: failover, hedged requests and circuit breakers
+
+import os
+import json
+import queue
+import threading
+import time
+from collections import Counter, deque
+from dataclasses import dataclass
+from typing import Callable, List, Dict, Any, Generator, Optional
+from dotenv import load_dotenv
+
+from admission import LLM_PROVIDER_CONCURRENCY, parse_provider_limits, worker_share
+from cancellation import CancelToken, Cancelled
+
+# Load environment variables
+load_dotenv()
+
+# ------------ Config -------------
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", "60"))  # connect/read timeout per provider call
+# Start a second request on the alternate provider if the first has produced no token after this
+# many seconds. 0 disables hedging (plain failover on error is still done).
+LLM_HEDGE_DELAY = float(os.environ.get("LLM_HEDGE_DELAY", "3.0"))
+
+BREAKER_WINDOW = float(os.environ.get("LLM_BREAKER_WINDOW", "120"))  # seconds of history per provider
+BREAKER_MIN_CALLS = int(os.environ.get("LLM_BREAKER_MIN_CALLS", "5"))
+BREAKER_ERROR_RATE = float(os.environ.get("LLM_BREAKER_ERROR_RATE", "0.5"))
+BREAKER_SLOW_TTFT = float(os.environ.get("LLM_BREAKER_SLOW_TTFT", "10"))  # slower first token counts as a failure
+BREAKER_COOLDOWN = float(os.environ.get("LLM_BREAKER_COOLDOWN", "30"))  # seconds open before a probe
+# Ask OpenAI-compatible providers for a final `usage` chunk (stream_options.include_usage);
+# Mistral sends it unasked.
+LLM_STREAM_USAGE = os.environ.get("LLM_STREAM_USAGE", "1") == "1"
+# Structured output when a schema is passed to stream(): json_object (JSON mode), json_schema
+# (schema-constrained decoding, strict) or off. One mode for all providers, or per provider as
+# "mistral=json_object,openai=json_schema" (providers not listed: off).
+LLM_RESPONSE_FORMAT = os.environ.get("LLM_RESPONSE_FORMAT", "json_object")
+# ---------------------------------
+
+
+@dataclass
+class Provider:
+    name: str
+    base: str
+    api_key: str
+    model: str
+    response_format: str = "off"  # json_object | json_schema | off, see LLM_RESPONSE_FORMAT
+
+
+def parse_response_formats(spec: str, name: str) -> str:
+    """The response-format mode LLM_RESPONSE_FORMAT gives provider `name`."""
+    if "=" not in spec:
+        return spec.strip() or "off"
+    for part in spec.split(","):
+        if "=" in part:
+            provider, mode = part.split("=", 1)
+            if provider.strip() == name:
+                return mode.strip()
+    return "off"
+
+
+def configured_providers() -> List[Provider]:
+    """Providers in preference order: Mistral first, then the OpenAI-compatible one (e.g. OpenRouter)."""
+    providers = []
+    if os.getenv("MISTRAL_API_KEY"):
+        providers.append(Provider(
+            name="mistral",
+            base=os.getenv("MISTRAL_BASE", "https://api.mistral.ai/v1"),
+            api_key=os.getenv("MISTRAL_API_KEY"),
+            model=os.getenv("MISTRAL_MODEL", "mistral-large-latest"),
+            response_format=parse_response_formats(LLM_RESPONSE_FORMAT, "mistral"),
+        ))
+    if os.getenv("OPENAI_API_KEY") and os.getenv("OPENAI_BASE") and os.getenv("OPENAI_MODEL"):
+        providers.append(Provider(
+            name="openai",
+            base=os.getenv("OPENAI_BASE"),
+            api_key=os.getenv("OPENAI_API_KEY"),
+            model=os.getenv("OPENAI_MODEL"),
+            response_format=parse_response_formats(LLM_RESPONSE_FORMAT, "openai"),
+        ))
+    return providers
+
+
+def iter_sse_content(response, meta: Optional[Dict[str, Any]] = None) -> Generator[str, None, None]:
+    """Yield `delta.content` pieces from an OpenAI-style SSE chat completion stream.
+    If `meta` is given, the `usage` block and `finish_reason` seen in the stream are stored in it."""
+    for line in response.iter_lines():
+        if not line:
+            continue
+        line = line.decode('utf-8')
+        if not line.startswith('data: '):
+            continue
+        data_str = line[6:]  # Remove 'data: ' prefix
+        if data_str == '[DONE]':
+            break
+        try:
+            data = json.loads(data_str)
+        except json.JSONDecodeError:
+            continue
+        if meta is not None and data.get('usage'):
+            meta['usage'] = data['usage']
+        if 'choices' in data and data['choices']:
+            choice = data['choices'][0]
+            if meta is not None and choice.get('finish_reason'):
+                meta['finish_reason'] = choice['finish_reason']
+            if 'delta' in choice and 'content' in choice['delta']:
+                content = choice['delta']['content']
+                if content:
+                    yield content
+
+
+class CircuitBreaker:
+    """Sliding-window breaker fed by call outcomes and time-to-first-token.
+
+    A call counts as bad if it errored or its first token took longer than `slow_ttft`.
+    When at least `min_calls` outcomes in the window are bad at `error_rate` or more, the
+    breaker opens and the provider is skipped for `cooldown` seconds. After that a single
+    probe request is let through (half-open); its outcome closes or re-opens the breaker.
+    """
+
+    def __init__(self, window: float = BREAKER_WINDOW, min_calls: int = BREAKER_MIN_CALLS,
+                 error_rate: float = BREAKER_ERROR_RATE, slow_ttft: float = BREAKER_SLOW_TTFT,
+                 cooldown: float = BREAKER_COOLDOWN):
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_ttft = slow_ttft
+        self.cooldown = cooldown
+        self._events = deque()  # (timestamp, ok, ttft or None)
+        self._opened_at: Optional[float] = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def _prune(self, now: float) -> None:
+        while self._events and now - self._events[0][0] > self.window:
+            self._events.popleft()
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at >= self.cooldown:
+            return "half-open"
+        return "open"
+
+    def allow(self) -> bool:
+        """True if a request may be sent now. In half-open state only one probe is allowed."""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.cooldown or self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def release(self) -> None:
+        """Forget an allowed call that ended without a verdict (e.g. a cancelled hedge)."""
+        with self._lock:
+            self._probing = False
+
+    def record(self, ok: bool, ttft: Optional[float] = None) -> None:
+        now = time.monotonic()
+        good = ok and (ttft is None or ttft <= self.slow_ttft)
+        with self._lock:
+            self._events.append((now, good, ttft))
+            self._prune(now)
+            if self._probing:
+                self._probing = False
+                if good:
+                    self._opened_at = None
+                    self._events.clear()
+                else:
+                    self._opened_at = now
+                return
+            if self._opened_at is None and len(self._events) >= self.min_calls:
+                bad = sum(1 for _, g, _ in self._events if not g)
+                if bad / len(self._events) >= self.error_rate:
+                    self._opened_at = now
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            self._prune(time.monotonic())
+            events = list(self._events)
+        ttfts = sorted(t for _, _, t in events if t is not None)
+        bad = sum(1 for _, g, _ in events if not g)
+        return {
+            "state": self.state,
+            "window_calls": len(events),
+            "window_error_rate": round(bad / len(events), 3) if events else 0.0,
+            "window_ttft_p50": round(ttfts[len(ttfts) // 2], 3) if ttfts else None,
+        }
+
+
+def _dist(values) -> Dict[str, Optional[float]]:
+    values = sorted(values)
+    if not values:
+        return {"p50": None, "p95": None, "p99": None}
+    pick = lambda q: round(values[min(len(values) - 1, int(q * len(values)))], 4)
+    return {"p50": pick(0.5), "p95": pick(0.95), "p99": pick(0.99)}
+
+
+class StreamMetrics:
+    """Recent latency distributions and token totals per provider/model."""
+
+    def __init__(self, history: int = 1000):
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.cached_prompt_tokens = 0
+        self.completion_tokens = 0
+        self.usage_from_provider = 0
+        self.finish_reasons: Counter = Counter()
+        self.connect = deque(maxlen=history)
+        self.ttft = deque(maxlen=history)
+        self.gaps = deque(maxlen=history * 20)
+        self.tokens_per_s = deque(maxlen=history)
+        self.prompt_sizes = deque(maxlen=history)  # (prompt tokens, ttft) pairs for correlation
+
+    def add(self, call: Dict[str, Any], gaps: List[float]) -> None:
+        self.calls += 1
+        self.prompt_tokens += call["prompt_tokens"] or 0
+        self.cached_prompt_tokens += call["cached_prompt_tokens"] or 0
+        self.completion_tokens += call["completion_tokens"] or 0
+        self.usage_from_provider += call["token_source"] == "provider"
+        self.finish_reasons[call["finish_reason"] or "unknown"] += 1
+        for key, series in (("connect_s", self.connect), ("ttft_s", self.ttft), ("tokens_per_s", self.tokens_per_s)):
+            if call[key] is not None:
+                series.append(call[key])
+        self.gaps.extend(gaps)
+        if call["ttft_s"] is not None:
+            self.prompt_sizes.append((call["prompt_tokens"] or 0, call["ttft_s"]))
+
+    def snapshot(self) -> Dict[str, Any]:
+        pairs = list(self.prompt_sizes)
+        # Seconds of TTFT per 1000 prompt tokens (least-squares slope): how much prompt size costs
+        slope = None
+        if len(pairs) >= 2:
+            mx = sum(p for p, _ in pairs) / len(pairs)
+            my = sum(t for _, t in pairs) / len(pairs)
+            var = sum((p - mx) ** 2 for p, _ in pairs)
+            if var > 0:
+                slope = round(1000 * sum((p - mx) * (t - my) for p, t in pairs) / var, 4)
+        return {
+            "calls": self.calls,
+            "prompt_tokens": self.prompt_tokens,
+            "cached_prompt_tokens": self.cached_prompt_tokens,
+            "prompt_cache_hit_rate": round(self.cached_prompt_tokens / self.prompt_tokens, 4) if self.prompt_tokens else 0.0,
+            "completion_tokens": self.completion_tokens,
+            "usage_from_provider": self.usage_from_provider,
+            "finish_reasons": dict(self.finish_reasons),
+            "connect_s": _dist(self.connect),
+            "ttft_s": _dist(self.ttft),
+            "inter_token_s": _dist(self.gaps),
+            "tokens_per_s": _dist(self.tokens_per_s),
+            "ttft_s_per_1k_prompt_tokens": slope,
+        }
+
+
+def _chars_per_token(text: str) -> int:
+    return (len(text) + 3) // 4
+
+
+class _Attempt:
+    """One streaming call to one provider, run on a background thread feeding a shared queue."""
+
+    def __init__(self, provider: Provider, out: "queue.Queue", messages, temperature, max_tokens, timeout,
+                 on_exit=None, schema: Optional[Dict[str, Any]] = None):
+        self.provider = provider
+        self.on_exit = on_exit
+        self.out = out
+        self.payload = {
+            "model": provider.model,
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "stream": True,
+        }
+        if LLM_STREAM_USAGE and provider.name != "mistral":
+            self.payload["stream_options"] = {"include_usage": True}
+        if schema is not None and provider.response_format == "json_schema":
+            self.payload["response_format"] = {"type": "json_schema", "json_schema": {
+                "name": schema.get("name", "output"), "schema": schema["schema"], "strict": True}}
+        elif schema is not None and provider.response_format == "json_object":
+            self.payload["response_format"] = {"type": "json_object"}
+        self.timeout = timeout
+        self.cancelled = threading.Event()
+        self.finished = False
+        self.response = None
+        self.started = time.monotonic()
+        self.ttft: Optional[float] = None
+        # Timing seen on the reading thread (not delayed by the consumer), plus usage/finish_reason
+        self.connected: Optional[float] = None
+        self.token_times: List[float] = []
+        self.parts: List[str] = []
+        self.meta: Dict[str, Any] = {}
+
+    def start(self) -> None:
+        threading.Thread(target=self._run, name=f"llm-{self.provider.name}", daemon=True).start()
+
+    def _run(self) -> None:
+        import requests
+        url = f"{self.provider.base}/chat/completions"
+        headers = {
+            "Authorization": f"Bearer {self.provider.api_key}",
+            "Content-Type": "application/json",
+        }
+        try:
+            with requests.post(url, headers=headers, json=self.payload, timeout=self.timeout, stream=True) as r:
+                self.connected = time.monotonic()
+                self.response = r
+                if self.cancelled.is_set():
+                    return
+                r.raise_for_status()
+                for content in iter_sse_content(r, self.meta):
+                    if self.cancelled.is_set():
+                        return
+                    self.token_times.append(time.monotonic())
+                    self.parts.append(content)
+                    self.out.put((self, "token", content))
+            self.out.put((self, "done", None))
+        except Exception as e:
+            if not self.cancelled.is_set():
+                self.out.put((self, "error", e))
+        finally:
+            if self.on_exit is not None:
+                self.on_exit()
+
+    def call_metrics(self, count_tokens: Callable[[str], int]) -> Dict[str, Any]:
+        """Timing and token accounting of this call. Token counts come from the provider's
+        `usage` block when it sent one, otherwise from `count_tokens` on prompt and output.
+        `cached_prompt_tokens` is the part of the prompt the provider served from its prefix cache
+        (OpenAI-style `prompt_tokens_details.cached_tokens`); None if the provider does not say."""
+        times = self.token_times
+        usage = self.meta.get("usage") or {}
+        completion = usage.get("completion_tokens")
+        prompt = usage.get("prompt_tokens")
+        source = "provider" if completion is not None else "local"
+        if completion is None:
+            completion = count_tokens("".join(self.parts))
+        if prompt is None:
+            prompt = sum(count_tokens(m.get("content", "")) for m in self.payload["messages"])
+        streaming_s = times[-1] - times[0] if len(times) > 1 else None
+        return {
+            "provider": self.provider.name,
+            "model": self.provider.model,
+            "connect_s": round(self.connected - self.started, 4) if self.connected else None,
+            "ttft_s": round(times[0] - self.started, 4) if times else None,
+            "inter_token_s": _dist([b - a for a, b in zip(times, times[1:])]),
+            "tokens_per_s": round((completion - 1) / streaming_s, 2) if streaming_s and completion > 1 else None,
+            "prompt_tokens": prompt,
+            "cached_prompt_tokens": (usage.get("prompt_tokens_details") or {}).get("cached_tokens"),
+            "completion_tokens": completion,
+            "token_source": source,
+            "finish_reason": self.meta.get("finish_reason"),
+            "response_format": (self.payload.get("response_format") or {}).get("type"),
+            "duration_s": round((times[-1] if times else time.monotonic()) - self.started, 4),
+        }
+
+    def cancel(self) -> None:
+        """Stop reading and close the provider connection so it stops generating (and billing)."""
+        self.cancelled.set()
+        r = self.response
+        if r is not None:
+            try:
+                r.close()
+            except Exception:
+                pass
+
+
+class ProviderRouter:
+    """Streams a chat completion from the first healthy provider, with hedging and failover.
+
+    - Failover: if a provider errors before producing a token, the next one is tried.
+    - Hedging: if no token has arrived after `hedge_delay` seconds, the alternate provider is
+      started as well; whichever produces the first token wins and the other is cancelled.
+    - Circuit breakers: providers with a high recent error/slow-TTFT rate are skipped.
+    - Concurrency caps: a provider already at its `limits` entry is skipped while another has
+      room. If none has, the preferred one is used anyway; admission.ADMISSION bounds the total.
+    Once tokens have been yielded the winner is committed; later errors are raised as-is.
+    """
+
+    def __init__(self, providers: List[Provider], hedge_delay: float = LLM_HEDGE_DELAY,
+                 timeout: float = LLM_TIMEOUT, limits: Optional[Dict[str, int]] = None):
+        self.providers = providers
+        self.limits = limits or {}
+        self._inflight = {p.name: 0 for p in providers}
+        self.hedge_delay = hedge_delay
+        self.timeout = timeout
+        self.breakers = {p.name: CircuitBreaker() for p in providers}
+        self._counters = {p.name: {"started": 0, "wins": 0, "errors": 0, "cancelled": 0, "hedged": 0}
+                          for p in providers}
+        self._metrics = {p.name: StreamMetrics() for p in providers}
+        # Local token count when a provider sends no usage; app.py plugs in its tokenizer
+        self.count_tokens: Callable[[str], int] = _chars_per_token
+        self._lock = threading.Lock()
+
+    def _count(self, provider: Provider, key: str) -> None:
+        with self._lock:
+            self._counters[provider.name][key] += 1
+
+    def _has_room(self, provider: Provider) -> bool:
+        limit = self.limits.get(provider.name)
+        with self._lock:
+            return limit is None or self._inflight[provider.name] < limit
+
+    def _enter(self, provider: Provider) -> None:
+        with self._lock:
+            self._inflight[provider.name] += 1
+
+    def _leave(self, provider: Provider) -> None:
+        with self._lock:
+            self._inflight[provider.name] -= 1
+
+    def _next_provider(self, tried: set, force: bool = False) -> Optional[Provider]:
+        for p in self.providers:
+            if p.name not in tried and self._has_room(p) and self.breakers[p.name].allow():
+                return p
+        if force:
+            # Every breaker is open: still try the preferred provider rather than fail outright
+            for p in self.providers:
+                if p.name not in tried:
+                    return p
+        return None
+
+    def stream(self, messages: List[Dict[str, str]], temperature: float, max_tokens: int,
+               timeout: Optional[float] = None, deadline_at: Optional[float] = None,
+               cancel: Optional[CancelToken] = None, report: Optional[Dict[str, Any]] = None,
+               schema: Optional[Dict[str, Any]] = None) -> Generator[str, None, None]:
+        """Yield content chunks. If `deadline_at` (time.monotonic) is given, the stream is stopped
+        and TimeoutError raised when it is reached, even if the provider is stalled mid-response.
+        Cancelling `cancel` wakes the router at once, closes the provider connections and raises
+        Cancelled. `report`, if given, receives the winning call's metrics (see call_metrics) once
+        the stream has ended, including when it ended in an error or was stopped early.
+        `schema` ({"name", "schema"}) asks each provider for structured output as configured in
+        LLM_RESPONSE_FORMAT; the caller still validates the result."""
+        timeout = timeout or self.timeout
+        if deadline_at is not None:
+            timeout = max(0.1, min(timeout, deadline_at - time.monotonic()))
+        out: "queue.Queue" = queue.Queue()
+        attempts: List[_Attempt] = []
+        tried: set = set()
+        last_error: Optional[Exception] = None
+
+        def start(p: Provider) -> None:
+            a = _Attempt(p, out, messages, temperature, max_tokens, timeout, on_exit=lambda: self._leave(p),
+                         schema=schema)
+            attempts.append(a)
+            tried.add(p.name)
+            self._count(p, "started")
+            self._enter(p)
+            a.start()
+
+        if cancel is not None:
+            cancel.check()
+        first = self._next_provider(tried, force=True)
+        if first is None:
+            raise RuntimeError("No LLM credentials configured. Set MISTRAL_API_KEY or OPENAI_* environment variables.")
+        start(first)
+        unregister = cancel.on_cancel(lambda: out.put((None, "cancel", None))) if cancel is not None else None
+        hedge_at = time.monotonic() + self.hedge_delay if self.hedge_delay > 0 else None
+        winner: Optional[_Attempt] = None
+        first_chunk: Optional[str] = None
+
+        def until_deadline() -> Optional[float]:
+            if deadline_at is None:
+                return None
+            left = deadline_at - time.monotonic()
+            if left <= 0:
+                raise TimeoutError("LLM deadline reached.")
+            return left
+
+        try:
+            # Phase 1: race for the first token
+            while winner is None:
+                live = [a for a in attempts if not a.finished]
+                if not live:
+                    nxt = self._next_provider(tried)
+                    if nxt is None:
+                        raise last_error or RuntimeError("All LLM providers failed.")
+                    start(nxt)
+                    continue
+                wait = until_deadline()
+                if hedge_at is not None:
+                    to_hedge = max(0.0, hedge_at - time.monotonic())
+                    wait = to_hedge if wait is None else min(wait, to_hedge)
+                try:
+                    a, kind, payload = out.get(timeout=wait)
+                except queue.Empty:
+                    if hedge_at is None or time.monotonic() < hedge_at:
+                        continue  # deadline wake-up; until_deadline() raises on the next pass
+                    hedge_at = None
+                    nxt = self._next_provider(tried)
+                    if nxt is not None:
+                        self._count(nxt, "hedged")
+                        start(nxt)
+                    continue
+                if kind == "cancel":
+                    raise Cancelled(cancel.reason)
+                if kind == "token":
+                    winner, first_chunk = a, payload
+                    a.ttft = time.monotonic() - a.started
+                elif kind == "done":
+                    # Finished without content; nothing better will come from racing on
+                    winner = a
+                    a.finished = True
+                    a.ttft = time.monotonic() - a.started
+                else:
+                    a.finished = True
+                    last_error = payload
+                    self._count(a.provider, "errors")
+                    self.breakers[a.provider.name].record(False)
+
+            # Cancel the losers. One that started first and still lost is the slow provider the
+            # hedge was for, so it counts against its breaker; a hedge that lost says nothing.
+            for a in attempts:
+                if a is not winner and not a.finished:
+                    a.cancel()
+                    a.finished = True
+                    self._count(a.provider, "cancelled")
+                    if a.started < winner.started:
+                        self.breakers[a.provider.name].record(False, time.monotonic() - a.started)
+                    else:
+                        self.breakers[a.provider.name].release()
+            self._count(winner.provider, "wins")
+
+            # Phase 2: stream the rest from the winner
+            if first_chunk is not None:
+                yield first_chunk
+            while not winner.finished:
+                try:
+                    a, kind, payload = out.get(timeout=until_deadline())
+                except queue.Empty:
+                    continue
+                if kind == "cancel":
+                    raise Cancelled(cancel.reason)
+                if a is not winner:
+                    continue
+                if kind == "token":
+                    yield payload
+                elif kind == "done":
+                    winner.finished = True
+                else:
+                    winner.finished = True
+                    self._count(winner.provider, "errors")
+                    self.breakers[winner.provider.name].record(False)
+                    winner.meta.setdefault("finish_reason", "error")
+                    raise payload
+            self.breakers[winner.provider.name].record(True, winner.ttft)
+        finally:
+            if winner is not None:
+                if not winner.finished:
+                    winner.meta.setdefault("finish_reason", "cancelled")
+                call = winner.call_metrics(self.count_tokens)
+                with self._lock:
+                    self._metrics[winner.provider.name].add(
+                        call, [b - a for a, b in zip(winner.token_times, winner.token_times[1:])])
+                if report is not None:
+                    report.update(call)
+            # Also reached when the consumer stops iterating (GeneratorExit) or on cancel
+            if unregister is not None:
+                unregister()
+            for a in attempts:
+                if not a.finished:
+                    a.cancel()
+                    a.finished = True
+                    self._count(a.provider, "cancelled")
+                    self.breakers[a.provider.name].release()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            counters = {k: dict(v) for k, v in self._counters.items()}
+            inflight = dict(self._inflight)
+            metrics = {k: m.snapshot() for k, m in self._metrics.items()}
+        return {
+            "hedge_delay": self.hedge_delay,
+            "providers": {
+                p.name: {"model": p.model, "response_format": p.response_format, **counters[p.name], "in_flight": inflight[p.name],
+                         "max_concurrent": self.limits.get(p.name), "breaker": self.breakers[p.name].snapshot(),
+                         "stream": metrics[p.name]}
+                for p in self.providers
+            },
+        }
+
+
+ROUTER = ProviderRouter(configured_providers(),
+                        limits={name: worker_share(n) for name, n in parse_provider_limits(LLM_PROVIDER_CONCURRENCY).items()})
@@ -0,0 +1,104 @@
+# long_note.py
+# Sliding-window retrieval for long notes: E5 truncates at 512 tokens, so long notes are embedded
+# as overlapping windows (one batched encode, one FAISS search) and per-code scores are pooled
+
+import os
+import re
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+# ------------ Config -------------
+LONG_NOTE_MODE = os.environ.get("LONG_NOTE_MODE", "1") == "1"  # 0 = always one vector per note
+WINDOW_TOKENS = int(os.environ.get("WINDOW_TOKENS", "384"))  # tokens per window (E5 limit is 512 incl. prefix)
+WINDOW_STRIDE = int(os.environ.get("WINDOW_STRIDE", "256"))  # step between window starts (overlap = size - stride)
+WINDOW_MAX = int(os.environ.get("WINDOW_MAX", "8"))  # cap per note; windows are spread out to still cover it all
+WINDOW_POOL = os.environ.get("WINDOW_POOL", "max")  # max | mean
+# ---------------------------------
+
+WORD_RE = re.compile(r"\S+")
+
+
+def _token_offsets(text: str, tokenizer) -> List[Tuple[int, int]]:
+    """Character span of every token; falls back to whitespace words without a fast tokenizer."""
+    if tokenizer is not None:
+        try:
+            enc = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)
+            return [tuple(o) for o in enc["offset_mapping"]]
+        except (NotImplementedError, TypeError, KeyError, ValueError):
+            pass
+    return [m.span() for m in WORD_RE.finditer(text)]
+
+
+def window_starts(n_tokens: int, size: int, stride: int, max_windows: int) -> List[int]:
+    if n_tokens <= size:
+        return [0]
+    last = n_tokens - size
+    starts = list(range(0, last, stride)) + [last]
+    if len(starts) > max_windows:
+        # Fewer, less-overlapping windows that still reach the end of the note
+        starts = sorted({int(round(s)) for s in np.linspace(0, last, max(2, max_windows))})
+    return starts
+
+
+def split_windows(text: str, tokenizer, size: int = WINDOW_TOKENS, stride: int = WINDOW_STRIDE,
+                  max_windows: int = WINDOW_MAX) -> List[str]:
+    """Overlapping windows of at most `size` tokens; a short note is returned as-is."""
+    offsets = _token_offsets(text, tokenizer)
+    if len(offsets) <= size:
+        return [text]
+    windows = []
+    for s in window_starts(len(offsets), size, stride, max_windows):
+        end = min(s + size, len(offsets)) - 1
+        windows.append(text[offsets[s][0]:offsets[end][1]])
+    return windows
+
+
+def pool_hits(D: np.ndarray, I: np.ndarray, topn: int, pool: str = WINDOW_POOL) -> List[Tuple[int, float]]:
+    """Combine the per-window FAISS hits of one note into one ranking of (meta index, score).
+    `mean` counts a code missing from a window's top list as 0 for that window."""
+    if len(I) == 1:
+        return [(int(i), float(d)) for d, i in zip(D[0], I[0]) if i >= 0][:topn]
+    scores: Dict[int, float] = {}
+    for drow, irow in zip(D, I):
+        for d, i in zip(drow, irow):
+            if i < 0:
+                continue
+            i = int(i)
+            if pool == "mean":
+                scores[i] = scores.get(i, 0.0) + float(d)
+            else:
+                scores[i] = max(scores.get(i, float("-inf")), float(d))
+    if pool == "mean":
+        scores = {i: s / len(I) for i, s in scores.items()}
+    return sorted(scores.items(), key=lambda kv: -kv[1])[:topn]
+
+
+def windowed_search(notes: List[str], model, index, topn: int, pool: str = WINDOW_POOL,
+                    size: int = WINDOW_TOKENS, stride: int = WINDOW_STRIDE,
+                    max_windows: int = WINDOW_MAX, timings: Optional[Dict[str, tuple]] = None,
+                    note_vectors: Optional[list] = None) -> List[List[Tuple[int, float]]]:
+    """Ranked (meta index, score) per note. All windows of all notes go through one encode call
+    and one FAISS search; notes that fit in one window behave exactly like the single-vector path.
+    `timings`, if given, receives perf_counter (start, end) for 'embed' and 'search'.
+    `note_vectors`, if given, receives one unit vector per note (the normalized window mean)."""
+    t0 = time.perf_counter()
+    tokenizer = getattr(model, "tokenizer", None)
+    windows, groups = [], []
+    for text in notes:
+        w = split_windows(text, tokenizer, size, stride, max_windows)
+        groups.append((len(windows), len(windows) + len(w)))
+        windows.extend(w)
+    qvecs = model.encode([f"query: {w}" for w in windows], convert_to_numpy=True,
+                         normalize_embeddings=True).astype(np.float32)
+    t1 = time.perf_counter()
+    D, I = index.search(qvecs, topn)
+    if timings is not None:
+        timings["embed"] = (t0, t1)
+        timings["search"] = (t1, time.perf_counter())
+    if note_vectors is not None:
+        for a, b in groups:
+            v = qvecs[a:b].mean(axis=0)
+            note_vectors.append(v / max(float(np.linalg.norm(v)), 1e-12))
+    return [pool_hits(D[a:b], I[a:b], topn, pool) for a, b in groups]
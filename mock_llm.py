@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# mock_llm.py
+# Local OpenAI-compatible chat-completions server for benchmarks: simulated prefill/decode timing,
+# a provider-style prefix cache and a cheap lexical "model" that answers in the output schema
+
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Tuple
+
+from prompt_layout import serialize
+
+# ------------ Config -------------
+MOCK_LLM_PORT = int(os.environ.get("MOCK_LLM_PORT", "8089"))
+MOCK_BASE_MS = float(os.environ.get("MOCK_BASE_MS", "120"))  # network + queueing before prefill
+MOCK_PREFILL_MS = float(os.environ.get("MOCK_PREFILL_MS", "0.2"))  # per uncached prompt token
+MOCK_CACHED_PREFILL_MS = float(os.environ.get("MOCK_CACHED_PREFILL_MS", "0.02"))  # per cached prompt token
+MOCK_DECODE_MS = float(os.environ.get("MOCK_DECODE_MS", "15"))  # per output token
+MOCK_CACHE_MIN_TOKENS = int(os.environ.get("MOCK_CACHE_MIN_TOKENS", "1024"))  # shorter prompts are never cached
+MOCK_CACHE_BLOCK = int(os.environ.get("MOCK_CACHE_BLOCK", "128"))  # cache granularity in tokens
+# ---------------------------------
+
+CHARS_PER_TOKEN = 4
+CODE_LINE_RE = re.compile(r"^([A-Z]\d{2})\s*\|\s*([^|\n]+)", re.M)
+NOTE_RE = re.compile(r"<note>\n?(.*?)\n?</note>", re.S)
+WORD_RE = re.compile(r"\w{4,}")
+
+
+class PrefixCache:
+    """Prompt prefixes seen recently, hashed per block like provider KV caches: a request reuses the
+    longest run of leading blocks identical to an earlier prompt, and only when at least
+    `min_tokens` long."""
+
+    def __init__(self, min_tokens: int = MOCK_CACHE_MIN_TOKENS, block: int = MOCK_CACHE_BLOCK,
+                 capacity: int = 100_000):
+        self.min_tokens = min_tokens
+        self.block_chars = block * CHARS_PER_TOKEN
+        self.capacity = capacity
+        self._blocks: "OrderedDict[str, None]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup_and_add(self, text: str) -> int:
+        """Cached tokens for this prompt; its blocks are remembered for later ones."""
+        h = hashlib.sha1()
+        keys = []
+        for i in range(len(text) // self.block_chars):
+            h.update(text[i * self.block_chars:(i + 1) * self.block_chars].encode("utf-8"))
+            keys.append(h.hexdigest())  # hash of the whole prefix up to this block
+        cached = 0
+        with self._lock:
+            for k in keys:
+                if k not in self._blocks:
+                    break
+                cached += 1
+            for k in keys:
+                self._blocks[k] = None
+                self._blocks.move_to_end(k)
+            while len(self._blocks) > self.capacity:
+                self._blocks.popitem(last=False)
+        tokens = cached * self.block_chars // CHARS_PER_TOKEN
+        return tokens if tokens >= self.min_tokens else 0
+
+
+def _stems(text: str) -> Dict[str, str]:
+    return {w.lower()[:5]: w for w in WORD_RE.findall(text)}
+
+
+def answer(messages: List[Dict[str, str]]) -> str:
+    """Up to three offered codes whose title shares word stems with the note, in the schema the
+    system prompt asks for. A plumbing stand-in, not a coding model: its accuracy only shows that
+    the right codes reached the prompt."""
+    text = "\n".join(m["content"] for m in messages)
+    m = NOTE_RE.search(messages[-1]["content"]) or NOTE_RE.search(text)
+    note = m.group(1) if m else messages[-1]["content"]
+    note_stems = _stems(note)
+    scored: List[Tuple[int, int, str, str, str]] = []
+    for pos, line in enumerate(CODE_LINE_RE.finditer(text)):
+        code, title = line.group(1), line.group(2).strip()
+        shared = [note_stems[s] for s in _stems(title) if s in note_stems]
+        if shared:
+            scored.append((-len(shared), pos, code, title, shared[0]))
+    scored.sort()
+    compact = '"evidence": [' in messages[0]["content"]
+    top = []
+    for i, (_, _, code, title, quote) in enumerate(scored[:3]):
+        confidence = round(0.9 - 0.2 * i, 2)
+        if compact:
+            top.append({"code": code, "confidence": confidence, "evidence": [quote], "needs_review": False})
+        else:
+            number = int(code[1:])
+            component = 1 if number < 30 else 7 if number >= 70 else None
+            top.append({"code": code, "title": title, "component": component, "confidence": confidence,
+                        "evidence_spans": [{"text": quote}], "needs_review": False})
+    return json.dumps({"top_k": top, "notes": ""}, ensure_ascii=False)
+
+
+class MockLLM:
+    def __init__(self, port: int = MOCK_LLM_PORT, cache: PrefixCache = None):
+        self.port = port
+        self.cache = cache or PrefixCache()
+        self.requests = 0
+        self._server = None
+
+    def handle(self, body: Dict) -> Tuple[List[str], Dict, float, str]:
+        """(output pieces, usage, prefill seconds, finish reason) for one request."""
+        prompt = serialize(body.get("messages", []))
+        prompt_tokens = (len(prompt) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+        cached = self.cache.lookup_and_add(prompt)
+        prefill = (MOCK_BASE_MS + (prompt_tokens - cached) * MOCK_PREFILL_MS + cached * MOCK_CACHED_PREFILL_MS) / 1000
+        content = answer(body.get("messages", []))
+        pieces = [content[i:i + CHARS_PER_TOKEN] for i in range(0, len(content), CHARS_PER_TOKEN)]
+        finish_reason = "length" if len(pieces) > int(body.get("max_tokens") or len(pieces)) else "stop"
+        pieces = pieces[:max(1, int(body.get("max_tokens") or len(pieces)))]
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(pieces),
+                 "total_tokens": prompt_tokens + len(pieces),
+                 "prompt_tokens_details": {"cached_tokens": cached}}
+        self.requests += 1
+        return pieces, usage, prefill, finish_reason
+
+    def serve(self, background: bool = False) -> None:
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                if not self.path.endswith("/chat/completions"):
+                    self.send_error(404)
+                    return
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                pieces, usage, prefill, finish_reason = mock.handle(body)
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                time.sleep(prefill)
+                send = lambda data: self.wfile.write(f"data: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8"))
+                try:
+                    for i, piece in enumerate(pieces):
+                        if i:
+                            time.sleep(MOCK_DECODE_MS / 1000)
+                        send({"choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]})
+                        self.wfile.flush()
+                    send({"choices": [{"index": 0, "delta": {}, "finish_reason": finish_reason}], "usage": usage})
+                    self.wfile.write(b"data: [DONE]\n\n")
+                    self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # client cancelled
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", self.port), Handler)
+        self._server.daemon_threads = True
+        if background:
+            threading.Thread(target=self._server.serve_forever, name="mock-llm", daemon=True).start()
+        else:
+            print(f"🧪 Mock-LLM på http://127.0.0.1:{self.port}/v1 (OPENAI_BASE, OPENAI_MODEL=mock, OPENAI_API_KEY=mock)")
+            self._server.serve_forever()
+
+    def shutdown(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+
+
+if __name__ == "__main__":
+    MockLLM().serve()
@@ -0,0 +1,272 @@
+# model_registry.py
+# Several (embedding model, index, metadata) sets side by side: lazy loading with memory
+# accounting, weighted / header-based routing for A/B tests, and shadow retrieval off the hot path
+
+import os
+import json
+import time
+import queue
+import random
+import threading
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from index_store import IndexStore, IndexVersion
+
+# ------------ Config -------------
+MODEL_REGISTRY = os.environ.get("MODEL_REGISTRY", "models.json")  # extra model sets; missing file = primary only
+REGISTRY_MAX_BYTES = int(float(os.environ.get("REGISTRY_MAX_BYTES", "4e9")))  # loaded sets beyond this are evicted (LRU)
+SHADOW_SET = os.environ.get("SHADOW_SET", "")  # model set that shadows every sampled request; empty = off
+SHADOW_SAMPLE_RATE = float(os.environ.get("SHADOW_SAMPLE_RATE", "1.0"))  # fraction of requests shadowed
+SHADOW_LOG = os.environ.get("SHADOW_LOG", "shadow.jsonl")  # one line per shadow comparison; empty = stats only
+SHADOW_QUEUE = int(os.environ.get("SHADOW_QUEUE", "64"))  # pending shadow runs; more are dropped
+# ---------------------------------
+
+PRIMARY = "default"
+OVERLAP_K = 10
+
+
+def _pct(values, q: float) -> Optional[float]:
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(q * len(values)))], 3) if values else None
+
+
+def model_bytes(model) -> int:
+    """Parameter memory of a SentenceTransformer (torch module)."""
+    try:
+        return sum(p.numel() * p.element_size() for p in model.parameters())
+    except AttributeError:
+        return 0
+
+
+def version_bytes(v: IndexVersion) -> int:
+    n = 0
+    if v.index is not None:
+        n += int(v.index.ntotal) * int(v.index.d) * 4  # flat float32 codes
+    if v.neighbors is not None:
+        n += v.neighbors.ids.nbytes + v.neighbors.scores.nbytes
+    return n
+
+
+class ModelSet:
+    def __init__(self, name: str, spec: Dict[str, Any], weight: float):
+        self.name = name
+        self.spec = spec
+        self.weight = weight
+        self.model = None
+        self.store: Optional[IndexStore] = None
+        self.bytes = 0
+        self.loads = 0
+        self.requests = 0
+        self.last_used = 0.0
+        self.load_lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self.store is not None
+
+    @property
+    def model_id(self) -> str:
+        return self.spec.get("model") or self.spec.get("bundle") or self.name
+
+
+class ShadowStats:
+    def __init__(self, history: int = 1000):
+        self.runs = 0
+        self.dropped = 0
+        self.errors = 0
+        self.served_ms = deque(maxlen=history)
+        self.shadow_ms = deque(maxlen=history)
+        self.overlap = deque(maxlen=history)
+        self.top1_agree = deque(maxlen=history)
+
+    def summary(self) -> Dict[str, Any]:
+        mean = lambda xs: round(sum(xs) / len(xs), 4) if xs else None
+        return {
+            "runs": self.runs, "dropped": self.dropped, "errors": self.errors,
+            "served_ms": {"p50": _pct(self.served_ms, 0.5), "p95": _pct(self.served_ms, 0.95)},
+            "shadow_ms": {"p50": _pct(self.shadow_ms, 0.5), "p95": _pct(self.shadow_ms, 0.95)},
+            f"overlap_at_{OVERLAP_K}": mean(self.overlap),
+            "top1_agreement": mean(self.top1_agree),
+        }
+
+
+class ModelRegistry:
+    """The primary set (the app's own model + IndexStore) plus extra sets from MODEL_REGISTRY:
+
+        {"sets": [{"name": "e5-small", "model": "intfloat/multilingual-e5-small",
+                   "index": "e5small.faiss", "meta": "e5small_meta.json", "weight": 0.1},
+                  {"name": "e5-base-q", "bundle": "bundles/e5-base-f16/current", "weight": 0}],
+         "primary_weight": 0.9}
+
+    Extra sets load on first use (model and IndexStore, like the primary). Loaded sets are
+    accounted by parameter + index memory; beyond `max_bytes` the least recently used idle extra
+    set is unloaded. A request picks a set by `X-Model-Set` / `model_set`, else at random by
+    weight. The shadow set reruns retrieval for a sample of requests on a background thread and
+    records latency and candidate overlap against the set that served the request.
+    """
+
+    def __init__(self, path: str = MODEL_REGISTRY, max_bytes: int = REGISTRY_MAX_BYTES,
+                 shadow: str = SHADOW_SET, shadow_rate: float = SHADOW_SAMPLE_RATE, shadow_log: str = SHADOW_LOG,
+                 prepare: Optional[Callable[[IndexVersion], None]] = None):
+        self.max_bytes = max_bytes
+        self.prepare = prepare
+        self.sets: Dict[str, ModelSet] = {}
+        self.primary_weight = 1.0
+        self._lock = threading.Lock()
+        self.evictions = 0
+        self.shadow = shadow
+        self.shadow_rate = shadow_rate
+        self.shadow_log = shadow_log
+        self.shadow_stats: Dict[str, ShadowStats] = {}
+        self._shadow_queue: "queue.Queue" = queue.Queue(maxsize=SHADOW_QUEUE)
+        self._shadow_thread: Optional[threading.Thread] = None
+        self._log_lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                config = json.load(f)
+            self.primary_weight = float(config.get("primary_weight", 1.0))
+            for spec in config.get("sets", []):
+                self.sets[spec["name"]] = ModelSet(spec["name"], spec, float(spec.get("weight", 0)))
+
+    def add_primary(self, model, store: IndexStore) -> None:
+        s = ModelSet(PRIMARY, {"model": store.model_id}, self.primary_weight)
+        s.model, s.store = model, store
+        s.bytes = model_bytes(model) + version_bytes(store.current())
+        self.sets[PRIMARY] = s
+
+    # --- routing ---
+
+    def route(self, requested: Optional[str] = None) -> Optional[str]:
+        """Name of the set for a request; None if `requested` names an unknown set."""
+        if requested:
+            return requested if requested in self.sets else None
+        names = [n for n, s in self.sets.items() if s.weight > 0]
+        if not names:
+            return PRIMARY
+        return random.choices(names, weights=[self.sets[n].weight for n in names])[0]
+
+    # --- loading / use ---
+
+    def _load(self, s: ModelSet) -> None:
+        spec = s.spec
+        t0 = time.perf_counter()
+        if spec.get("bundle"):
+            from bundle import read_manifest, load_model
+            root = os.path.realpath(spec["bundle"])
+            manifest = read_manifest(root)
+            model, model_id = load_model(root, manifest), manifest["model"]
+        else:
+            from sentence_transformers import SentenceTransformer
+            model, model_id = SentenceTransformer(spec["model"]), spec["model"]
+        store = IndexStore(spec.get("index", ""), spec.get("meta", ""), model_id,
+                           model.get_sentence_embedding_dimension(), manifest_path=spec.get("manifest", ""),
+                           prepare=self.prepare, bundle_path=spec.get("bundle", ""),
+                           neighbors_path=spec.get("neighbors", ""))
+        store.load_initial()
+        with self._lock:
+            s.model, s.store = model, store
+            s.bytes = model_bytes(model) + version_bytes(store.current())
+            s.loads += 1
+        print(f"✅ Modellsett {s.name} lastet ({s.bytes / 1e6:.0f} MB, {time.perf_counter() - t0:.1f}s)")
+
+    def acquire(self, name: str = PRIMARY) -> Tuple[ModelSet, IndexVersion]:
+        """The set (loaded if needed) and its current index version, held until release()."""
+        s = self.sets[name]
+        while True:
+            if not s.loaded:
+                with s.load_lock:
+                    if not s.loaded:
+                        self._load(s)
+                self._evict(keep=s)
+            with self._lock:
+                if s.store is None:  # evicted between loading and now
+                    continue
+                version = s.store.acquire()
+                s.requests += 1
+                s.last_used = time.monotonic()
+                return s, version
+
+    def release(self, s: ModelSet, version: IndexVersion) -> None:
+        s.store.release(version)  # a set with any version in flight (retired ones too) is never evicted
+
+    def _evict(self, keep: ModelSet) -> None:
+        with self._lock:
+            total = sum(s.bytes for s in self.sets.values() if s.loaded)
+            idle = sorted((s for s in self.sets.values()
+                           if s.loaded and s is not keep and s.name != PRIMARY and s.store.in_flight == 0),
+                          key=lambda s: s.last_used)
+            dropped = []
+            while total > self.max_bytes and idle:
+                s = idle.pop(0)
+                total -= s.bytes
+                dropped.append((s, s.store))
+                s.model, s.store, s.bytes = None, None, 0
+                self.evictions += 1
+        for s, store in dropped:
+            store.current().close()
+            print(f"♻️ Modellsett {s.name} avlastet (minnegrense {self.max_bytes / 1e9:.1f} GB)")
+
+    # --- shadow ---
+
+    def submit_shadow(self, served: str, note_text: str, codes: List[str], served_ms: float,
+                      retrieve: Callable[[str, Any, IndexVersion], List[str]]) -> None:
+        """Queue a shadow retrieval for this request (never blocks; dropped when the queue is full).
+        `retrieve(note_text, model, version)` returns ranked codes."""
+        if not self.shadow or self.shadow == served or self.shadow not in self.sets:
+            return
+        if random.random() >= self.shadow_rate:
+            return
+        stats = self.shadow_stats.setdefault(self.shadow, ShadowStats())
+        try:
+            self._shadow_queue.put_nowait((served, note_text, codes, served_ms, retrieve))
+        except queue.Full:
+            stats.dropped += 1
+            return
+        if self._shadow_thread is None:
+            self._shadow_thread = threading.Thread(target=self._shadow_loop, name="shadow", daemon=True)
+            self._shadow_thread.start()
+
+    def _shadow_loop(self) -> None:
+        while True:
+            served, note_text, codes, served_ms, retrieve = self._shadow_queue.get()
+            stats = self.shadow_stats[self.shadow]
+            try:
+                s, version = self.acquire(self.shadow)
+                try:
+                    t0 = time.perf_counter()
+                    shadow_codes = retrieve(note_text, s.model, version)
+                    shadow_ms = (time.perf_counter() - t0) * 1000
+                finally:
+                    self.release(s, version)
+            except Exception as e:
+                stats.errors += 1
+                print(f"⚠️ Skyggesøk feilet ({self.shadow}): {e}")
+                continue
+            overlap = len(set(codes[:OVERLAP_K]) & set(shadow_codes[:OVERLAP_K])) / max(1, min(OVERLAP_K, len(codes)))
+            agree = float(bool(codes) and bool(shadow_codes) and codes[0] == shadow_codes[0])
+            stats.runs += 1
+            stats.served_ms.append(served_ms)
+            stats.shadow_ms.append(shadow_ms)
+            stats.overlap.append(overlap)
+            stats.top1_agree.append(agree)
+            if self.shadow_log:
+                line = json.dumps({"ts": time.time(), "served": served, "shadow": self.shadow,
+                                   "served_ms": round(served_ms, 3), "shadow_ms": round(shadow_ms, 3),
+                                   f"overlap_at_{OVERLAP_K}": round(overlap, 4), "top1_agree": bool(agree),
+                                   "served_top": codes[:OVERLAP_K], "shadow_top": shadow_codes[:OVERLAP_K]},
+                                  ensure_ascii=False)
+                with self._log_lock:
+                    with open(self.shadow_log, "a", encoding="utf-8") as f:
+                        f.write(line + "\n")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            sets = {n: {"model": s.model_id, "weight": s.weight, "loaded": s.loaded,
+                        "mb": round(s.bytes / 1e6, 1), "loads": s.loads, "requests": s.requests,
+                        "index_version": s.store.current().version if s.loaded else None}
+                    for n, s in self.sets.items()}
+            loaded = sum(s.bytes for s in self.sets.values() if s.loaded)
+        return {"sets": sets, "loaded_mb": round(loaded / 1e6, 1), "max_mb": round(self.max_bytes / 1e6, 1),
+                "evictions": self.evictions, "shadow": self.shadow or None,
+                "shadow_stats": {n: st.summary() for n, st in self.shadow_stats.items()}}
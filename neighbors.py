@@ -0,0 +1,122 @@
+# neighbors.py
+# Precomputed code-to-code neighbor graph: local `alternatives` for suggestions (no LLM output
+# tokens, never outside the code set) and optional candidate expansion around a small top-N
+
+import os
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from icpc_utils import ICPCEntry
+
+# ------------ Config -------------
+NEIGHBORS_PATH = os.environ.get("NEIGHBORS_PATH", "icpc2_neighbors.npz")  # written by build_index.py
+NEIGHBORS_K = int(os.environ.get("NEIGHBORS_K", "8"))  # neighbors stored per code
+ALTERNATIVES_MAX = int(os.environ.get("ALTERNATIVES_MAX", "3"))  # alternatives filled in per suggestion
+NEIGHBOR_EXPAND = int(os.environ.get("NEIGHBOR_EXPAND", "0"))  # retrieve this many and expand with neighbors; 0 = off
+# ---------------------------------
+
+
+def _cross_component_match(vecs: np.ndarray, entries: List[ICPCEntry]) -> Dict[int, int]:
+    """Row -> most similar row in the same chapter on the other side of the symptom/diagnosis split
+    (component 1 <-> 7), e.g. a complaint and the diagnosis it most often turns into."""
+    by_chapter: Dict[Tuple[str, int], List[int]] = {}
+    for i, e in enumerate(entries):
+        if e.component_guess in (1, 7):
+            by_chapter.setdefault((e.chapter, e.component_guess), []).append(i)
+    match = {}
+    for (chapter, comp), rows in by_chapter.items():
+        other = by_chapter.get((chapter, 8 - comp))
+        if not other:
+            continue
+        sims = vecs[rows] @ vecs[other].T
+        for r, j in zip(rows, sims.argmax(axis=1)):
+            match[r] = other[int(j)]
+    return match
+
+
+def build_graph(vecs: np.ndarray, entries: List[ICPCEntry], k: int = NEIGHBORS_K) -> Tuple[np.ndarray, np.ndarray]:
+    """(ids int32 [n, k], scores float16 [n, k]) from normalized code vectors: the k most similar
+    codes, with the last slot reserved for the cross-component match when it is not already among
+    them. Unused slots are -1."""
+    import faiss
+
+    vecs = np.ascontiguousarray(vecs, dtype=np.float32)
+    n = len(entries)
+    index = faiss.IndexFlatIP(vecs.shape[1])
+    index.add(vecs)
+    D, I = index.search(vecs, min(k + 1, n))
+    ids = np.full((n, k), -1, dtype=np.int32)
+    scores = np.zeros((n, k), dtype=np.float16)
+    match = _cross_component_match(vecs, entries)
+    for r in range(n):
+        row = [(int(j), float(d)) for d, j in zip(D[r], I[r]) if j >= 0 and j != r][:k]
+        m = match.get(r)
+        if m is not None and all(j != m for j, _ in row):
+            row = row[:k - 1] + [(m, float(vecs[r] @ vecs[m]))]
+        for c, (j, d) in enumerate(row):
+            ids[r, c], scores[r, c] = j, d
+    return ids, scores
+
+
+def save_graph(path: str, ids: np.ndarray, scores: np.ndarray, codes: List[str]) -> None:
+    with open(path, "wb") as f:  # a file object: np.savez would append .npz to the name
+        np.savez(f, ids=ids, scores=scores, codes=np.array(codes))
+
+
+class NeighborGraph:
+    """Neighbor rows for every code of one index version (rows = metadata positions)."""
+
+    def __init__(self, ids: np.ndarray, scores: np.ndarray, meta: List[ICPCEntry]):
+        self.ids = ids
+        self.scores = scores
+        self.meta = meta
+        self.rows = {e.code: i for i, e in enumerate(meta)}
+
+    @classmethod
+    def load(cls, path: str, meta: List[ICPCEntry]) -> "NeighborGraph":
+        """Raises ValueError if the file was built for another code list."""
+        with np.load(path) as z:
+            ids, scores, codes = z["ids"], z["scores"], z["codes"]
+        if len(codes) != len(meta) or any(str(c) != e.code for c, e in zip(codes, meta)):
+            raise ValueError(f"{path} er bygget for en annen kodeliste")
+        return cls(ids, scores, meta)
+
+    @classmethod
+    def from_index(cls, index, meta: List[ICPCEntry], k: int = NEIGHBORS_K) -> "NeighborGraph":
+        """Fallback when no graph file was built: the flat index holds the code vectors."""
+        vecs = index.reconstruct_n(0, index.ntotal)
+        ids, scores = build_graph(vecs, meta, k)
+        return cls(ids, scores, meta)
+
+    def neighbors(self, code: str) -> List[str]:
+        r = self.rows.get(code)
+        if r is None:
+            return []
+        return [self.meta[j].code for j in self.ids[r] if j >= 0]
+
+    def alternatives(self, code: str, exclude=(), limit: int = ALTERNATIVES_MAX) -> List[str]:
+        return [c for c in self.neighbors(code) if c not in exclude][:limit]
+
+    def fill_alternatives(self, obj: Dict, limit: int = ALTERNATIVES_MAX) -> Dict:
+        """Replace the suggestions' `alternatives` with graph neighbors, skipping codes that are
+        already suggested."""
+        items = [i for i in obj.get("top_k", []) if isinstance(i, dict)]
+        suggested = {i.get("code") for i in items}
+        for item in items:
+            item["alternatives"] = self.alternatives(item.get("code"), suggested, limit)
+        return obj
+
+    def expand(self, rows: List[int], limit: int) -> List[int]:
+        """A small retrieved top-N (best first) grown to `limit` rows: the seeds, then every seed's
+        nearest neighbor in seed order, then the second nearest, and so on; duplicates dropped."""
+        out, seen = list(rows), set(rows)
+        for depth in range(self.ids.shape[1]):
+            for r in rows:
+                if len(out) >= limit:
+                    return out
+                j = int(self.ids[r, depth])
+                if j >= 0 and j not in seen:
+                    seen.add(j)
+                    out.append(j)
+        return out[:limit]
@@ -0,0 +1,55 @@
+# procmem.py
+# Memory of this process and its worker processes from /proc (Linux): what is really private
+# per worker and what is still shared copy-on-write with the preloading master
+
+import os
+from typing import Any, Dict, List
+
+SMAPS_FIELDS = {"Rss": "rss", "Pss": "pss", "Shared_Clean": "shared_clean", "Shared_Dirty": "shared_dirty",
+                "Private_Clean": "private_clean", "Private_Dirty": "private_dirty", "Swap": "swap"}
+
+
+def memory(pid: int = 0) -> Dict[str, Any]:
+    """MB of one process. `pss` counts shared pages divided by the number of processes sharing
+    them, so the sum of pss over master + workers is the real footprint; `private` is what a
+    worker has copied (or allocated) for itself."""
+    pid = pid or os.getpid()
+    out: Dict[str, Any] = {"pid": pid}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup", "r") as f:
+            for line in f:
+                key, _, rest = line.partition(":")
+                if key in SMAPS_FIELDS:
+                    out[SMAPS_FIELDS[key]] = round(int(rest.split()[0]) / 1024, 1)
+    except OSError:
+        try:  # kernels before 4.14 have no smaps_rollup: RSS only
+            with open(f"/proc/{pid}/status", "r") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        out["rss"] = round(int(line.split()[1]) / 1024, 1)
+        except OSError:
+            import resource  # not Linux: peak RSS of this process (kB on Linux, bytes on macOS)
+            if pid == os.getpid():
+                out["max_rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return out
+    if "private_dirty" in out:
+        out["shared"] = round(out.pop("shared_clean") + out.pop("shared_dirty"), 1)
+        out["private"] = round(out.pop("private_clean") + out.pop("private_dirty"), 1)
+    return out
+
+
+def children(pid: int) -> List[int]:
+    """Direct child processes (the workers of a master)."""
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children", "r") as f:
+            return [int(p) for p in f.read().split()]
+    except OSError:
+        return []
+
+
+def report(master: int) -> Dict[str, Any]:
+    """Master + every worker, and the totals: `rss_sum` is what naive monitoring adds up,
+    `pss_sum` what the machine actually spends."""
+    procs = [dict(memory(master), role="master")] + [dict(memory(p), role="worker") for p in children(master)]
+    total = lambda k: round(sum(p.get(k, 0) for p in procs), 1)
+    return {"processes": procs, "workers": len(procs) - 1, "rss_sum": total("rss"), "pss_sum": total("pss")}
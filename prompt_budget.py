@@ -0,0 +1,254 @@
+# prompt_budget.py
+# Token-budgeted prompt building: cached grounding lines, local token counting, candidate trimming
+# and section-aware note truncation
+
+import os
+import re
+import time
+from os.path import commonprefix
+from typing import Callable, Dict, List, Any, Optional, Tuple
+
+from icpc_utils import ICPCEntry
+from prompt_layout import serialize
+
+try:  # optional; the embedding model's tokenizer or a char estimate is used otherwise
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# ------------ Config -------------
+PROMPT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", "3000"))  # whole prompt; 0 = no limit
+PROMPT_MIN_CANDIDATES = int(os.environ.get("PROMPT_MIN_CANDIDATES", "10"))  # never trim below this many
+PROMPT_TOKENIZER = os.environ.get("PROMPT_TOKENIZER", "auto")  # auto | tiktoken | embedding | chars
+# ---------------------------------
+
+SECTION_RE = re.compile(r"^\s*(anamnese|status|funn|us|vurdering|plan|tiltak|konklusjon)\s*:", re.I | re.M)
+# Truncated first -> last. What the clinician concluded matters most for coding.
+SECTION_PRIORITY = {"": 0, "status": 1, "funn": 1, "us": 1, "anamnese": 2, "plan": 3, "tiltak": 3,
+                    "vurdering": 4, "konklusjon": 4}
+SENTENCE_RE = re.compile(r"(?<=[.!?;\n])(\s+)")  # captures the separators, so line breaks survive a split
+TRUNCATION_MARK = " […]"
+
+
+class TokenCounter:
+    """Counts tokens locally. The LLM's own tokenizer isn't available offline, so this uses
+    tiktoken when installed, else the (already loaded) embedding model's tokenizer, else chars/4."""
+
+    def __init__(self, kind: str = PROMPT_TOKENIZER, hf_tokenizer=None):
+        self._encode: Optional[Callable[[str], list]] = None
+        self.name = "chars/4"
+        if kind in ("auto", "tiktoken") and tiktoken is not None:
+            enc = tiktoken.get_encoding("cl100k_base")
+            self._encode = enc.encode
+            self.name = "tiktoken:cl100k_base"
+        elif kind in ("auto", "embedding") and hf_tokenizer is not None:
+            self._encode = lambda text: hf_tokenizer.encode(text, add_special_tokens=False)
+            self.name = f"hf:{getattr(hf_tokenizer, 'name_or_path', 'embedding')}"
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        if self._encode is None:
+            return (len(text) + 3) // 4
+        return len(self._encode(text))
+
+
+def grounding_line(e: ICPCEntry) -> str:
+    comp = e.component_guess if e.component_guess is not None else e.component_hint
+    return f"{e.code} | {e.title} | component:{comp} | chapter:{e.chapter}"
+
+
+class GroundingCache:
+    """Every entry's candidate line and its token count, computed once at load time."""
+
+    def __init__(self, entries: List[ICPCEntry], counter: TokenCounter):
+        self.lines: Dict[str, str] = {}
+        self.tokens: Dict[str, int] = {}
+        for e in entries:
+            line = grounding_line(e)
+            self.lines[e.code] = line
+            self.tokens[e.code] = counter.count(line) + 1  # + newline
+
+    def line(self, e: ICPCEntry) -> str:
+        line = self.lines.get(e.code)
+        return line if line is not None else grounding_line(e)
+
+    def format(self, entries: List[ICPCEntry]) -> str:
+        return "\n".join(self.line(e) for e in entries)
+
+
+def split_sections(note_text: str) -> List[Tuple[str, str]]:
+    """(section name, text incl. header) in note order; text before the first header has name ''."""
+    starts = [(m.start(), m.group(1).lower()) for m in SECTION_RE.finditer(note_text)]
+    if not starts or starts[0][0] > 0:
+        starts.insert(0, (0, ""))
+    out = []
+    for i, (pos, name) in enumerate(starts):
+        end = starts[i + 1][0] if i + 1 < len(starts) else len(note_text)
+        chunk = note_text[pos:end]
+        if chunk.strip():
+            out.append((name, chunk))
+    return out
+
+
+def _fit_prefix(text: str, fits: Callable[[str], bool]) -> str:
+    """Longest prefix of `text` (cut at a character, trailing space dropped) for which `fits` holds,
+    or "" if none does. Binary search: only used on the rare oversized sentence."""
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if fits(text[:mid].rstrip()):
+            lo = mid
+        else:
+            hi = mid - 1
+    return text[:lo].rstrip()
+
+
+def truncate_note(note_text: str, budget: int, counter: TokenCounter) -> str:
+    """Fit the note into `budget` tokens. Trailing sentences are dropped first, lowest-priority
+    section first, until every section is down to its header and first sentence. Only then is a
+    first sentence cut short, again lowest priority first; headers are never removed. The
+    truncation marks count against the budget, and line breaks inside sections are kept."""
+    if counter.count(note_text) <= budget:
+        return note_text
+    sections = []
+    for name, chunk in split_sections(note_text):
+        body = chunk.rstrip()
+        parts = SENTENCE_RE.split(body)  # sentence, separator, sentence, ...
+        pieces = [sentence + sep for sentence, sep in zip(parts[0::2], parts[1::2] + [""])]
+        # A header on its own line ("Plan:\n...") doesn't count as the kept first sentence
+        floor = 2 if len(pieces) > 1 and pieces[0].strip().endswith(":") else 1
+        header = SECTION_RE.match(body)
+        sections.append({"name": name, "pieces": pieces, "floor": floor, "tail": chunk[len(body):], "cut": False,
+                         "header": header.end() if header and floor == 1 else 0})
+
+    def assemble() -> str:
+        return "".join("".join(sec["pieces"]).rstrip() + (TRUNCATION_MARK if sec["cut"] else "") + sec["tail"]
+                       for sec in sections)
+
+    order = sorted(range(len(sections)), key=lambda i: SECTION_PRIORITY.get(sections[i]["name"], 0))
+    fits = lambda t: counter.count(t) <= budget
+
+    # 1. Whole trailing sentences, lowest-priority section first: on estimated sizes (cheap), then
+    #    by the real count in case the estimates were low
+    sizes = [[counter.count(p) + 1 for p in sec["pieces"]] for sec in sections]
+    total = sum(map(sum, sizes))
+    for i in order:
+        sec = sections[i]
+        while total > budget and len(sec["pieces"]) > sec["floor"]:
+            sec["pieces"].pop()
+            total -= sizes[i].pop()
+            sec["cut"] = True
+    for i in order:
+        sec = sections[i]
+        while len(sec["pieces"]) > sec["floor"] and not fits(assemble()):
+            sec["pieces"].pop()
+            sec["cut"] = True
+    if fits(assemble()):
+        return assemble()
+
+    # 2. Last resort: cut the kept first sentences short, lowest priority first, keeping the header
+    for i in order:
+        sec = sections[i]
+        before, last = sec["pieces"][:-1], sec["pieces"][-1]
+        head, rest = last[:sec["header"]], last[sec["header"]:]
+        sec["cut"] = True
+
+        def with_prefix(prefix: str) -> str:
+            sec["pieces"] = before + [head + prefix]
+            return assemble()
+
+        if fits(with_prefix(_fit_prefix(rest, lambda p: fits(with_prefix(p))))):
+            return assemble()
+    # Even the headers alone exceed the budget
+    if not fits(TRUNCATION_MARK):
+        return ""
+    return _fit_prefix(note_text, lambda t: fits(t + TRUNCATION_MARK)) + TRUNCATION_MARK
+
+
+class PromptBuilder:
+    """Builds the chat messages so the whole prompt stays within `budget` tokens.
+
+    Candidates arrive best-first from retrieval; the lowest-ranked are trimmed first, down to
+    `min_candidates`. If the note alone does not fit next to those, it is truncated section-aware.
+    A template's `budget_exempt` text (the full codebook, billed as a cached prefix) is left out of
+    the budget.
+    """
+
+    def __init__(self, cache: GroundingCache, counter: TokenCounter, budget: int = PROMPT_TOKEN_BUDGET,
+                 min_candidates: int = PROMPT_MIN_CANDIDATES):
+        self.cache = cache
+        self.counter = counter
+        self.budget = budget
+        self.min_candidates = min_candidates
+        self._overhead: Dict[Callable, int] = {}
+        self._static: Dict[Callable, int] = {}
+        self._exempt: Dict[Callable, int] = {}
+
+    def overhead(self, build_messages: Callable) -> int:
+        """Tokens of the fixed parts (system prompt, instructions, tags), per message template."""
+        if build_messages not in self._overhead:
+            messages = build_messages("", "")
+            self._overhead[build_messages] = sum(self.counter.count(m["content"]) + 4 for m in messages)
+        return self._overhead[build_messages]
+
+    def static_prefix(self, build_messages: Callable) -> int:
+        """Tokens of the byte-identical prefix every prompt of this template starts with: what a
+        provider's prefix cache can reuse between requests."""
+        if build_messages not in self._static:
+            a = serialize(build_messages("a", "A01 | a"))
+            b = serialize(build_messages("b", "B01 | b"))
+            self._static[build_messages] = self.counter.count(commonprefix([a, b]))
+        return self._static[build_messages]
+
+    def exempt(self, build_messages: Callable) -> int:
+        """Tokens a template keeps outside the budget (prompt_layout.Codebook's code list)."""
+        if build_messages not in self._exempt:
+            self._exempt[build_messages] = self.counter.count(getattr(build_messages, "budget_exempt", ""))
+        return self._exempt[build_messages]
+
+    def build(self, note_text: str, entries: List[ICPCEntry], build_messages: Callable,
+              timings: Optional[Dict[str, tuple]] = None
+              ) -> Tuple[List[Dict[str, str]], List[ICPCEntry], Dict[str, Any]]:
+        """(messages, candidates used, token report). `timings`, if given, receives perf_counter
+        (start, end) for 'fit_budget', 'format_grounding' and 'build_messages'."""
+        t0 = time.perf_counter()
+        fixed = self.overhead(build_messages)
+        exempt = self.exempt(build_messages)
+        note_tokens = self.counter.count(note_text)
+        cand_tokens = [self.cache.tokens.get(e.code) or self.counter.count(self.cache.line(e)) + 1 for e in entries]
+        used_note, used = note_text, entries
+        if self.budget:
+            keep_min = min(self.min_candidates, len(entries))
+            note_budget = self.budget - fixed + exempt - sum(cand_tokens[:keep_min])
+            if note_tokens > note_budget:
+                used_note = truncate_note(note_text, max(1, note_budget), self.counter)
+            room = self.budget - fixed + exempt - self.counter.count(used_note)
+            n = 0
+            while n < len(entries) and (n < keep_min or cand_tokens[n] <= room):
+                room -= cand_tokens[n]
+                n += 1
+            used = entries[:n]
+        t1 = time.perf_counter()
+        grounding = self.cache.format(used)
+        t2 = time.perf_counter()
+        messages = build_messages(used_note, grounding)
+        if timings is not None:
+            timings["fit_budget"] = (t0, t1)
+            timings["format_grounding"] = (t1, t2)
+            timings["build_messages"] = (t2, time.perf_counter())
+        used_note_tokens = note_tokens if used_note is note_text else self.counter.count(used_note)
+        report = {
+            "prompt_tokens": fixed + used_note_tokens + sum(cand_tokens[:len(used)]),
+            "budget": self.budget or None,
+            "fixed_tokens": fixed,
+            "static_prefix_tokens": self.static_prefix(build_messages),
+            "note_tokens": used_note_tokens,
+            "note_tokens_original": note_tokens,
+            "note_truncated": used_note is not note_text,
+            "candidate_tokens": sum(cand_tokens[:len(used)]),
+            "candidates_used": len(used),
+            "candidates_retrieved": len(entries),
+            "tokenizer": self.counter.name,
+        }
+        return messages, used, report
@@ -0,0 +1,81 @@
+# prompt_layout.py
+# Prompt layouts for provider-side prompt caching: what is the same for every request goes first
+# and byte-identical, the per-request part last
+
+import os
+from typing import Dict, List
+
+from icpc_utils import ICPCEntry
+
+# ------------ Config -------------
+PROMPT_LAYOUT = os.environ.get("PROMPT_LAYOUT", "rag")  # rag | cached | cached-sorted | codebook
+# ---------------------------------
+
+LAYOUTS = ("rag", "cached", "cached-sorted", "codebook")
+if PROMPT_LAYOUT not in LAYOUTS:
+    PROMPT_LAYOUT = "rag"
+
+INSTRUCTIONS = """Du får et konsultasjonsnotat mellom <note>-tagger og en liste av tillatte ICPC-2-koder i <icpc2_kandidater>.
+Returner KUN JSON iht. skjemaet. Ikke skriv noe annet."""
+
+CODEBOOK_INSTRUCTIONS = """Du får et konsultasjonsnotat mellom <note>-tagger. Alle tillatte ICPC-2-koder står i <icpc2_kodebok> nedenfor (kode|tittel).
+Returner KUN JSON iht. skjemaet. Ikke skriv noe annet."""
+
+
+def codebook_line(e: ICPCEntry) -> str:
+    """Compact line; component and chapter follow from the code (mapping help in the system prompt)."""
+    return f"{e.code}|{e.title}"
+
+
+def serialize(messages: List[Dict[str, str]]) -> str:
+    """Roughly what a provider tokenizes (and prefix-caches) for a chat request."""
+    return "".join(f"<{m['role']}>\n{m['content']}\n" for m in messages)
+
+
+class CachedLayout:
+    """The RAG prompt with every static part in the system message: system prompt and instructions
+    form one byte-identical prefix. Candidates keep their retrieval order. With `sort_candidates`
+    ('cached-sorted') they are listed in code order instead, so requests with the same candidate
+    set (templated notes) are byte-identical up to the note, at the cost of the ranking signal;
+    compare top1/top3 with bench_prompt_layout.py before using it."""
+
+    def __init__(self, system_prompt: str, sort_candidates: bool = False):
+        self.static = f"{system_prompt}\n{INSTRUCTIONS}\n"
+        self.sort_candidates = sort_candidates
+
+    def __call__(self, note_text: str, grounding: str) -> List[Dict[str, str]]:
+        lines = grounding.split("\n") if grounding else []
+        if self.sort_candidates:
+            lines = sorted(lines)  # lines start with the code
+        user_content = f"""<icpc2_kandidater>
+{chr(10).join(lines)}
+</icpc2_kandidater>
+
+<note>
+{note_text}
+</note>
+"""
+        return [
+            {"role": "system", "content": self.static},
+            {"role": "user", "content": user_content},
+        ]
+
+
+class Codebook:
+    """Full-codebook layout for one index version: every code in the static system message, the
+    user message is the note alone. No per-request candidate list, so retrieval misses cannot hide
+    the right code, at the price of a large (but cacheable) prefix. The prefix does not count
+    against PROMPT_TOKEN_BUDGET (see PromptBuilder.build)."""
+
+    def __init__(self, entries: List[ICPCEntry], system_prompt: str):
+        lines = "\n".join(codebook_line(e) for e in entries)  # index order: stable between requests
+        system_prompt = system_prompt.replace("<icpc2_kandidater>", "<icpc2_kodebok>")
+        self.static = f"{system_prompt}\n{CODEBOOK_INSTRUCTIONS}\n\n<icpc2_kodebok>\n{lines}\n</icpc2_kodebok>\n"
+        self.budget_exempt = self.static
+        self.entries = entries
+
+    def __call__(self, note_text: str, grounding: str = "") -> List[Dict[str, str]]:
+        return [
+            {"role": "system", "content": self.static},
+            {"role": "user", "content": f"<note>\n{note_text}\n</note>\n"},
+        ]
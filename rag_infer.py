@@ -2,15 +2,20 @@
 # Retrieve ICPC-2 candidates and query an LLM (Mistral) with RAG grounding
 
 import os, json, re
-from typing import List, Dict, Any, Tuple, Generator
+from typing import List, Dict, Any, Tuple, Generator, Optional, TYPE_CHECKING
 import sys
 from dotenv import load_dotenv
 
 import numpy as np
-import faiss
-from sentence_transformers import SentenceTransformer
+if TYPE_CHECKING:  # faiss and the model are only loaded by infer(); app.py imports this module for the LLM call
+    from sentence_transformers import SentenceTransformer
 
 from icpc_utils import ICPCEntry
+from llm_router import ROUTER, LLM_TIMEOUT
+from deadline import Deadline
+from cancellation import CancelToken
+from evidence import NoteEvidence
+from structured_output import parse_json, response_schema
 
 # Load environment variables
 load_dotenv()
@@ -46,12 +51,12 @@ def load_meta(path: str) -> List[ICPCEntry]:
     return rows
 
 
-def embed_queries(texts: List[str], model: SentenceTransformer) -> np.ndarray:
+def embed_queries(texts: List[str], model: "SentenceTransformer") -> np.ndarray:
     # E5 expects "query: " prefix for query embeddings
     return model.encode([f"query: {t}" for t in texts], convert_to_numpy=True, normalize_embeddings=True)
 
 
-def retrieve(note_text: str, model: SentenceTransformer, index, meta: List[ICPCEntry], topn: int) -> List[ICPCEntry]:
+def retrieve(note_text: str, model: "SentenceTransformer", index, meta: List[ICPCEntry], topn: int) -> List[ICPCEntry]:
     qvec = embed_queries([note_text], model)[0].astype(np.float32)
     D, I = index.search(qvec.reshape(1, -1), topn)
     return [meta[i] for i in I[0]]
@@ -75,7 +80,7 @@ Regler:
 3) Maks 3 forslag.
 4) Symptom vs. diagnose: Hvis diagnosen ikke er tydelig etablert, prioriter symptomkode (komponent 1) fremfor sykdomsdiagnose (komponent 7).
 5) Prosesskoder (komponent 2–6) kun ved eksplisitt prosess (screening, henvisning, sykmelding, prøver, behandling, administrativt).
-6) For hver kode: kort begrunnelse og 1–3 tekstbevis (spans) ordrett fra notatet (angi gjerne seksjon).
+6) For hver kode: kort begrunnelse og 1–3 tekstbevis (spans) ordrett fra notatet.
 7) Sett confidence 0.0–1.0 konservativt. Bruk needs_review: true ved lav sikkerhet eller mulig feilkode.
 8) Ingen kjede-resonnering. Ikke avslør interne steg.
 
@@ -94,7 +99,7 @@ Output-skjema (JSON):
       "component": 1,
       "confidence": 0.0,
       "evidence_spans": [
-        {"text": "ordrett sitat fra notatet", "section": "Anamnese|Status|Vurdering|Plan|Ukjent"}
+        {"text": "ordrett sitat fra notatet"}
       ],
       "alternatives": ["ALT1", "ALT2"],
       "needs_review": false
@@ -123,87 +128,24 @@ Returner KUN JSON iht. skjemaet. Ikke skriv noe annet.
     ]
 
 
-def call_mistral_stream(messages: List[Dict[str, str]], temperature: float, max_tokens: int) -> Generator[str, None, None]:
-    """Call Mistral API with streaming enabled."""
-    if MISTRAL_API_KEY:
-        import requests
-        
-        url = f"{MISTRAL_BASE}/chat/completions"
-        headers = {
-            "Authorization": f"Bearer {MISTRAL_API_KEY}",
-            "Content-Type": "application/json",
-        }
-        payload = {
-            "model": MISTRAL_MODEL,
-            "messages": messages,
-            "temperature": temperature,
-            "max_tokens": max_tokens,
-            "stream": True  # Enable streaming
-        }
-        
-        with requests.post(url, headers=headers, json=payload, timeout=60, stream=True) as r:
-            r.raise_for_status()
-            
-            for line in r.iter_lines():
-                if line:
-                    line = line.decode('utf-8')
-                    if line.startswith('data: '):
-                        data_str = line[6:]  # Remove 'data: ' prefix
-                        
-                        if data_str == '[DONE]':
-                            break
-                        
-                        try:
-                            data = json.loads(data_str)
-                            if 'choices' in data and data['choices']:
-                                choice = data['choices'][0]
-                                if 'delta' in choice and 'content' in choice['delta']:
-                                    content = choice['delta']['content']
-                                    if content:
-                                        yield content
-                        except json.JSONDecodeError:
-                            continue
-
-    elif OPENAI_API_KEY and OPENAI_BASE and OPENAI_MODEL:
-        import requests
-        
-        url = f"{OPENAI_BASE}/chat/completions"
-        headers = {
-            "Authorization": f"Bearer {OPENAI_API_KEY}",
-            "Content-Type": "application/json",
-        }
-        payload = {
-            "model": OPENAI_MODEL,
-            "messages": messages,
-            "temperature": temperature,
-            "max_tokens": max_tokens,
-            "stream": True
-        }
-        
-        with requests.post(url, headers=headers, json=payload, timeout=60, stream=True) as r:
-            r.raise_for_status()
-            
-            for line in r.iter_lines():
-                if line:
-                    line = line.decode('utf-8')
-                    if line.startswith('data: '):
-                        data_str = line[6:]
-                        
-                        if data_str == '[DONE]':
-                            break
-                        
-                        try:
-                            data = json.loads(data_str)
-                            if 'choices' in data and data['choices']:
-                                choice = data['choices'][0]
-                                if 'delta' in choice and 'content' in choice['delta']:
-                                    content = choice['delta']['content']
-                                    if content:
-                                        yield content
-                        except json.JSONDecodeError:
-                            continue
-    else:
-        raise RuntimeError("No LLM credentials configured. Set MISTRAL_API_KEY or OPENAI_* environment variables.")
+def call_mistral_stream(messages: List[Dict[str, str]], temperature: float, max_tokens: int,
+                        deadline: Optional[Deadline] = None,
+                        cancel: Optional[CancelToken] = None,
+                        report: Optional[Dict[str, Any]] = None,
+                        schema: Optional[Dict[str, Any]] = None) -> Generator[str, None, None]:
+    """Call the configured LLM provider(s) with streaming enabled.
+
+    Routing (failover, hedged requests to the alternate provider, circuit breakers) lives in
+    llm_router; see LLM_HEDGE_DELAY and the LLM_BREAKER_* settings. With a `deadline` the
+    stream raises TimeoutError once it is close, instead of waiting for the provider. Cancelling
+    `cancel` closes the provider connection and raises cancellation.Cancelled. `report` receives
+    the call's timing and token accounting (connect time, TTFT, inter-token gaps, usage, finish reason).
+    `schema` (structured_output.response_schema) requests JSON mode / schema-constrained output
+    from providers that support it, see LLM_RESPONSE_FORMAT.
+    """
+    deadline_at = deadline.llm_cutoff() if deadline is not None else None
+    yield from ROUTER.stream(messages, temperature=temperature, max_tokens=max_tokens, deadline_at=deadline_at,
+                             cancel=cancel, report=report, schema=schema)
 
 
 def call_mistral_non_stream(messages: List[Dict[str, str]], temperature: float, max_tokens: int) -> str:
@@ -221,7 +163,7 @@ def call_mistral_non_stream(messages: List[Dict[str, str]], temperature: float,
             "temperature": temperature,
             "max_tokens": max_tokens,
         }
-        r = requests.post(url, headers=headers, json=payload, timeout=60)
+        r = requests.post(url, headers=headers, json=payload, timeout=LLM_TIMEOUT)
         r.raise_for_status()
         data = r.json()
         if "choices" not in data or not data["choices"]:
@@ -241,7 +183,7 @@ def call_mistral_non_stream(messages: List[Dict[str, str]], temperature: float,
             "temperature": temperature,
             "max_tokens": max_tokens,
         }
-        r = requests.post(url, headers=headers, json=payload, timeout=60)
+        r = requests.post(url, headers=headers, json=payload, timeout=LLM_TIMEOUT)
         r.raise_for_status()
         data = r.json()
         if "choices" not in data or not data["choices"]:
@@ -262,12 +204,10 @@ def call_mistral(messages: List[Dict[str, str]], temperature: float, max_tokens:
         return call_mistral_non_stream(messages, temperature, max_tokens)
 
 
-def parse_json_or_raise(text: str) -> Dict[str, Any]:
-    # Extract JSON block if the model wrapped it in code fences
-    m = re.search(r"\{.*\}", text, flags=re.S)
-    if not m:
-        raise ValueError("Model did not return JSON.")
-    return json.loads(m.group(0))
+def parse_json_or_raise(text: str, compact: bool = False) -> Dict[str, Any]:
+    # Code fences, surrounding prose, trailing commas and output cut at max_tokens are repaired;
+    # top_k is validated against the output schema (structured_output)
+    return parse_json(text, compact)
 
 
 def infer(note_text: str, stream: bool = False, show_stream: bool = False) -> Dict[str, Any]:
@@ -280,6 +220,8 @@ def infer(note_text: str, stream: bool = False, show_stream: bool = False) -> Di
         show_stream: Whether to display streaming output (only works if stream=True)
     """
     # Load index + meta + embedding model
+    import faiss
+    from sentence_transformers import SentenceTransformer
     index = faiss.read_index(INDEX_PATH)
     with open(META_PATH, "r", encoding="utf-8") as f:
         meta = [ICPCEntry(**r) for r in json.load(f)]
@@ -298,7 +240,8 @@ def infer(note_text: str, stream: bool = False, show_stream: bool = False) -> Di
         print("-" * 50)
         
         full_response = ""
-        for chunk in call_mistral_stream(messages, temperature=TEMPERATURE, max_tokens=MAX_TOKENS):
+        for chunk in call_mistral_stream(messages, temperature=TEMPERATURE, max_tokens=MAX_TOKENS,
+                                         schema=response_schema()):
             print(chunk, end='', flush=True)
             full_response += chunk
         
@@ -316,7 +259,8 @@ def infer(note_text: str, stream: bool = False, show_stream: bool = False) -> Di
         if item.get("code") not in allowed:
             item["needs_review"] = True
             item["notes"] = (obj.get("notes") or "") + " | Kode ikke i kandidatliste fra RAG."
-    return obj
+    # Locate the quoted evidence in the note: offsets + section, fabricated quotes -> needs_review
+    return NoteEvidence(note_text).verify(obj)
 
 
 if __name__ == "__main__":
@@ -11,6 +11,8 @@ import faiss
 from sentence_transformers import SentenceTransformer
 
 from icpc_utils import ICPCEntry
+from evidence import NoteEvidence
+from structured_output import parse_json
 
 # ------------ Config -------------
 EMB_MODEL = os.environ.get("EMB_MODEL", "intfloat/multilingual-e5-base")
@@ -60,7 +62,7 @@ Regler:
 3) Maks 3 forslag.
 4) Symptom vs. diagnose: Hvis diagnosen ikke er tydelig etablert, prioriter symptomkode (komponent 1) fremfor sykdomsdiagnose (komponent 7).
 5) Prosesskoder (komponent 2–6) kun ved eksplisitt prosess (screening, henvisning, sykmelding, prøver, behandling, administrativt).
-6) For hver kode: kort begrunnelse og 1–3 tekstbevis (spans) ordrett fra notatet (angi gjerne seksjon).
+6) For hver kode: kort begrunnelse og 1–3 tekstbevis (spans) ordrett fra notatet.
 7) Sett confidence 0.0–1.0 konservativt. Bruk needs_review: true ved lav sikkerhet eller mulig feilkode.
 8) Ingen kjede-resonnering. Ikke avslør interne steg.
 
@@ -79,7 +81,7 @@ Output-skjema (JSON):
       "component": 1,
       "confidence": 0.0,
       "evidence_spans": [
-        {"text": "ordrett sitat fra notatet", "section": "Anamnese|Status|Vurdering|Plan|Ukjent"}
+        {"text": "ordrett sitat fra notatet"}
       ],
       "alternatives": ["ALT1", "ALT2"],
       "needs_review": false
@@ -241,10 +243,7 @@ def call_mistral_non_stream(messages: List[Dict[str, str]], temperature: float,
 
 
 def parse_json_or_raise(text: str) -> Dict[str, Any]:
-    m = re.search(r"\{.*\}", text, flags=re.S)
-    if not m:
-        raise ValueError("Model did not return JSON.")
-    return json.loads(m.group(0))
+    return parse_json(text)
 
 
 def infer_stream(note_text: str, use_streaming: bool = True) -> Dict[str, Any]:
@@ -286,8 +285,9 @@ def infer_stream(note_text: str, use_streaming: bool = True) -> Dict[str, Any]:
         if item.get("code") not in allowed:
             item["needs_review"] = True
             item["notes"] = (obj.get("notes") or "") + " | Kode ikke i kandidatliste fra RAG."
-    
-    return obj
+
+    # Locate the quoted evidence in the note: offsets + section, fabricated quotes -> needs_review
+    return NoteEvidence(note_text).verify(obj)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,164 @@
+# semantic_cache.py
+# Semantic result cache: near-identical notes (templated URI notes, sick-leave renewals, repeat
+# prescriptions) reuse an earlier validated result instead of calling the LLM again
+
+import os
+import copy
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import faiss
+
+# ------------ Config -------------
+SEMANTIC_CACHE = os.environ.get("SEMANTIC_CACHE", "1") == "1"  # 0 = off
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", "0.97"))  # min cosine note similarity
+SEMANTIC_CACHE_MIN_OVERLAP = float(os.environ.get("SEMANTIC_CACHE_MIN_OVERLAP", "0.8"))  # min Jaccard of candidates
+SEMANTIC_CACHE_OVERLAP_K = int(os.environ.get("SEMANTIC_CACHE_OVERLAP_K", "20"))  # top candidates compared
+SEMANTIC_CACHE_SIZE = int(os.environ.get("SEMANTIC_CACHE_SIZE", "5000"))  # max cached results
+SEMANTIC_CACHE_TTL = float(os.environ.get("SEMANTIC_CACHE_TTL", "86400"))  # seconds a result may be reused
+# ---------------------------------
+
+PER_CALL_FIELDS = ("llm", "prompt", "index_version")  # describe one run, not the answer
+
+
+class CachedResult:
+    def __init__(self, result: Dict[str, Any], codes: List[str], scope: tuple, dim: int):
+        self.result = result
+        self.dim = dim
+        self.codes = set(codes)
+        self.scope = scope
+        self.created = time.monotonic()
+        self.hits = 0
+
+
+class SemanticCache:
+    """Past (note embedding, final result) pairs in their own FAISS index.
+
+    A lookup hits when a cached note is at least `threshold` cosine-similar AND the retrieved
+    candidate sets overlap by at least `min_overlap` (Jaccard over the top `overlap_k`), within the
+    same scope (output mode, index version). The second check keeps a one-word difference that
+    changes the diagnosis ("ikke feber") from reusing an answer built on other candidates.
+    Entries expire after `ttl`; beyond `max_size` the least recently used is evicted.
+    """
+
+    def __init__(self, enabled: bool = SEMANTIC_CACHE, threshold: float = SEMANTIC_CACHE_THRESHOLD,
+                 min_overlap: float = SEMANTIC_CACHE_MIN_OVERLAP, overlap_k: int = SEMANTIC_CACHE_OVERLAP_K,
+                 max_size: int = SEMANTIC_CACHE_SIZE, ttl: float = SEMANTIC_CACHE_TTL):
+        self.enabled = enabled and max_size > 0
+        self.threshold = threshold
+        self.min_overlap = min_overlap
+        self.overlap_k = overlap_k
+        self.max_size = max_size
+        self.ttl = ttl
+        self._indexes: Dict[int, Any] = {}  # dimension -> IndexIDMap over IndexFlatIP (one per embedding model)
+        self._entries: "OrderedDict[int, CachedResult]" = OrderedDict()  # id -> entry, least recently used first
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+        self.stores = 0
+        self.rejected_overlap = 0
+        self.evicted_ttl = 0
+        self.evicted_size = 0
+
+    def _remove(self, ids: List[int]) -> None:
+        by_dim: Dict[int, List[int]] = {}
+        for i in ids:
+            by_dim.setdefault(self._entries.pop(i).dim, []).append(i)
+        for dim, dim_ids in by_dim.items():
+            self._indexes[dim].remove_ids(np.array(dim_ids, dtype=np.int64))
+
+    def _expire(self) -> None:
+        now = time.monotonic()
+        old = [i for i, e in self._entries.items() if now - e.created > self.ttl]
+        if old:
+            self._remove(old)
+            self.evicted_ttl += len(old)
+
+    def _overlap(self, a: set, b: set) -> float:
+        return len(a & b) / len(a | b) if a or b else 1.0
+
+    def lookup(self, vec: np.ndarray, codes: List[str], scope: tuple) -> Optional[Dict[str, Any]]:
+        """A copy of the cached result with `source: "semantic-cache"`, or None."""
+        if not self.enabled:
+            return None
+        codes = set(codes[:self.overlap_k])
+        with self._lock:
+            self.lookups += 1
+            index = self._indexes.get(vec.shape[-1])
+            if index is None or not self._entries:
+                return None
+            self._expire()
+            if not index.ntotal:
+                return None
+            D, I = index.search(vec.reshape(1, -1).astype(np.float32), min(5, int(index.ntotal)))
+            near = False
+            for sim, i in zip(D[0], I[0]):
+                entry = self._entries.get(int(i))
+                if sim < self.threshold or entry is None or entry.scope != scope:
+                    continue
+                near = True
+                overlap = self._overlap(codes, entry.codes)
+                if overlap < self.min_overlap:
+                    continue
+                entry.hits += 1
+                self.hits += 1
+                self._entries.move_to_end(int(i))
+                result = copy.deepcopy(entry.result)
+                age = time.monotonic() - entry.created
+                break
+            else:
+                if near:
+                    self.rejected_overlap += 1
+                return None
+        result["source"] = "semantic-cache"
+        result["cache"] = {"similarity": round(float(sim), 4), "candidate_overlap": round(overlap, 4),
+                           "age_s": round(age, 1)}
+        return result
+
+    def store(self, vec: np.ndarray, codes: List[str], result: Dict[str, Any], scope: tuple) -> None:
+        """Remember a final result. Degraded results are never cached."""
+        if not self.enabled or result.get("degraded"):
+            return
+        kept = {k: v for k, v in result.items() if k not in PER_CALL_FIELDS}
+        vec = vec.reshape(1, -1).astype(np.float32)
+        dim = vec.shape[1]
+        entry = CachedResult(copy.deepcopy(kept), codes[:self.overlap_k], scope, dim)
+        with self._lock:
+            if dim not in self._indexes:
+                self._indexes[dim] = faiss.IndexIDMap(faiss.IndexFlatIP(dim))
+            self._expire()
+            if len(self._entries) >= self.max_size:
+                oldest = list(self._entries)[:len(self._entries) - self.max_size + 1]
+                self._remove(oldest)
+                self.evicted_size += len(oldest)
+            i = self._next_id
+            self._next_id += 1
+            self._indexes[dim].add_with_ids(vec, np.array([i], dtype=np.int64))
+            self._entries[i] = entry
+            self.stores += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            if self._entries:
+                self._remove(list(self._entries))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "hit_rate": round(self.hits / self.lookups, 4) if self.lookups else 0.0,
+                "rejected_overlap": self.rejected_overlap,
+                "stores": self.stores,
+                "evicted_ttl": self.evicted_ttl,
+                "evicted_size": self.evicted_size,
+                "threshold": self.threshold,
+                "min_overlap": self.min_overlap,
+            }
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# serve.py
+# Production launcher: the master process loads the embedding model, FAISS index and metadata once
+# (gunicorn preload), then forks workers that share those pages copy-on-write
+
+import os
+import gc
+import sys
+import json
+import threading
+
+# ------------ Config -------------
+DEPLOY_PROFILE = os.environ.get("DEPLOY_PROFILE", "docker")  # see PROFILES; WEB_* / TORCH_THREADS override it
+PORT = int(os.environ.get("PORT", "5000"))
+HOST = os.environ.get("HOST", "0.0.0.0")
+WORKER_TIMEOUT = int(os.environ.get("WORKER_TIMEOUT", "120"))  # seconds a silent worker lives before restart
+SERVE_PIDFILE = os.environ.get("SERVE_PIDFILE", "/tmp/icpc2-serve.pid")  # for `python serve.py memory`
+MEMORY_REPORT_DELAY = float(os.environ.get("MEMORY_REPORT_DELAY", "60"))  # each worker logs its memory after this; 0 = off
+# ---------------------------------
+
+CPUS = os.cpu_count() or 1
+
+# Recommended settings per deployment target. Workers share the model (~1.1 GB for e5-base in
+# float32) copy-on-write, so a worker costs its private pages (typically 100-300 MB), not a full
+# copy. Threads serve the mostly I/O-bound LLM streams; torch threads bound each worker's
+# embedding CPU use so workers * torch_threads does not oversubscribe the cores.
+PROFILES = {
+    "local": {"workers": 1, "threads": 8, "torch_threads": CPUS},  # dev machine, one process
+    "render": {"workers": 1, "threads": 16, "torch_threads": 1},  # Render Standard: 1 CPU, 2 GB
+    # One worker everywhere until per-process state (live sessions, coalescing, breakers, caches)
+    # is shared: the platforms' load balancers cannot route by session_id, so scale with replicas
+    # only where sticky routing exists, and with WEB_WORKERS only knowingly
+    "railway": {"workers": 1, "threads": 16, "torch_threads": 2},  # Railway: shared vCPUs, 8 GB
+    "digitalocean": {"workers": 1, "threads": 16, "torch_threads": 2},  # App Platform / Droplet: 2 vCPU, 4 GB
+    "docker": {"workers": 1, "threads": 16, "torch_threads": CPUS},
+}
+
+profile = PROFILES.get(DEPLOY_PROFILE, PROFILES["docker"])
+WEB_WORKERS = int(os.environ.get("WEB_WORKERS", profile["workers"]))
+WEB_THREADS = int(os.environ.get("WEB_THREADS", profile["threads"]))
+TORCH_THREADS = int(os.environ.get("TORCH_THREADS", profile["torch_threads"]))
+
+# Before torch is imported: OpenMP pools sized for one worker, and no tokenizer thread pool in the
+# master (HF tokenizers warn and may deadlock when forked with it running)
+os.environ.setdefault("OMP_NUM_THREADS", str(TORCH_THREADS))
+os.environ.setdefault("MKL_NUM_THREADS", str(TORCH_THREADS))
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+# /admin/reload-index reaches a single worker; with several, every worker watches the index files
+# so all of them swap in the new version
+if WEB_WORKERS > 1:
+    os.environ.setdefault("INDEX_WATCH_INTERVAL", "30")
+os.environ["WEB_WORKERS"] = str(WEB_WORKERS)  # admission.py splits the LLM limits between the workers
+os.environ["DEFER_BACKGROUND"] = "1"  # app.py: no threads before fork; started per worker in post_fork
+
+
+def when_ready(server):
+    """Master, after preloading the app and before the first fork."""
+    import app as icpc_app
+    icpc_app.job_store.close()  # sqlite connections must not cross a fork
+    gc.collect()
+    # Move every object loaded so far into the permanent generation: the cyclic GC never touches
+    # (and so never writes to) their headers again, which keeps the pages shared after fork
+    gc.freeze()
+    from procmem import memory
+    m = memory()
+    print(f"✅ Master {os.getpid()} klar ({m.get('rss', '?')} MB RSS), starter {WEB_WORKERS} arbeidere "
+          f"× {WEB_THREADS} tråder, torch {TORCH_THREADS} tråd(er) [{DEPLOY_PROFILE}]")
+
+
+def post_fork(server, worker):
+    """Each worker, right after fork: per-process threads and pools."""
+    import torch
+    torch.set_num_threads(TORCH_THREADS)
+    import app as icpc_app
+    icpc_app.start_background()
+    if MEMORY_REPORT_DELAY > 0:
+        def log_memory():
+            from procmem import memory
+            m = memory()
+            print(f"📊 Arbeider {m['pid']}: rss {m.get('rss')} MB, pss {m.get('pss')} MB, "
+                  f"delt {m.get('shared')} MB, privat {m.get('private')} MB")
+        t = threading.Timer(MEMORY_REPORT_DELAY, log_memory)
+        t.daemon = True
+        t.start()
+
+
+def options():
+    return {
+        "bind": f"{HOST}:{PORT}",
+        "workers": WEB_WORKERS,
+        "threads": WEB_THREADS,
+        "worker_class": "gthread",
+        "preload_app": True,
+        "timeout": WORKER_TIMEOUT,
+        "graceful_timeout": 30,
+        "keepalive": 5,
+        "pidfile": SERVE_PIDFILE,
+        "when_ready": when_ready,
+        "post_fork": post_fork,
+    }
+
+
+def main():
+    from gunicorn.app.base import BaseApplication
+
+    class Launcher(BaseApplication):
+        def load_config(self):
+            for key, value in options().items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            import app as icpc_app  # runs in the master only (preload_app)
+            return icpc_app.app
+
+    Launcher().run()
+
+
+def memory_report():
+    """Per-process memory of a running launcher (master from SERVE_PIDFILE)."""
+    from procmem import report
+    try:
+        with open(SERVE_PIDFILE, "r") as f:
+            master = int(f.read().strip())
+    except (OSError, ValueError):
+        sys.exit(f"❌ Fant ingen kjørende serve.py ({SERVE_PIDFILE})")
+    r = report(master)
+    if "--json" in sys.argv:
+        print(json.dumps(r, indent=2))
+        return
+    print(f"{'rolle':<8} {'pid':>7} {'rss':>9} {'pss':>9} {'delt':>9} {'privat':>9}   (MB)")
+    for p in r["processes"]:
+        print(f"{p['role']:<8} {p['pid']:>7} {p.get('rss', '-'):>9} {p.get('pss', '-'):>9} "
+              f"{p.get('shared', '-'):>9} {p.get('private', '-'):>9}")
+    print(f"Sum rss {r['rss_sum']} MB, sum pss {r['pss_sum']} MB (faktisk forbruk), {r['workers']} arbeidere")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "memory":
+        memory_report()
+    elif len(sys.argv) > 1 and sys.argv[1] == "profiles":
+        for name, p in PROFILES.items():
+            print(f"{name:<13} workers={p['workers']} threads={p['threads']} torch_threads={p['torch_threads']}")
+    else:
+        main()
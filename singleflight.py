@@ -0,0 +1,155 @@
+# singleflight.py
+# Coalesce identical in-flight analyses: one pipeline run, many subscribers with replay
+
+import hashlib
+import json
+import threading
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Tuple
+
+from cancellation import CancelToken
+
+Event = Tuple[str, Any]  # ('stream', chunk) | ('final', result) | ('error', exception)
+
+
+def coalesce_key(*parts: Any) -> str:
+    """Stable key over everything that determines the output (note text + model/prompt settings)."""
+    raw = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class Flight:
+    """One running pipeline. Events are kept so late subscribers get a replay from the start.
+    `cancel` is handed to the producer; it is cancelled when the last subscriber disconnects."""
+
+    def __init__(self, key: str, cancel: Optional[CancelToken] = None, tag: Any = None):
+        self.key = key
+        self.cancel = cancel or CancelToken()
+        self.tag = tag  # set by whoever started it (e.g. the request id that owns the trace)
+        self.subscribers = 0
+        self._events = []
+        self._done = False
+        self._cond = threading.Condition()
+
+    def publish(self, event: Event) -> None:
+        with self._cond:
+            self._events.append(event)
+            self._cond.notify_all()
+
+    def finish(self) -> None:
+        with self._cond:
+            self._done = True
+            self._cond.notify_all()
+
+    @property
+    def done(self) -> bool:
+        return self._done
+
+    def subscribe(self, heartbeat: Optional[float] = None) -> Iterator[Event]:
+        """Replay what has been produced so far, then follow the live events until the end.
+        ('error', exc) events are re-raised in the subscriber. With `heartbeat`, ('heartbeat', None)
+        is yielded after that many idle seconds, so a streaming endpoint writes something and
+        notices a disconnected client even while the provider is silent."""
+        i = 0
+        while True:
+            with self._cond:
+                if heartbeat is None:
+                    while i >= len(self._events) and not self._done:
+                        self._cond.wait()
+                elif i >= len(self._events) and not self._done:
+                    self._cond.wait(heartbeat)
+                batch = self._events[i:]
+                done = self._done
+            if not batch and not done:
+                yield 'heartbeat', None
+                continue
+            for kind, payload in batch:
+                if kind == 'error':
+                    raise payload
+                yield kind, payload
+            i += len(batch)
+            if done:
+                return
+
+
+class SingleFlight:
+    """Runs at most one pipeline per key at a time; identical concurrent requests attach to it.
+
+    The pipeline runs on its own thread and publishes into a Flight, so it does not depend on
+    which client started it. The flight is forgotten as soon as it finishes: this coalesces
+    in-flight work only, it is not a result cache. Subscribers call `leave` when they stop
+    reading; if the last one left because its client disconnected, the flight is cancelled so
+    the producer closes its provider stream and frees its worker.
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._flights: Dict[str, Flight] = {}
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.coalesced = 0
+        self.disconnected = 0  # subscribers whose client went away mid-stream
+        self.abandoned = 0  # flights cancelled because every subscriber had disconnected
+
+    def has(self, key: str) -> bool:
+        with self._lock:
+            return key in self._flights
+
+    def join(self, key: str, producer: Callable[[CancelToken], Iterable[Event]],
+             cancel: Optional[CancelToken] = None, tag: Any = None) -> Flight:
+        """Attach to the running flight for `key`, or start `producer(flight.cancel)` in a new one
+        (`cancel` lets the caller supply the token, e.g. one that is also cancelled elsewhere)."""
+        with self._lock:
+            self.requests += 1
+            flight = self._flights.get(key) if self.enabled else None
+            if flight is not None and not flight.done:
+                self.coalesced += 1
+                flight.subscribers += 1
+                return flight
+            flight = Flight(key, cancel, tag)
+            flight.subscribers = 1
+            if self.enabled:
+                self._flights[key] = flight
+        threading.Thread(target=self._run, args=(flight, producer), name="singleflight", daemon=True).start()
+        return flight
+
+    def leave(self, flight: Flight, disconnected: bool = False) -> None:
+        """A subscriber stopped reading. Cancels the flight if it was the last one and it left
+        because its client disconnected."""
+        with self._lock:
+            flight.subscribers -= 1
+            if disconnected:
+                self.disconnected += 1
+            abandon = disconnected and flight.subscribers <= 0 and not flight.done
+            if abandon:
+                self.abandoned += 1
+                if self._flights.get(flight.key) is flight:
+                    del self._flights[flight.key]  # new identical requests must not join it
+        if abandon:
+            flight.cancel.cancel("client disconnected")
+
+    def _run(self, flight: Flight, producer: Callable[[CancelToken], Iterable[Event]]) -> None:
+        try:
+            for event in producer(flight.cancel):
+                flight.publish(event)
+        except Exception as e:
+            flight.publish(('error', e))
+        finally:
+            with self._lock:
+                if self._flights.get(flight.key) is flight:
+                    del self._flights[flight.key]
+            flight.finish()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            in_flight = len(self._flights)
+            requests, coalesced = self.requests, self.coalesced
+            disconnected, abandoned = self.disconnected, self.abandoned
+        return {
+            "enabled": self.enabled,
+            "requests": requests,
+            "coalesced": coalesced,
+            "coalescing_rate": round(coalesced / requests, 4) if requests else 0.0,
+            "in_flight": in_flight,
+            "disconnected": disconnected,
+            "cancelled_on_disconnect": abandoned,
+        }
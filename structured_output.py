@@ -0,0 +1,322 @@
+# structured_output.py
+# Structured LLM output: JSON schemas for the provider's response_format, a tolerant parser that
+# repairs fenced / truncated / slightly malformed JSON, strict validation of top_k, and counters
+
+import os
+import re
+import json
+import threading
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+# ------------ Config -------------
+# One continuation request when the output was cut at max_tokens and nothing usable could be
+# repaired from it; 0 = fall back to the degraded result at once
+OUTPUT_CONTINUATION = os.environ.get("OUTPUT_CONTINUATION", "1") == "1"
+CONTINUATION_MAX_TOKENS = int(os.environ.get("CONTINUATION_MAX_TOKENS", "400"))
+# ---------------------------------
+
+MAX_SUGGESTIONS = 3
+SCHEMA_NAME = "icpc2_coding"
+CODE_RE = re.compile(r"^[A-Z]\d{2,3}$")  # A01 ... plus the Norwegian four-character extensions (R991)
+FENCE_RE = re.compile(r"```[a-zA-Z]*\s*(.*?)(?:```|$)", re.S)
+TRAILING_COMMA_RE = re.compile(r",\s*([}\]])")
+
+CONTINUE_PROMPT = ("Svaret ditt ble avbrutt. Fortsett JSON-en nøyaktig der den stoppet, uten å gjenta noe "
+                   "og uten annen tekst.")
+
+# Strict-mode compatible (every property required, no extra properties), so the same schema works
+# for OpenAI-style `json_schema` with strict: true and as plain documentation for json_object mode
+_SPAN = {"type": "object", "properties": {"text": {"type": "string"}},
+         "required": ["text"], "additionalProperties": False}
+_FULL_ITEM = {
+    "type": "object",
+    "properties": {
+        "code": {"type": "string"},
+        "title": {"type": "string"},
+        "component": {"type": ["integer", "null"]},
+        "confidence": {"type": "number"},
+        "evidence_spans": {"type": "array", "items": _SPAN},
+        "needs_review": {"type": "boolean"},
+    },
+    "required": ["code", "title", "component", "confidence", "evidence_spans", "needs_review"],
+    "additionalProperties": False,
+}
+_COMPACT_ITEM = {
+    "type": "object",
+    "properties": {
+        "code": {"type": "string"},
+        "confidence": {"type": "number"},
+        "evidence": {"type": "array", "items": {"type": "string"}},
+        "needs_review": {"type": "boolean"},
+    },
+    "required": ["code", "confidence", "evidence", "needs_review"],
+    "additionalProperties": False,
+}
+
+
+def _output_schema(item: Dict[str, Any]) -> Dict[str, Any]:
+    return {"type": "object",
+            "properties": {"top_k": {"type": "array", "items": item}, "notes": {"type": "string"}},
+            "required": ["top_k", "notes"], "additionalProperties": False}
+
+
+OUTPUT_SCHEMAS = {"full": _output_schema(_FULL_ITEM), "compact": _output_schema(_COMPACT_ITEM)}
+
+
+def response_schema(compact: bool = False) -> Dict[str, Any]:
+    """The `schema` argument for ProviderRouter.stream."""
+    return {"name": SCHEMA_NAME, "schema": OUTPUT_SCHEMAS["compact" if compact else "full"]}
+
+
+class OutputError(ValueError):
+    """The model output holds no usable result. `report` says what was tried."""
+
+    def __init__(self, message: str, report: Dict[str, Any]):
+        super().__init__(message)
+        self.report = report
+
+
+def _close_truncated(text: str) -> Optional[str]:
+    """Longest prefix of `text` (which starts with '{') that is valid JSON once the open brackets
+    are closed. Cuts are only made at the root or directly inside a root-level array (between
+    suggestions), so a suggestion the model did not finish is dropped, not half-kept."""
+    stack: List[str] = []
+    cuts: List[Tuple[int, str]] = []
+    in_str = esc = False
+    for i, c in enumerate(text):
+        if in_str:
+            if esc:
+                esc = False
+            elif c == "\\":
+                esc = True
+            elif c == '"':
+                in_str = False
+            continue
+        if c == '"':
+            in_str = True
+        elif c in "{[":
+            stack.append("}" if c == "{" else "]")
+        elif c in "}]":
+            if not stack:
+                break
+            stack.pop()
+            if not stack:
+                break  # a complete object that still did not parse: not a truncation
+            if len(stack) <= 2:
+                cuts.append((i + 1, "".join(reversed(stack))))
+        elif c == "," and len(stack) <= 2:
+            cuts.append((i, "".join(reversed(stack))))
+    for end, closers in reversed(cuts):
+        candidate = text[:end] + closers
+        try:
+            json.loads(candidate)
+            return candidate
+        except ValueError:
+            continue
+    return None
+
+
+def repair_json(text: str) -> Tuple[Dict[str, Any], List[str]]:
+    """The JSON object in `text` and the repairs that were needed to read it: `fence` (code
+    fences), `prose` (text around the object), `trailing_comma`, `truncated` (cut off; closed at
+    the last complete suggestion). Raises ValueError if there is no object to recover."""
+    repairs = []
+    body = (text or "").strip()
+    if "```" in body:
+        m = FENCE_RE.search(body)
+        if m and "{" in m.group(1):
+            body = m.group(1).strip()
+            repairs.append("fence")
+    start = body.find("{")
+    if start < 0:
+        raise ValueError("Model did not return JSON.")
+    if start > 0:
+        repairs.append("prose")
+    body = body[start:]
+    decoder = json.JSONDecoder()
+    attempts = [(body, None), (TRAILING_COMMA_RE.sub(r"\1", body), "trailing_comma")]
+    for candidate, repair in attempts:
+        try:
+            obj, end = decoder.raw_decode(candidate)
+        except ValueError:
+            continue
+        if candidate[end:].strip() and "prose" not in repairs:
+            repairs.append("prose")
+        return obj, repairs + ([repair] if repair else [])
+    for candidate, repair in attempts:
+        closed = _close_truncated(candidate)
+        if closed is not None:
+            return json.loads(closed), repairs + ([repair] if repair else []) + ["truncated"]
+    raise ValueError("Model returned JSON that could not be repaired.")
+
+
+def _as_bool(value: Any) -> Optional[bool]:
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.strip().lower() in ("true", "false"):
+        return value.strip().lower() == "true"
+    return None
+
+
+def validate(obj: Any, compact: bool = False) -> Tuple[Dict[str, Any], List[str]]:
+    """Check `top_k` against the output schema. Suggestions without a valid code are dropped
+    (as are duplicates and any beyond MAX_SUGGESTIONS); fields that can be read unambiguously are
+    coerced (confidence "0.8" -> 0.8, clamped to 0..1; needs_review "true" -> true; a bare
+    string as evidence). Returns the object and the problems found."""
+    problems = []
+    if not isinstance(obj, dict):
+        raise ValueError("Model output is not a JSON object.")
+    top = obj.get("top_k")
+    if not isinstance(top, list):
+        raise ValueError("Model output has no top_k list.")
+    items, seen = [], set()
+    for i, item in enumerate(top):
+        if not isinstance(item, dict):
+            problems.append(f"top_k[{i}]: ikke et objekt")
+            continue
+        code = item.get("code")
+        code = code.strip().upper() if isinstance(code, str) else code
+        if not isinstance(code, str) or not CODE_RE.match(code):
+            problems.append(f"top_k[{i}]: ugyldig kode {item.get('code')!r}")
+            continue
+        if code in seen:
+            problems.append(f"top_k[{i}]: {code} gjentatt")
+            continue
+        seen.add(code)
+        item["code"] = code
+
+        try:
+            confidence = float(item.get("confidence"))
+        except (TypeError, ValueError):
+            problems.append(f"top_k[{i}]: confidence mangler")
+            confidence, item["needs_review"] = 0.0, True
+        if not 0.0 <= confidence <= 1.0:
+            problems.append(f"top_k[{i}]: confidence {confidence} utenfor 0–1")
+            confidence = min(1.0, max(0.0, confidence))
+        item["confidence"] = confidence
+
+        key = "evidence" if compact else "evidence_spans"
+        raw = item.get(key, [])
+        if isinstance(raw, (str, dict)):
+            raw = [raw]
+        if not isinstance(raw, list):
+            problems.append(f"top_k[{i}]: {key} er ikke en liste")
+            raw = []
+        texts = [s.get("text") if isinstance(s, dict) else s for s in raw]
+        texts = [t for t in texts if isinstance(t, str) and t.strip()]
+        if len(texts) < len(raw):
+            problems.append(f"top_k[{i}]: tomme eller ugyldige sitater fjernet")
+        item[key] = texts if compact else [{"text": t} for t in texts]
+
+        review = _as_bool(item.get("needs_review", False))
+        if review is None:
+            problems.append(f"top_k[{i}]: needs_review er ikke boolsk")
+            review = True
+        item["needs_review"] = review
+
+        if not compact:
+            if not isinstance(item.get("title", ""), str):
+                item["title"] = str(item["title"])
+            component = item.get("component")
+            if component is not None and not isinstance(component, int):
+                try:
+                    item["component"] = int(component)
+                except (TypeError, ValueError):
+                    problems.append(f"top_k[{i}]: ugyldig komponent {component!r}")
+                    item["component"] = None
+        items.append(item)
+    if len(items) > MAX_SUGGESTIONS:
+        problems.append(f"{len(items)} forslag, beholder {MAX_SUGGESTIONS}")
+        items = items[:MAX_SUGGESTIONS]
+    if top and not items:
+        raise ValueError("No valid suggestion in model output: " + "; ".join(problems))
+    obj["top_k"] = items
+    if not isinstance(obj.get("notes", ""), str):
+        obj["notes"] = str(obj["notes"])
+    return obj, problems
+
+
+def parse_output(text: str, compact: bool = False) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """Repair + validate in one step. Returns the object and a report (`repairs`, `problems`);
+    raises OutputError when nothing usable is left, including output cut off before the first
+    complete suggestion."""
+    report: Dict[str, Any] = {"repairs": [], "problems": []}
+    try:
+        obj, report["repairs"] = repair_json(text)
+        obj, report["problems"] = validate(obj, compact)
+    except ValueError as e:
+        raise OutputError(str(e), report) from e
+    if "truncated" in report["repairs"] and not obj["top_k"]:
+        raise OutputError("Model output was cut off before the first suggestion.", report)
+    return obj, report
+
+
+def parse_json(text: str, compact: bool = False) -> Dict[str, Any]:
+    """parse_output without the report, for scripts."""
+    return parse_output(text, compact)[0]
+
+
+def continuation_messages(messages: List[Dict[str, str]], partial: str) -> List[Dict[str, str]]:
+    """Ask the model to finish the JSON it started (the last resort for output cut at max_tokens)."""
+    return messages + [{"role": "assistant", "content": partial}, {"role": "user", "content": CONTINUE_PROMPT}]
+
+
+def join_continuation(partial: str, continuation: str) -> List[str]:
+    """Texts to try parsing after a continuation, best first: the two halves joined, or the
+    continuation alone when the model started over instead of continuing."""
+    candidates = [partial + continuation]
+    if continuation.lstrip().startswith(("{", "```")):
+        candidates.append(continuation)
+    return candidates
+
+
+class OutputStats:
+    """How often model output parsed cleanly, needed repair or failed, per repair kind, plus the
+    continuation requests made and how many of them rescued the answer."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.parsed = 0
+        self.clean = 0
+        self.repaired = 0
+        self.failed = 0
+        self.invalid = 0  # parsed, but with schema problems fixed or dropped by validate()
+        self.repairs: Counter = Counter()
+        self.continuations = 0
+        self.continuations_recovered = 0
+
+    def record(self, report: Dict[str, Any], ok: bool) -> None:
+        with self._lock:
+            self.parsed += 1
+            self.repairs.update(report.get("repairs", []))
+            if not ok:
+                self.failed += 1
+            elif report.get("repairs"):
+                self.repaired += 1
+            else:
+                self.clean += 1
+            if ok and report.get("problems"):
+                self.invalid += 1
+            if report.get("continuation"):
+                self.continuations += 1
+                self.continuations_recovered += ok
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            n = self.parsed or 1
+            return {
+                "parsed": self.parsed,
+                "clean": self.clean,
+                "repaired": self.repaired,
+                "failed": self.failed,
+                "with_schema_problems": self.invalid,
+                "repair_rate": round(self.repaired / n, 4),
+                "failure_rate": round(self.failed / n, 4),
+                "repairs": dict(self.repairs),
+                "continuations": self.continuations,
+                "continuations_recovered": self.continuations_recovered,
+            }
+
+
+OUTPUT_STATS = OutputStats()
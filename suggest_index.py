@@ -0,0 +1,220 @@
+# suggest_index.py
+# In-memory prefix + trigram index for ICPC-2 code/title typeahead (/suggest)
+
+from __future__ import annotations
+import csv
+import os
+import re
+import unicodedata
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+from icpc_utils import ICPCEntry
+
+MAX_PREFIX = int(os.environ.get("SUGGEST_MAX_PREFIX", "16"))  # longest word prefix we index
+MIN_WORD_SIMILARITY = float(os.environ.get("SUGGEST_MIN_WORD_SIMILARITY", "0.65"))
+MAX_WORD_CORRECTIONS = 5  # vocabulary words a misspelt/infix query word may expand to
+
+# Match quality (higher is better). Codes beat text, titles beat synonyms, whole words beat prefixes.
+SCORE_CODE_EXACT = 1000
+SCORE_CODE_PREFIX = 900
+SCORE_TITLE = 100
+SCORE_SYNONYM = 70
+BONUS_WHOLE_WORD = 20
+BONUS_FIRST_WORD = 10
+FUZZY_PENALTY = 0.5  # fuzzy hits keep half their score times the word similarity
+
+# Letters that do not decompose under NFKD but should still be typeable without them
+_FOLD = str.maketrans({"ø": "o", "æ": "ae", "ß": "ss", "đ": "d", "ł": "l"})
+_WORD_RE = re.compile(r"[a-z0-9]+")
+_CODE_RE = re.compile(r"^[a-z]\d{0,3}$")
+
+Posting = List[Tuple[int, int, str]]  # (score, entry index, matched text), best first
+
+
+def normalize(text: str) -> str:
+    """Lowercase, fold Norwegian letters and strip accents ("Sår hals" -> "sar hals", "Øre" -> "ore")."""
+    text = text.lower().translate(_FOLD)
+    text = unicodedata.normalize("NFKD", text)
+    return "".join(ch for ch in text if not unicodedata.combining(ch))
+
+
+def tokenize(text: str) -> List[str]:
+    return _WORD_RE.findall(normalize(text))
+
+
+def _trigrams(word: str) -> set:
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def load_synonyms(path: str) -> Dict[str, List[str]]:
+    """Read every (code, text) row of the ICPC-2 CSV without pandas.
+
+    The CSV lists several texts per code; build_index keeps only the longest one as the
+    title, the rest are the synonyms clinicians actually type. Returns {} if the file is missing.
+    """
+    if not path or not os.path.exists(path):
+        return {}
+    out: Dict[str, List[str]] = defaultdict(list)
+    with open(path, "r", encoding="utf-8-sig", errors="ignore") as f:
+        sample = f.read(2048)
+        f.seek(0)
+        try:
+            delim = csv.Sniffer().sniff(sample).delimiter
+        except Exception:
+            delim = ","
+        reader = csv.reader(f, delimiter=delim)
+        next(reader, None)  # header ("Kode;Kodetekst ")
+        for row in reader:
+            if len(row) < 2:
+                continue
+            code, text = row[0].strip(), row[1].strip()
+            if code and text and text not in out[code]:
+                out[code].append(text)
+    return dict(out)
+
+
+class SuggestIndex:
+    """Typeahead over ICPC-2 codes, titles and CSV synonyms.
+
+    Everything is precomputed at construction:
+    - a code-prefix table ("r", "r7", "r74"),
+    - a word-prefix table where each prefix maps to its entries already ranked by match quality,
+    - a trigram index over the word vocabulary, used to correct typos ("hodpine") and
+      resolve infixes ("pine" -> "hodepine") when the prefix table has no answer.
+    A query is then a handful of dict lookups plus a small intersection.
+    """
+
+    def __init__(self, entries: List[ICPCEntry], synonyms: Dict[str, List[str]] | None = None,
+                 max_prefix: int = MAX_PREFIX):
+        self.entries = entries
+        self.max_prefix = max_prefix
+        self._codes: Dict[str, List[int]] = defaultdict(list)
+        best: Dict[str, Dict[int, Tuple[int, str]]] = defaultdict(dict)
+        vocab = set()
+
+        for idx, e in enumerate(entries):
+            code = normalize(e.code)
+            for n in range(1, len(code) + 1):
+                self._codes[code[:n]].append(idx)
+
+            texts = [(e.title, SCORE_TITLE)]
+            texts += [(s, SCORE_SYNONYM) for s in (synonyms or {}).get(e.code, []) if s != e.title]
+            for text, base in texts:
+                for pos, word in enumerate(tokenize(text)):
+                    word = word[:max_prefix]
+                    vocab.add(word)
+                    for n in range(1, len(word) + 1):
+                        score = base + (BONUS_WHOLE_WORD if n == len(word) else 0) + (BONUS_FIRST_WORD if pos == 0 else 0)
+                        prev = best[word[:n]].get(idx)
+                        if prev is None or score > prev[0]:
+                            best[word[:n]][idx] = (score, text)
+
+        # Pre-rank every posting list so single-word queries are just a slice
+        self._prefix: Dict[str, Posting] = {
+            p: sorted(((s, i, t) for i, (s, t) in hits.items()), key=lambda h: (-h[0], len(entries[h[1]].title)))
+            for p, hits in best.items()
+        }
+
+        self._vocab = sorted(w for w in vocab if len(w) >= 3 and not w.isdigit())
+        self._vocab_tri: Dict[str, List[int]] = defaultdict(list)
+        self._vocab_grams: List[int] = []
+        for wid, w in enumerate(self._vocab):
+            grams = _trigrams(w)
+            self._vocab_grams.append(len(grams))
+            for g in grams:
+                self._vocab_tri[g].append(wid)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def _hit(self, idx: int, score: int, text: str, match: str) -> Dict:
+        e = self.entries[idx]
+        comp = e.component_guess if e.component_guess is not None else e.component_hint
+        return {"code": e.code, "title": e.title, "component": comp, "chapter": e.chapter,
+                "match": match, "matched_text": text, "score": score}
+
+    def _corrections(self, word: str) -> List[Tuple[float, str]]:
+        """Vocabulary words similar to `word` (Dice over trigrams), or containing it as an infix."""
+        grams = _trigrams(word)
+        counts: Dict[int, int] = defaultdict(int)
+        for g in grams:
+            for wid in self._vocab_tri.get(g, ()):
+                counts[wid] += 1
+        scored = []
+        for wid, c in counts.items():
+            cand = self._vocab[wid]
+            sim = 2 * c / (len(grams) + self._vocab_grams[wid])
+            if word in cand:
+                sim = max(sim, len(word) / len(cand))
+            if sim >= MIN_WORD_SIMILARITY or word in cand:
+                scored.append((sim, cand))
+        scored.sort(key=lambda s: (-s[0], len(s[1])))
+        return scored[:MAX_WORD_CORRECTIONS]
+
+    def _fuzzy_posting(self, word: str) -> Posting:
+        merged: Dict[int, Tuple[int, str]] = {}
+        for sim, cand in self._corrections(word):
+            for score, idx, text in self._prefix[cand]:
+                s = int(score * sim * FUZZY_PENALTY)
+                if idx not in merged or s > merged[idx][0]:
+                    merged[idx] = (s, text)
+        return sorted(((s, i, t) for i, (s, t) in merged.items()), key=lambda h: -h[0])
+
+    @staticmethod
+    def _intersect(postings: List[Posting], limit: int) -> Posting:
+        if len(postings) == 1:
+            return postings[0][:limit]
+        postings = sorted(postings, key=len)
+        scores = {i: (s, t) for s, i, t in postings[0]}
+        for plist in postings[1:]:
+            other = {i: s for s, i, _ in plist}
+            scores = {i: (s + other[i], t) for i, (s, t) in scores.items() if i in other}
+        return sorted(((s, i, t) for i, (s, t) in scores.items()), key=lambda h: -h[0])[:limit]
+
+    def search(self, query: str, limit: int = 10) -> List[Dict]:
+        q = normalize(query).strip()
+        if not q:
+            return []
+        results: Dict[int, Dict] = {}
+
+        # 1) Code lookup ("R74", "r7", "k 86")
+        compact = q.replace(" ", "")
+        if _CODE_RE.match(compact):
+            for idx in self._codes.get(compact, [])[:limit]:
+                exact = normalize(self.entries[idx].code) == compact
+                results[idx] = self._hit(idx, SCORE_CODE_EXACT if exact else SCORE_CODE_PREFIX,
+                                         self.entries[idx].code, "code")
+            if results:
+                return sorted(results.values(), key=lambda h: -h["score"])[:limit]
+
+        # 2) Word prefixes over titles and synonyms; every query word must match
+        words = [w[:self.max_prefix] for w in _WORD_RE.findall(q)]
+        if not words:
+            return []
+        postings = [self._prefix.get(w) for w in words]
+        if all(postings):
+            for score, idx, text in self._intersect(postings, limit):
+                match = "title" if text == self.entries[idx].title else "synonym"
+                results[idx] = self._hit(idx, score, text, match)
+
+        # 3) Typo/infix fallback: replace words the prefix table cannot satisfy
+        if len(results) < limit:
+            fuzzy = []
+            for w, p in zip(words, postings):
+                if p and (len(words) > 1 or len(w) < 3):
+                    fuzzy.append(p)
+                elif len(w) >= 3:
+                    fuzzy.append(self._fuzzy_posting(w))
+                else:
+                    fuzzy = []
+                    break
+            if fuzzy and all(fuzzy):
+                for score, idx, text in self._intersect(fuzzy, limit):
+                    if len(results) >= limit:
+                        break
+                    if idx not in results:
+                        results[idx] = self._hit(idx, score, text, "fuzzy")
+
+        return sorted(results.values(), key=lambda h: -h["score"])[:limit]
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# test_cancellation.py
+# pytest: CancelToken, and a client disconnect travelling from SingleFlight.leave through the
+# cancel token into the router, which closes the provider stream
+
+import time
+import threading
+
+import pytest
+
+from cancellation import CancelToken, Cancelled
+from singleflight import SingleFlight
+from test_llm_router import router  # noqa: F401  (fixture with scripted fake providers)
+
+
+def test_cancel_runs_callbacks_once():
+    token, calls = CancelToken(), []
+    token.on_cancel(lambda: calls.append("a"))
+    unregister = token.on_cancel(lambda: calls.append("b"))
+    unregister()
+    assert token.cancel("ny revisjon")
+    assert not token.cancel("igjen")
+    assert calls == ["a"] and token.reason == "ny revisjon"
+    with pytest.raises(Cancelled, match="ny revisjon"):
+        token.check()
+
+
+def test_on_cancel_after_cancel_runs_at_once():
+    token, calls = CancelToken(), []
+    token.cancel()
+    token.on_cancel(lambda: calls.append(1))
+    assert calls == [1]
+
+
+def test_cancel_wakes_a_stalled_router_stream(router):
+    r = router({"mistral": [(0, "token", "a"), (5.0, "token", "b")]})
+    token = CancelToken()
+    threading.Timer(0.1, token.cancel, args=("client disconnected",)).start()
+    t0, chunks = time.monotonic(), []
+    with pytest.raises(Cancelled):
+        for chunk in r.stream([], 0.0, 10, cancel=token):
+            chunks.append(chunk)
+    assert chunks == ["a"] and time.monotonic() - t0 < 1.0
+    assert r.stats()["providers"]["mistral"]["cancelled"] == 1
+    # The attempt thread notices the cancel and gives its provider slot back
+    end = time.monotonic() + 1
+    while r.stats()["providers"]["mistral"]["in_flight"] and time.monotonic() < end:
+        time.sleep(0.01)
+    assert r.stats()["providers"]["mistral"]["in_flight"] == 0
+
+
+def test_disconnect_of_last_subscriber_closes_the_provider_stream(router):
+    r = router({"mistral": [(0, "token", "a"), (5.0, "token", "b")]})
+    sf, outcome = SingleFlight(), []
+
+    def producer(cancel):
+        try:
+            for chunk in r.stream([], 0.0, 10, cancel=cancel):
+                yield 'stream', chunk
+        except Cancelled as e:
+            outcome.append(str(e))
+            raise
+
+    flight = sf.join("k", producer)
+    events = flight.subscribe()
+    assert next(events) == ('stream', 'a')
+    events.close()  # the client went away
+    sf.leave(flight, disconnected=True)
+    end = time.monotonic() + 2
+    while not flight.done and time.monotonic() < end:
+        time.sleep(0.01)
+    assert flight.done and outcome == ["client disconnected"]
+    assert r.stats()["providers"]["mistral"]["cancelled"] == 1
+
+
+def test_cancelled_before_start_never_calls_a_provider(router):
+    r = router({"mistral": [(0, "token", "a")]})
+    token = CancelToken()
+    token.cancel()
+    with pytest.raises(Cancelled):
+        list(r.stream([], 0.0, 10, cancel=token))
+    assert r.stats()["providers"]["mistral"]["started"] == 0
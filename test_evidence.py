@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# test_evidence.py
+# pytest: NoteEvidence exact and fuzzy quote location, and the trigram-anchored fuzzy fallback
+# scoring a bounded number of windows
+
+import evidence
+from evidence import NoteEvidence
+
+NOTE = "Anamnese: Sår hals i tre dager.\nStatus: Rød svelg, ingen belegg.\nPlan: Penicillin i ti dager."
+
+
+def test_exact_and_fuzzy_quotes():
+    ev = NoteEvidence(NOTE)
+    exact = ev.check_span({"text": "rød svelg"})
+    assert exact["match"] == "exact" and exact["text"] == "Rød svelg" and exact["section"] == "Status"
+    typo = ev.check_span({"text": "Penicilin i ti dager"})
+    assert typo["match"] == "fuzzy" and typo["text"] == "Penicillin i ti dager" and typo["section"] == "Plan"
+    first_word_typo = ev.check_span({"text": "rod svelg"})
+    assert first_word_typo["verified"] and first_word_typo["text"] == "Rød svelg"
+
+
+def test_ellipsis_parts_in_order():
+    ev = NoteEvidence(NOTE)
+    hit = ev.check_span({"text": "Sår hals … Penicillin"})
+    assert hit["verified"] and hit["text"].startswith("Sår hals") and hit["text"].endswith("Penicillin")
+    assert not ev.check_span({"text": "Penicillin … Sår hals"})["verified"]
+
+
+def test_made_up_quote_scores_a_bounded_number_of_windows(monkeypatch):
+    compared = []
+
+    class CountingMatcher(evidence.SequenceMatcher):
+        def __init__(self, *args, **kwargs):
+            compared.append(1)
+            super().__init__(*args, **kwargs)
+
+    monkeypatch.setattr(evidence, "SequenceMatcher", CountingMatcher)
+    note = "Anamnese: " + " ".join(["hoste og feber med sår hals."] * 500)
+    ev = NoteEvidence(note)
+    assert not ev.check_span({"text": "røyker tjue sigaretter daglig"})["verified"]
+    assert len(compared) <= 3 * evidence.EVIDENCE_MAX_WINDOWS
+    assert not ev.check_span({"text": "xyzzy qwerty"})["verified"]  # no shared trigram: nothing scored
+    assert len(compared) <= 3 * evidence.EVIDENCE_MAX_WINDOWS
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# test_importtime.py
+# Startup benchmark for the server path: import time per module/package (python -X importtime), RSS
+# after import, and a check that build-only dependencies (pandas, icpc_csv) are not loaded by the server
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+from collections import defaultdict
+from typing import Any, Dict, List, Tuple
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BUILD_ONLY = ["pandas", "icpc_csv"]
+# Runtime modules that import without the model stack; the pytest check runs on these
+LIGHT_RUNTIME = ["icpc_utils", "compact_output", "deadline", "evidence", "structured_output", "prompt_layout",
+                 "prompt_budget", "suggest_index", "singleflight", "cancellation", "jobs", "tracing", "procmem"]
+
+PROBE = """
+import sys, json
+{imports}
+from procmem import memory
+print(json.dumps({{"memory": memory(), "build_only": [m for m in {build_only!r} if m in sys.modules]}}))
+"""
+
+
+def run_import(modules: List[str]) -> Tuple[List[Tuple[int, int, str, int]], Dict[str, Any], float]:
+    """Import `modules` in a fresh interpreter under -X importtime. Returns the import rows
+    (self µs, cumulative µs, module, depth), what the probe reported and the wall time in seconds."""
+    env = dict(os.environ, DEFER_BACKGROUND="1", PYTHONDONTWRITEBYTECODE="1")
+    code = PROBE.format(imports="\n".join(f"import {m}" for m in modules), build_only=BUILD_ONLY)
+    t0 = time.perf_counter()
+    p = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=HERE, env=env,
+                       capture_output=True, text=True)
+    wall = time.perf_counter() - t0
+    if p.returncode != 0:
+        tail = "\n".join(l for l in p.stderr.splitlines() if not l.startswith("import time:"))[-2000:]
+        raise RuntimeError(f"Import av {', '.join(modules)} feilet:\n{tail}")
+    rows = []
+    for line in p.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cum_us, name = line[len("import time:"):].split("|", 2)
+        name = name[1:]
+        rows.append((int(self_us), int(cum_us), name.strip(), (len(name) - len(name.lstrip())) // 2))
+    return rows, json.loads(p.stdout.strip().splitlines()[-1]), wall
+
+
+def by_package(rows) -> List[Tuple[str, float]]:
+    """Self time per top-level package, in ms, largest first."""
+    totals = defaultdict(int)
+    for self_us, _, name, _ in rows:
+        totals[name.split(".")[0]] += self_us
+    return sorted(((k, v / 1000) for k, v in totals.items()), key=lambda kv: -kv[1])
+
+
+def repo_modules(rows) -> List[Tuple[str, float]]:
+    """Cumulative import time of this repo's own modules, in ms."""
+    own = {f[:-3] for f in os.listdir(HERE) if f.endswith(".py")}
+    return sorted(((name, cum / 1000) for _, cum, name, _ in rows if name in own), key=lambda kv: -kv[1])
+
+
+def test_runtime_modules_skip_build_deps():
+    """pytest: runtime modules must not pull in build-only dependencies."""
+    _, probe, _ = run_import(LIGHT_RUNTIME)
+    assert probe["build_only"] == [], f"Byggeavhengigheter lastet av serverstien: {probe['build_only']}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Importtid og minne for serverstien (python -X importtime).")
+    parser.add_argument("modules", nargs="*", default=["app"], help="Moduler som importeres (standard: app)")
+    parser.add_argument("--top", type=int, default=20, help="Antall pakker/moduler i tabellene")
+    parser.add_argument("--json", action="store_true", help="Skriv hele sammendraget som JSON")
+    args = parser.parse_args()
+
+    base_rows, base_probe, base_wall = run_import([])
+    rows, probe, wall = run_import(args.modules)
+    total_ms = sum(r[0] for r in rows) / 1000
+    summary = {
+        "modules": args.modules,
+        "wall_s": round(wall, 3),
+        "interpreter_wall_s": round(base_wall, 3),
+        "import_ms": round(total_ms, 1),
+        "rss_mb": probe["memory"].get("rss"),
+        "interpreter_rss_mb": base_probe["memory"].get("rss"),
+        "build_only_loaded": probe["build_only"],
+        "packages_ms": [(k, round(v, 1)) for k, v in by_package(rows)[:args.top]],
+        "repo_modules_ms": [(k, round(v, 1)) for k, v in repo_modules(rows)[:args.top]],
+    }
+    if args.json:
+        print(json.dumps(summary, indent=2, ensure_ascii=False))
+    else:
+        print(f"⏱️  import {', '.join(args.modules)}: {summary['wall_s']} s totalt "
+              f"(tom tolk {summary['interpreter_wall_s']} s), {summary['import_ms']} ms i importer")
+        print(f"📊 RSS etter import: {summary['rss_mb']} MB (tom tolk {summary['interpreter_rss_mb']} MB)")
+        print(f"\n{'pakke':<28} {'ms (self)':>10}")
+        print("-" * 39)
+        for name, ms in summary["packages_ms"]:
+            print(f"{name:<28} {ms:>10.1f}")
+        print(f"\n{'modul i repoet':<28} {'ms (kumulativ)':>14}")
+        print("-" * 43)
+        for name, ms in summary["repo_modules_ms"]:
+            print(f"{name:<28} {ms:>14.1f}")
+    if probe["build_only"]:
+        print(f"❌ Byggeavhengigheter lastet av serverstien: {', '.join(probe['build_only'])}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# test_index_store.py
+# pytest: IndexStore validate-then-swap on temporary index files, and acquire/release keeping a
+# retired version alive until its last request is done, also against ModelRegistry eviction.
+# Needs numpy and faiss (skipped without).
+
+import os
+import json
+
+import pytest
+
+np = pytest.importorskip("numpy")
+faiss = pytest.importorskip("faiss")
+
+from bundle import save_entries
+from icpc_utils import ICPCEntry
+from index_store import IndexStore
+from model_registry import ModelRegistry, ModelSet
+
+DIM = 8
+
+
+def write_index(root, n: int, dim: int = DIM, model: str = "e5", meta_rows: int = None) -> None:
+    """An n-row flat index, metadata for `meta_rows` (default n) codes and a manifest in `root`."""
+    rng = np.random.default_rng(n)
+    vecs = rng.standard_normal((n, dim)).astype(np.float32)
+    faiss.normalize_L2(vecs)
+    index = faiss.IndexFlatIP(dim)
+    index.add(vecs)
+    tmp = os.path.join(root, "index.faiss.tmp")
+    faiss.write_index(index, tmp)
+    os.replace(tmp, os.path.join(root, "index.faiss"))  # build_index.py writes atomically too
+    rows = n if meta_rows is None else meta_rows
+    save_entries([ICPCEntry(f"A{i:02d}", f"tittel {i}", "symptom", 1, "A") for i in range(rows)],
+                 os.path.join(root, "meta.json"))
+    with open(os.path.join(root, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump({"model": model, "dim": dim}, f)
+
+
+@pytest.fixture
+def store(tmp_path):
+    write_index(str(tmp_path), 10)
+    s = IndexStore(str(tmp_path / "index.faiss"), str(tmp_path / "meta.json"), "e5", DIM,
+                   manifest_path=str(tmp_path / "manifest.json"),
+                   probe=np.ones(DIM, dtype=np.float32), neighbors_path=str(tmp_path / "neighbors.npz"))
+    s.load_initial()
+    return s
+
+
+def test_unchanged_files_are_not_reloaded(store):
+    version = store.current().version
+    assert store.reload() == {"status": "unchanged", "version": version}
+    assert store.current().version == version
+
+
+def test_valid_files_are_swapped_in(store, tmp_path):
+    old = store.current()
+    write_index(str(tmp_path), 12)
+    result = store.reload()
+    assert result["status"] == "reloaded" and result["previous"] == old.version
+    assert store.current() is not old and len(store.current().meta) == 12
+    assert old.index is None  # nothing held it, so it was closed at once
+
+
+@pytest.mark.parametrize("bad", [
+    {"meta_rows": 11},  # row count differs from the metadata
+    {"dim": DIM * 2},  # wrong dimension for the embedding model
+    {"model": "annen-modell"},  # built with another model
+])
+def test_invalid_files_keep_the_active_version(store, tmp_path, bad):
+    old = store.current()
+    write_index(str(tmp_path), 12, **bad)
+    result = store.reload()
+    assert result["status"] == "failed" and result["version"] == old.version
+    assert store.current() is old and old.index is not None
+    assert store.stats()["failed"] == 1 and store.stats()["last_error"]
+
+
+def test_retired_version_lives_until_released(store, tmp_path):
+    held = store.acquire()
+    write_index(str(tmp_path), 12)
+    assert store.reload()["status"] == "reloaded"
+    # The running request still searches its own version
+    assert held.index is not None and len(held.meta) == 10
+    assert [r["version"] for r in store.stats()["retired"]] == [held.version]
+    new = store.acquire()
+    assert new is store.current() and new is not held
+    store.release(held)
+    assert held.index is None and store.stats()["retired"] == []
+    store.release(new)
+    assert new.index is not None  # the active version is never closed
+    assert store.stats()["released"] == 1
+
+
+def test_concurrent_reload_is_refused(store):
+    store._reload_lock.acquire()
+    try:
+        assert store.reload() == {"status": "busy"}
+    finally:
+        store._reload_lock.release()
+
+
+def test_registry_keeps_a_set_whose_retired_version_is_in_use(store, tmp_path):
+    registry = ModelRegistry(path="", max_bytes=0)
+    extra = ModelSet("ekstra", {"model": "e5"}, 0.0)
+    extra.store, extra.bytes = store, 1
+    registry.sets["ekstra"] = extra
+    held = store.acquire()
+    write_index(str(tmp_path), 12)
+    assert store.reload()["status"] == "reloaded"  # `held` is now a retired version, still read
+    assert store.in_flight == 1
+    registry._evict(keep=None)
+    assert extra.loaded and held.index is not None
+    store.release(held)
+    registry._evict(keep=None)
+    assert not extra.loaded and registry.evictions == 1
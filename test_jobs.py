@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# test_jobs.py
+# pytest: JobStore claim/complete/requeue on a temporary SQLite file, and JobRunner with
+# RetryLater and store errors
+
+import os
+import time
+import threading
+
+import pytest
+
+import jobs
+from jobs import JobRunner, JobStore, RetryLater
+
+
+@pytest.fixture
+def store(tmp_path):
+    s = JobStore(str(tmp_path / "jobs.sqlite3"))
+    yield s
+    s.close()
+
+
+def wait_for(predicate, timeout=5.0):
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def test_claims_are_fifo_across_jobs(store):
+    first = store.create_job([{"id": "a", "note_text": "en"}, {"id": "b", "note_text": "to"}])
+    second = store.create_job([{"id": 7, "note_text": "tre"}])
+    claimed = [store.claim_next() for _ in range(4)]
+    assert [(r["job_id"], r["idx"]) for r in claimed[:3]] == [(first, 0), (first, 1), (second, 0)]
+    assert claimed[3] is None
+    assert store.get(first)["status"] == "running"
+
+
+def test_complete_and_partial_results(store):
+    job_id = store.create_job([{"id": "a", "note_text": "en"}, {"id": None, "note_text": "to"}])
+    row = store.claim_next()
+    store.complete(row["job_id"], row["idx"], result={"top_k": []})
+    job = store.get(job_id)
+    assert (job["status"], job["done"], job["progress"]) == ("running", 1, 0.5)
+    assert job["results"] == [{"index": 0, "id": "a", "status": "done", "result": {"top_k": []}}]
+    row = store.claim_next()
+    store.complete(row["job_id"], row["idx"], error="feil")
+    job = store.get(job_id)
+    assert (job["status"], job["failed"], job["progress"]) == ("done", 1, 1.0)
+    assert job["results"][1]["error"] == "feil"
+    assert "results" not in store.get(job_id, include_results=False)
+    assert store.get("ukjent") is None
+
+
+def test_release_puts_the_note_back_first_in_line(store):
+    job_id = store.create_job([{"note_text": "en"}, {"note_text": "to"}])
+    row = store.claim_next()
+    store.release(row["job_id"], row["idx"])
+    assert store.get(job_id)["status"] == "queued"
+    assert store.claim_next()["idx"] == 0
+
+
+def test_requeue_orphans_of_dead_processes_only(store):
+    store.create_job([{"note_text": "en"}, {"note_text": "to"}])
+    store.claim_next()
+    store.claim_next()
+    dead = f"{os.uname().nodename}:{2 ** 22 + 12345}"  # above pid_max, never alive
+    store._conn().execute("UPDATE job_notes SET claimed_by = ? WHERE idx = 0", (dead,))
+    assert store.requeue_orphans() == 1
+    row = store.claim_next()
+    assert row["idx"] == 0 and store.claim_next() is None
+
+
+def test_earlier_life_of_the_same_pid_is_an_orphan(store):
+    # A restarted container: same hostname, same PID, but a different process
+    store.create_job([{"note_text": "en"}, {"note_text": "to"}])
+    store.claim_next()
+    store.claim_next()
+    previous = f"{os.uname().nodename}:{os.getpid()}:tidligere"
+    store._conn().execute("UPDATE job_notes SET claimed_by = ? WHERE idx = 1", (previous,))
+    assert store.requeue_orphans() == 1  # our own live claim on idx 0 stays
+    assert store.claim_next()["idx"] == 1
+
+
+def test_runner_sweeps_orphans_while_idle(store, monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_ORPHAN_CHECK", 0.05)
+    sweeps = []
+    real_requeue = store.requeue_orphans
+    monkeypatch.setattr(store, "requeue_orphans", lambda: sweeps.append(1) or real_requeue())
+    runner = JobRunner(store, lambda text: {"ok": text}, workers=1)
+    runner.start()
+    # Not only at start: an idle worker sweeps again, so a process dying later is noticed
+    assert wait_for(lambda: len(sweeps) >= 2, timeout=3.0)
+
+
+def test_runner_retries_later_then_completes(store, monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_RETRY_DELAY", 0.01)
+    attempts = []
+
+    def process(note_text):
+        attempts.append(note_text)
+        if len(attempts) < 3:
+            raise RetryLater()
+        if note_text == "dårlig":
+            raise ValueError("ugyldig notat")
+        return {"note": note_text}
+
+    job_id = store.create_job([{"note_text": "god"}, {"note_text": "dårlig"}])
+    JobRunner(store, process, workers=1).start()
+    assert wait_for(lambda: store.get(job_id)["status"] == "done")
+    job = store.get(job_id)
+    assert attempts[:3] == ["god", "god", "god"]
+    assert [r["status"] for r in job["results"]] == ["done", "failed"]
+    assert job["results"][1]["error"] == "ugyldig notat"
+
+
+def test_runner_survives_store_errors(store, monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_RETRY_DELAY", 0.01)
+    real_claim, failures = store.claim_next, []
+
+    def flaky_claim():
+        if len(failures) < 2:
+            failures.append(1)
+            raise jobs.sqlite3.OperationalError("database is locked")
+        return real_claim()
+
+    monkeypatch.setattr(store, "claim_next", flaky_claim)
+    job_id = store.create_job([{"note_text": "en"}])
+    runner = JobRunner(store, lambda text: {"ok": text}, workers=1)
+    runner.start()
+    runner.notify()
+    assert wait_for(lambda: store.get(job_id)["status"] == "done")
+    assert len(failures) == 2
+    assert all(t.is_alive() for t in threading.enumerate() if t.name.startswith("job-worker"))
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# test_llm_router.py
+# pytest: failover, hedging, circuit breakers and deadline expiry in llm_router, against scripted
+# fake providers (no HTTP) and a fake clock for the breaker
+
+import sys
+import time
+import types
+
+import pytest
+
+try:
+    import dotenv  # noqa: F401
+except ImportError:  # llm_router only calls load_dotenv(); the tests need no .env
+    sys.modules["dotenv"] = types.SimpleNamespace(load_dotenv=lambda *a, **k: False)
+
+import llm_router
+from llm_router import CircuitBreaker, Provider, ProviderRouter
+
+
+class FakeAttempt(llm_router._Attempt):
+    """Plays `SCRIPTS[provider]` instead of calling the provider: (delay s, kind, payload) steps,
+    where kind is "token" or "error". A script that runs out ends the stream normally."""
+
+    SCRIPTS = {}
+
+    def _run(self) -> None:
+        try:
+            for delay, kind, payload in self.SCRIPTS[self.provider.name]:
+                if self.cancelled.wait(delay):
+                    return
+                if kind == "token":
+                    self.token_times.append(time.monotonic())
+                    self.parts.append(payload)
+                self.out.put((self, kind, payload))
+                if kind == "error":
+                    return
+            self.out.put((self, "done", None))
+        finally:
+            if self.on_exit is not None:
+                self.on_exit()
+
+
+@pytest.fixture
+def router(monkeypatch):
+    """make(scripts, **router_kwargs) -> ProviderRouter over fake providers, in script order."""
+    monkeypatch.setattr(llm_router, "_Attempt", FakeAttempt)
+
+    def make(scripts, **kwargs):
+        FakeAttempt.SCRIPTS = scripts
+        providers = [Provider(name=name, base="fake://", api_key="", model=f"{name}-model") for name in scripts]
+        return ProviderRouter(providers, **{"hedge_delay": 0, "timeout": 5, **kwargs})
+
+    return make
+
+
+def counters(r, name):
+    return r.stats()["providers"][name]
+
+
+def test_failover_to_next_provider_on_error(router):
+    r = router({"mistral": [(0, "error", RuntimeError("503"))],
+                "openai": [(0, "token", "hei"), (0, "token", " der")]})
+    assert "".join(r.stream([{"role": "user", "content": "x"}], 0.0, 10)) == "hei der"
+    assert counters(r, "mistral")["errors"] == 1
+    assert counters(r, "openai")["wins"] == 1
+    assert r.breakers["mistral"].snapshot()["window_error_rate"] == 1.0
+
+
+def test_all_providers_failing_raises_last_error(router):
+    r = router({"mistral": [(0, "error", RuntimeError("503"))], "openai": [(0, "error", ValueError("400"))]})
+    with pytest.raises(ValueError):
+        list(r.stream([], 0.0, 10))
+
+
+def test_hedge_wins_and_slow_primary_is_cancelled(router):
+    r = router({"mistral": [(2.0, "token", "sent")], "openai": [(0, "token", "raskt")]}, hedge_delay=0.05)
+    t0 = time.monotonic()
+    report = {}
+    assert "".join(r.stream([], 0.0, 10, report=report)) == "raskt"
+    assert time.monotonic() - t0 < 1.0
+    assert report["provider"] == "openai"
+    assert counters(r, "openai")["hedged"] == 1
+    assert counters(r, "mistral")["cancelled"] == 1
+    # The primary that lost the race counts as slow against its breaker
+    assert r.breakers["mistral"].snapshot()["window_calls"] == 1
+
+
+def test_no_hedge_when_first_token_is_quick(router):
+    r = router({"mistral": [(0, "token", "a"), (0.1, "token", "b")], "openai": [(0, "token", "x")]},
+               hedge_delay=0.05)
+    assert "".join(r.stream([], 0.0, 10)) == "ab"
+    assert counters(r, "openai")["started"] == 0
+
+
+def test_open_breaker_is_skipped(router):
+    r = router({"mistral": [(0, "token", "m")], "openai": [(0, "token", "o")]})
+    r.breakers["mistral"]._opened_at = time.monotonic()
+    assert "".join(r.stream([], 0.0, 10)) == "o"
+    assert counters(r, "mistral")["started"] == 0
+
+
+def test_deadline_stops_a_stalled_stream(router):
+    r = router({"mistral": [(0, "token", "a"), (5.0, "token", "b")]})
+    t0 = time.monotonic()
+    chunks = []
+    with pytest.raises(TimeoutError):
+        for chunk in r.stream([], 0.0, 10, deadline_at=time.monotonic() + 0.2):
+            chunks.append(chunk)
+    assert chunks == ["a"]
+    assert time.monotonic() - t0 < 1.0
+    assert counters(r, "mistral")["cancelled"] == 1
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+def test_breaker_opens_probes_and_closes(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(llm_router, "time", clock)
+    b = CircuitBreaker(window=60, min_calls=4, error_rate=0.5, slow_ttft=2.0, cooldown=30)
+    b.record(True, 0.5)
+    b.record(True, 0.5)
+    b.record(False)
+    assert b.state == "closed"
+    b.record(True, 5.0)  # slow first token counts as bad: 2 of 4
+    assert b.state == "open" and not b.allow()
+
+    clock.now += 30
+    assert b.state == "half-open"
+    assert b.allow()  # the one probe
+    assert not b.allow()
+    b.record(False)
+    assert b.state == "open"
+
+    clock.now += 30
+    assert b.allow()
+    b.record(True, 0.5)
+    assert b.state == "closed" and b.allow()
+
+
+def test_breaker_forgets_outcomes_outside_the_window(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(llm_router, "time", clock)
+    b = CircuitBreaker(window=60, min_calls=3, error_rate=0.5, cooldown=30)
+    b.record(False)
+    b.record(False)
+    clock.now += 61
+    b.record(False)
+    assert b.state == "closed"
+    assert b.snapshot()["window_calls"] == 1
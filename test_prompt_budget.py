@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# test_prompt_budget.py
+# pytest: truncate_note drops whole sentences before cutting into one, keeps every header, and
+# never goes over the budget (chars/4 counter, so no tokenizer is needed)
+
+import pytest
+
+from prompt_budget import TRUNCATION_MARK, TokenCounter, truncate_note
+
+COUNTER = TokenCounter("chars")
+ANAMNESE = "Anamnese: " + " ".join(f"Opplysning nummer {i} om sykehistorien." for i in range(12))
+NOTE = (ANAMNESE + "\nStatus: BT 120/80, puls 80, afebril. Lunger med normale respirasjonslyder."
+        "\nVurdering: Viral øvre luftveisinfeksjon.\nPlan: Råd om væske og hvile.\nKontroll ved behov.")
+HEADERS = ("Anamnese:", "Status:", "Vurdering:", "Plan:")
+
+
+def test_short_note_is_untouched():
+    assert truncate_note(NOTE, COUNTER.count(NOTE), COUNTER) == NOTE
+
+
+def test_whole_sentences_go_before_any_first_sentence_is_cut():
+    out = truncate_note(NOTE, 120, COUNTER)
+    assert COUNTER.count(out) <= 120
+    # Anamnese (lower priority than Plan, higher than Status) lost trailing sentences, but the
+    # first sentence of every section is intact
+    assert "Opplysning nummer 0 om sykehistorien." in out
+    assert "Opplysning nummer 11" not in out
+    assert "Status: BT 120/80, puls 80, afebril." in out
+    assert "Lunger med normale" not in out
+    assert "Vurdering: Viral øvre luftveisinfeksjon." in out
+    assert "Plan: Råd om væske og hvile." in out
+
+
+@pytest.mark.parametrize("budget", [100, 80, 60, 50, 40])
+def test_tight_budget_keeps_every_header(budget):
+    out = truncate_note(NOTE, budget, COUNTER)
+    assert COUNTER.count(out) <= budget
+    assert all(h in out for h in HEADERS), out
+    assert "Vurdering: Viral" in out  # the highest-priority section is cut last
+
+
+def test_never_over_budget_and_line_breaks_survive():
+    for budget in range(1, COUNTER.count(NOTE) + 5):
+        out = truncate_note(NOTE, budget, COUNTER)
+        assert COUNTER.count(out) <= budget
+    out = truncate_note(NOTE, 100, COUNTER)
+    assert out.count("\n") == NOTE.count("\n")
+    assert out.endswith("Kontroll ved behov.")  # Plan outranks Anamnese and Status: untouched
+    assert out.count(TRUNCATION_MARK) == 2
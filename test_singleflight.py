@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# test_singleflight.py
+# pytest: SingleFlight join (coalescing and replay), leave, and cancel when the last subscriber
+# disconnects
+
+import threading
+
+import pytest
+
+from singleflight import SingleFlight
+
+
+def gated_producer(gate: threading.Event, chunks=("a", "b"), calls=None):
+    """Producer that publishes `chunks`, then waits for `gate` before its final event."""
+    def produce(cancel):
+        if calls is not None:
+            calls.append(cancel)
+        for c in chunks:
+            yield 'stream', c
+        while not gate.wait(0.01):
+            if cancel.cancelled:
+                return
+        yield 'final', "".join(chunks)
+    return produce
+
+
+def drain(flight):
+    return [e for e in flight.subscribe() if e[0] != 'heartbeat']
+
+
+def test_identical_requests_share_one_run_with_replay():
+    sf, gate, calls = SingleFlight(), threading.Event(), []
+    first = sf.join("k", gated_producer(gate, calls=calls))
+    second = sf.join("k", gated_producer(gate, calls=calls))
+    assert second is first and first.subscribers == 2
+    gate.set()
+    # Both subscribers see every event from the start, whenever they subscribed
+    expected = [('stream', 'a'), ('stream', 'b'), ('final', 'ab')]
+    assert drain(first) == expected and drain(second) == expected
+    assert len(calls) == 1
+    stats = sf.stats()
+    assert stats["requests"] == 2 and stats["coalesced"] == 1
+
+
+def test_finished_flight_is_not_a_cache():
+    sf, gate = SingleFlight(), threading.Event()
+    gate.set()
+    first = sf.join("k", gated_producer(gate))
+    drain(first)
+    sf.leave(first)
+    assert not sf.has("k")
+    assert sf.join("k", gated_producer(gate)) is not first
+
+
+def test_disabled_never_coalesces():
+    sf, gate = SingleFlight(enabled=False), threading.Event()
+    a = sf.join("k", gated_producer(gate))
+    b = sf.join("k", gated_producer(gate))
+    gate.set()
+    assert a is not b
+    assert drain(a)[-1] == drain(b)[-1] == ('final', 'ab')
+
+
+def test_last_disconnect_cancels_the_flight():
+    sf, gate, calls = SingleFlight(), threading.Event(), []
+    flight = sf.join("k", gated_producer(gate, calls=calls))
+    sf.join("k", gated_producer(gate))
+    sf.leave(flight, disconnected=True)
+    assert not flight.cancel.cancelled  # someone is still reading
+    sf.leave(flight, disconnected=True)
+    assert flight.cancel.cancelled and calls[0].reason == "client disconnected"
+    assert not sf.has("k")  # new identical requests start fresh instead of joining it
+    stats = sf.stats()
+    assert stats["disconnected"] == 2 and stats["cancelled_on_disconnect"] == 1
+
+
+def test_normal_leave_does_not_cancel():
+    sf, gate = SingleFlight(), threading.Event()
+    flight = sf.join("k", gated_producer(gate))
+    sf.leave(flight)
+    assert not flight.cancel.cancelled
+    gate.set()
+    assert drain(flight)[-1] == ('final', 'ab')
+
+
+def test_producer_error_reaches_every_subscriber():
+    sf = SingleFlight()
+
+    def failing(cancel):
+        yield 'stream', "a"
+        raise RuntimeError("provider nede")
+
+    flight = sf.join("k", failing)
+    for _ in range(2):
+        with pytest.raises(RuntimeError, match="provider nede"):
+            drain(flight)
+
+
+def test_heartbeat_while_producer_is_silent():
+    sf, gate = SingleFlight(), threading.Event()
+    flight = sf.join("k", gated_producer(gate, chunks=()))
+    events = flight.subscribe(heartbeat=0.01)
+    assert next(events) == ('heartbeat', None)
+    gate.set()
+    assert [e for e in events if e[0] != 'heartbeat'] == [('final', '')]
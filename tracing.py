@@ -0,0 +1,252 @@
+# tracing.py
+# Per-request tracing (spans as JSONL, OTLP-style fields) and an opt-in sampling profiler that
+# writes flame-graph-ready folded stacks
+
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+# ------------ Config -------------
+TRACE_PATH = os.environ.get("TRACE_PATH", "")  # JSONL span log, e.g. traces.jsonl; empty = tracing off
+TRACE_MAX_MB = float(os.environ.get("TRACE_MAX_MB", "50"))  # rotate to <path>.1 at this size; 0 = never
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "1.0"))  # fraction of requests traced
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))  # fraction of requests profiled
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN", "")  # `X-Profile: <token>` profiles one request
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL", "0.005"))  # seconds between stack samples
+# ---------------------------------
+
+
+class SamplingProfiler:
+    """Samples the Python stacks of the threads working on one request at a fixed interval and
+    aggregates them as folded stacks ("thread;outer;...;inner count"), the input format of
+    flamegraph.pl, speedscope and similar tools. Only registered threads are sampled."""
+
+    def __init__(self, interval: float = PROFILE_INTERVAL):
+        self.interval = interval
+        self.threads: Dict[int, str] = {}
+        self.counts: Counter = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name="profiler", daemon=True)
+
+    def add_thread(self, ident: int, name: str) -> None:
+        self.threads.setdefault(ident, name)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def _loop(self) -> None:
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            for ident, name in list(self.threads.items()):
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(name)
+                self.counts[";".join(reversed(stack))] += 1
+                self.samples += 1
+
+    def stop(self, path: str) -> None:
+        self._stop.set()
+        self._thread.join(timeout=1.0)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, n in self.counts.most_common():
+                f.write(f"{stack} {n}\n")
+
+
+class Span:
+    def __init__(self, trace: "Trace", name: str, parent: Optional["Span"], attrs: Dict[str, Any]):
+        self.trace = trace
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent = parent
+        self.attrs = attrs
+        self.start = time.perf_counter()
+        self.end: Optional[float] = None
+
+    def set(self, **attrs) -> None:
+        self.attrs.update(attrs)
+
+
+class Trace:
+    """Spans of one request. Stages may run on other threads (single-flight producer), so the
+    trace is passed explicitly rather than kept in a thread-local. Written once, on finish()."""
+
+    def __init__(self, tracer: "Tracer", name: str, request_id: str, profiler: Optional[SamplingProfiler] = None):
+        self.tracer = tracer
+        self.request_id = request_id
+        self.trace_id = uuid.uuid4().hex
+        # perf_counter for durations, anchored to wall-clock time for the exported timestamps
+        self._epoch_ns = time.time_ns() - int(time.perf_counter() * 1e9)
+        self.spans: List[Span] = []
+        self.profiler = profiler
+        self._lock = threading.Lock()
+        self._finished = False
+        self.root = self._open(name, None, {"request_id": request_id})
+
+    def _open(self, name: str, parent: Optional[Span], attrs: Dict[str, Any]) -> Span:
+        span = Span(self, name, parent, attrs)
+        with self._lock:
+            self.spans.append(span)
+        if self.profiler is not None:
+            t = threading.current_thread()
+            self.profiler.add_thread(t.ident, t.name)
+        return span
+
+    @contextmanager
+    def span(self, name: str, parent: Optional[Span] = None, **attrs):
+        s = self._open(name, parent or self.root, attrs)
+        try:
+            yield s
+        except BaseException as e:
+            s.attrs.setdefault("error", type(e).__name__)
+            raise
+        finally:
+            s.end = time.perf_counter()
+
+    def set(self, **attrs) -> None:
+        """Attributes on the root span (outcome of the request)."""
+        self.root.attrs.update(attrs)
+
+    def add(self, name: str, start: float, end: float, parent: Optional[Span] = None, **attrs) -> None:
+        """Record a span timed elsewhere (perf_counter start/end)."""
+        s = Span(self, name, parent or self.root, attrs)
+        s.start, s.end = start, end
+        with self._lock:
+            self.spans.append(s)
+
+    def add_timings(self, timings: Dict[str, tuple], parent: Optional[Span] = None) -> None:
+        for name, (start, end) in timings.items():
+            self.add(name, start, end, parent)
+
+    def finish(self, **attrs) -> None:
+        with self._lock:
+            if self._finished:
+                return
+            self._finished = True
+        self.root.attrs.update(attrs)
+        self.root.end = time.perf_counter()
+        if self.profiler is not None:
+            path = os.path.join(PROFILE_DIR, f"{self.request_id}.folded")
+            self.profiler.stop(path)
+            self.root.attrs["profile"] = path
+            self.root.attrs["profile_samples"] = self.profiler.samples
+        self.tracer.write(self)
+
+    def records(self) -> List[Dict[str, Any]]:
+        out = []
+        for s in self.spans:
+            end = s.end if s.end is not None else self.root.end
+            out.append({
+                "trace_id": self.trace_id,
+                "span_id": s.span_id,
+                "parent_span_id": s.parent.span_id if s.parent else None,
+                "name": s.name,
+                "start_time_unix_nano": self._epoch_ns + int(s.start * 1e9),
+                "end_time_unix_nano": self._epoch_ns + int(end * 1e9),
+                "duration_ms": round((end - s.start) * 1000, 3),
+                "attributes": s.attrs,
+            })
+        return out
+
+
+class NullTrace:
+    """Stand-in for requests that are not sampled; every call is a no-op."""
+
+    request_id = None
+    root = None
+
+    @contextmanager
+    def span(self, name: str, parent=None, **attrs):
+        yield _NULL_SPAN
+
+    def set(self, **attrs) -> None:
+        pass
+
+    def add(self, *args, **kwargs) -> None:
+        pass
+
+    def add_timings(self, *args, **kwargs) -> None:
+        pass
+
+    def finish(self, **attrs) -> None:
+        pass
+
+
+class _NullSpan:
+    def set(self, **attrs) -> None:
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+NULL_TRACE = NullTrace()
+
+
+class Tracer:
+    def __init__(self, path: str = TRACE_PATH, sample_rate: float = TRACE_SAMPLE_RATE,
+                 max_bytes: int = int(TRACE_MAX_MB * 1024 * 1024)):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.traces = 0
+        self.profiles = 0
+
+    def wants_profile(self, headers) -> bool:
+        if PROFILE_TOKEN and headers is not None and headers.get("X-Profile") == PROFILE_TOKEN:
+            return True
+        return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+    def start(self, name: str, request_id: Optional[str] = None, profile: bool = False):
+        """A Trace for this request, or NULL_TRACE if tracing is off / not sampled. A profiled
+        request is always traced (the profile path is recorded on its root span)."""
+        request_id = request_id or uuid.uuid4().hex
+        if not profile and (not self.path or random.random() >= self.sample_rate):
+            return NULL_TRACE
+        profiler = None
+        if profile:
+            profiler = SamplingProfiler()
+            profiler.start()
+            self.profiles += 1
+        return Trace(self, name, request_id, profiler)
+
+    def write(self, trace: Trace) -> None:
+        self.traces += 1
+        if not self.path:
+            return
+        lines = "".join(json.dumps(r, ensure_ascii=False, default=str) + "\n" for r in trace.records())
+        with self._lock:
+            self._rotate()
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(lines)
+
+    def _rotate(self) -> None:
+        """Keep the log bounded: at max_bytes the file becomes <path>.1 (replacing the previous one)."""
+        if self.max_bytes <= 0:
+            return
+        try:
+            if os.path.getsize(self.path) >= self.max_bytes:
+                os.replace(self.path, self.path + ".1")
+        except OSError:
+            pass  # not created yet, or another worker rotated it first
+
+    def stats(self) -> Dict[str, Any]:
+        return {"path": self.path or None, "sample_rate": self.sample_rate, "max_bytes": self.max_bytes,
+                "traces": self.traces, "profiles": self.profiles}
+
+
+TRACER = Tracer()